@@ -0,0 +1,159 @@
+#!/usr/bin/env python2
+# -*- coding: utf-8 -*-
+"""
+    Benchmark of scap.cdblib.Writer
+
+    Writes the same records with the writer as originally imported from
+    python-pure-cdb and with the current one, checks that both files are
+    identical and reports, for each writer:
+
+    * elapsed: wall-clock time to put every record and finalize the file
+    * keys/sec: records written per second
+
+    Records are either generated, with keys and values shaped like those of
+    the l10n cache, or read from an upstream l10n JSON file::
+
+        python benchmarks/cdb_writer.py
+        python benchmarks/cdb_writer.py --keys 500000
+        python benchmarks/cdb_writer.py --json /srv/mediawiki/php-1.35.0-wmf.1/cache/l10n/upstream/l10n_cache-en.cdb.json
+
+    Copyright © 2014-2017 Wikimedia Foundation and Contributors.
+
+    This file is part of Scap.
+
+    Scap is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, version 3.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+from __future__ import absolute_import
+from __future__ import print_function
+
+import argparse
+import filecmp
+import json
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+from itertools import chain
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from scap import cdblib  # noqa: E402
+
+
+class ReferenceWriter(object):
+    """The writer as originally imported, see :class:`scap.cdblib.Writer`."""
+
+    def __init__(self, fp, hashfn=cdblib.DJB_HASH):
+        self.fp = fp
+        self.hashfn = hashfn
+
+        fp.write(b"\x00" * 2048)
+        self._unordered = [[] for i in range(256)]
+
+    def put(self, key, value=""):
+        pos = self.fp.tell()
+        self.fp.write(cdblib.WRITE_2_LE4(len(key), len(value)))
+        self.fp.write(key)
+        self.fp.write(value)
+
+        h = self.hashfn(key) & 0xFFFFFFFF
+        self._unordered[h & 0xFF].append((h, pos))
+
+    def finalize(self):
+        index = []
+        for tbl in self._unordered:
+            length = len(tbl) << 1
+            ordered = [(0, 0)] * length
+            for pair in tbl:
+                where = (pair[0] >> 8) % length
+                for i in chain(range(where, length), range(0, where)):
+                    if not ordered[i][0]:
+                        ordered[i] = pair
+                        break
+
+            index.append((self.fp.tell(), length))
+            for pair in ordered:
+                self.fp.write(cdblib.WRITE_2_LE4(*pair))
+
+        self.fp.seek(0)
+        for pair in index:
+            self.fp.write(cdblib.WRITE_2_LE4(*pair))
+        self.fp = None
+
+
+def generate(count):
+    """Records shaped like those of the l10n cache."""
+    rand = random.Random(0)
+    records = []
+    for i in range(count):
+        key = "messages:%s-%d" % ("x" * rand.randint(4, 40), i)
+        value = json.dumps("y" * rand.randint(0, 400))
+        records.append((key, value))
+    return records
+
+
+def load(path):
+    """Records of an upstream l10n JSON file, encoded as update_l10n_cdb does."""
+    with open(path) as f:
+        data = json.load(f)
+    return [(k.encode("utf-8"), v.encode("utf-8")) for k, v in data.items()]
+
+
+def write(writer_class, records, path):
+    start = time.time()
+    with open(path, "wb") as fp:
+        writer = writer_class(fp)
+        for key, value in records:
+            writer.put(key, value)
+        writer.finalize()
+    return time.time() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0].strip())
+    parser.add_argument(
+        "--keys",
+        type=int,
+        default=300000,
+        help="Number of records to generate (default: %(default)s)",
+    )
+    parser.add_argument("--json", help="Upstream l10n JSON file to read records from")
+    args = parser.parse_args()
+
+    records = load(args.json) if args.json else generate(args.keys)
+
+    tmpdir = tempfile.mkdtemp(prefix="cdb-writer-")
+    try:
+        paths = {}
+        print("%10s %10s %12s" % ("writer", "elapsed", "keys/sec"))
+        for name, writer_class in (
+            ("reference", ReferenceWriter),
+            ("current", cdblib.Writer),
+        ):
+            paths[name] = os.path.join(tmpdir, "%s.cdb" % name)
+            elapsed = write(writer_class, records, paths[name])
+            print("%10s %9.2fs %12.0f" % (name, elapsed, len(records) / elapsed))
+
+        if not filecmp.cmp(paths["reference"], paths["current"], shallow=False):
+            print("Outputs differ!")
+            sys.exit(1)
+        print("Outputs are identical (%d bytes)" % os.path.getsize(paths["current"]))
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,146 @@
+#!/usr/bin/env python2
+# -*- coding: utf-8 -*-
+"""
+    Memory benchmark for scap.tasks.update_l10n_cdb
+
+    Builds the CDB file of one upstream l10n JSON file, either loading the
+    whole JSON object first or streaming its members into the CDB writer,
+    and reports for each mode:
+
+    * elapsed: wall-clock time of the update
+    * peak rss: peak resident set size of the process
+    * growth: growth of the peak resident set size during the update
+
+    Each mode runs in a fresh interpreter so the peak memory usage of one
+    does not hide that of the other::
+
+        python benchmarks/l10n_cdb.py
+        python benchmarks/l10n_cdb.py --json /srv/mediawiki/php-1.35.0-wmf.1/cache/l10n/upstream/l10n_cache-en.cdb.json
+
+    Copyright © 2014-2017 Wikimedia Foundation and Contributors.
+
+    This file is part of Scap.
+
+    Scap is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, version 3.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+from __future__ import absolute_import
+from __future__ import print_function
+
+import argparse
+import json
+import os
+import random
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from scap import tasks  # noqa: E402
+
+CDB_FILE = "l10n_cache-bench.cdb"
+MODES = ["load", "streaming"]
+
+
+def generate(path, count, value_size):
+    """Write a JSON file shaped like those of the l10n cache."""
+    rand = random.Random(0)
+    with open(path, "w") as f:
+        f.write("{")
+        for i in range(count):
+            if i:
+                f.write(",")
+            key = "messages:%s-%d" % ("x" * rand.randint(4, 40), i)
+            value = u"yé" * rand.randint(0, value_size)
+            f.write("%s:%s" % (json.dumps(key), json.dumps(value)))
+        f.write("}")
+
+
+def run(args):
+    """Run one mode in this process and return its measurements."""
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    start = time.time()
+
+    tasks.update_l10n_cdb(args.cache_dir, CDB_FILE, False, args.mode == "streaming")
+
+    elapsed = time.time() - start
+    after = resource.getrusage(resource.RUSAGE_SELF)
+    os.unlink(os.path.join(args.cache_dir, CDB_FILE))
+
+    # ru_maxrss is in kilobytes on Linux
+    return {
+        "elapsed": elapsed,
+        "peak_rss": after.ru_maxrss * 1024.0,
+        "growth": (after.ru_maxrss - usage.ru_maxrss) * 1024.0,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0].strip())
+    parser.add_argument(
+        "--keys",
+        type=int,
+        default=200000,
+        help="Number of messages to generate (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--value-size",
+        type=int,
+        default=400,
+        help="Maximum length of generated messages (default: %(default)s)",
+    )
+    parser.add_argument("--json", help="Upstream l10n JSON file to read instead")
+    parser.add_argument("--mode", choices=MODES, help=argparse.SUPPRESS)
+    parser.add_argument("--cache-dir", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.mode:
+        print(json.dumps(run(args)))
+        return
+
+    cache_dir = tempfile.mkdtemp(prefix="l10n-cdb-bench-")
+    try:
+        upstream = os.path.join(cache_dir, "upstream")
+        os.mkdir(upstream)
+        json_path = os.path.join(upstream, "%s.json" % CDB_FILE)
+        if args.json:
+            os.symlink(os.path.abspath(args.json), json_path)
+        else:
+            generate(json_path, args.keys, args.value_size)
+        with open(os.path.join(upstream, "%s.MD5" % CDB_FILE), "w") as f:
+            f.write("\n")
+
+        print("JSON file: %.1f MiB" % (os.path.getsize(json_path) / 1024.0 / 1024.0))
+        print("%10s %10s %12s %12s" % ("mode", "elapsed", "peak rss", "growth"))
+        for mode in MODES:
+            child = [sys.executable, os.path.abspath(__file__), "--mode", mode]
+            child += ["--cache-dir", cache_dir]
+            result = json.loads(subprocess.check_output(child).decode("utf-8"))
+            print(
+                "%10s %9.2fs %10.1fMiB %10.1fMiB"
+                % (
+                    mode,
+                    result["elapsed"],
+                    result["peak_rss"] / 1024.0 / 1024.0,
+                    result["growth"] / 1024.0 / 1024.0,
+                )
+            )
+    finally:
+        shutil.rmtree(cache_dir)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,143 @@
+#!/usr/bin/env python2
+# -*- coding: utf-8 -*-
+"""
+    Fan-out benchmark for scap.ssh.cluster_ssh
+
+    Runs jobs against hosts simulated by :class:`scap.ssh.LocalTransport` and
+    reports, for each fleet size:
+
+    * jobs/sec: completed hosts per second of wall-clock time
+    * sched cpu: CPU seconds spent by scap itself (children excluded), per
+      thousand hosts
+    * mem/host: growth of the peak resident set size, per host
+
+    Each fleet size runs in a fresh interpreter so peak memory usage of one
+    run does not hide that of the next::
+
+        python benchmarks/ssh_fanout.py
+        python benchmarks/ssh_fanout.py --hosts 10 1000 --latency 0.05 --output 4096
+
+    Copyright © 2014-2017 Wikimedia Foundation and Contributors.
+
+    This file is part of Scap.
+
+    Scap is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, version 3.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+from __future__ import absolute_import
+from __future__ import print_function
+
+import argparse
+import json
+import os
+import resource
+import subprocess
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from scap import ssh  # noqa: E402
+
+DEFAULT_SIZES = [10, 1000, 10000]
+
+
+def run(args):
+    """Run one benchmark in this process and return its measurements."""
+    transport = ssh.LocalTransport(
+        latency=args.latency,
+        jitter=args.jitter,
+        output=args.output,
+        failure_rate=args.failure_rate,
+        seed=0,
+    )
+    hosts = ["host%d.example" % i for i in range(args.size)]
+
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    start = time.time()
+
+    completed = 0
+    for _ in ssh.cluster_ssh(hosts, "true", limit=args.batch_size, transport=transport):
+        completed += 1
+
+    elapsed = time.time() - start
+    after = resource.getrusage(resource.RUSAGE_SELF)
+    cpu = (after.ru_utime - usage.ru_utime) + (after.ru_stime - usage.ru_stime)
+
+    return {
+        "hosts": completed,
+        "elapsed": elapsed,
+        "jobs_per_sec": completed / elapsed,
+        "cpu_per_1k": cpu * 1000.0 / completed,
+        # ru_maxrss is in kilobytes on Linux
+        "mem_per_host": (after.ru_maxrss - usage.ru_maxrss) * 1024.0 / completed,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0].strip())
+    parser.add_argument(
+        "--hosts",
+        type=int,
+        nargs="+",
+        default=DEFAULT_SIZES,
+        help="Fleet sizes to simulate (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--batch-size",
+        type=int,
+        default=ssh.DEFAULT_BATCH_SIZE,
+        help="Concurrent hosts (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--latency", type=float, default=0.0, help="Seconds each host takes"
+    )
+    parser.add_argument(
+        "--jitter", type=float, default=0.0, help="Random variation of --latency"
+    )
+    parser.add_argument(
+        "--output", type=int, default=0, help="Bytes of output per host"
+    )
+    parser.add_argument(
+        "--failure-rate", type=float, default=0.0, help="Fraction of hosts failing"
+    )
+    parser.add_argument("--size", type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.size:
+        print(json.dumps(run(args)))
+        return
+
+    print(
+        "%8s %10s %10s %14s %12s"
+        % ("hosts", "elapsed", "jobs/sec", "cpu/1k hosts", "mem/host")
+    )
+    for size in args.hosts:
+        child = [sys.executable, os.path.abspath(__file__), "--size", str(size)]
+        for flag in ("batch_size", "latency", "jitter", "output", "failure_rate"):
+            child += ["--" + flag.replace("_", "-"), str(getattr(args, flag))]
+
+        result = json.loads(subprocess.check_output(child).decode("utf-8"))
+        print(
+            "%8d %9.2fs %10.1f %13.3fs %11.0fB"
+            % (
+                result["hosts"],
+                result["elapsed"],
+                result["jobs_per_sec"],
+                result["cpu_per_1k"],
+                result["mem_per_host"],
+            )
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -26,7 +26,10 @@ from __future__ import absolute_import
 import scap.plugins
 
 from scap.main import (
+    ApplyBundle,
+    Audit,
     CompileWikiversions,
+    JobResults,
     LockManager,
     MWVersionsInUse,
     RebuildCdbs,
@@ -38,6 +41,7 @@ from scap.main import (
     SyncL10n,
     SyncMaster,
     SyncWikiversions,
+    TreeHash,
     Version,
 )
 
@@ -48,10 +52,13 @@ from scap.deploy import Deploy, DeployLocal, DeployLog
 import scap.runcmd
 
 __all__ = [
+    "ApplyBundle",
+    "Audit",
     "CompileWikiversions",
     "Deploy",
     "DeployLocal",
     "DeployLog",
+    "JobResults",
     "LockManager",
     "MWVersionsInUse",
     "RebuildCdbs",
@@ -63,6 +70,7 @@ __all__ = [
     "SyncL10n",
     "SyncMaster",
     "SyncWikiversions",
+    "TreeHash",
     "Version",
     "__version__",
     "runcmd",
@@ -15,12 +15,17 @@ rather than djb_hash() for a tidy speedup.
 .. note::
     Minor alterations made to comply with PEP8 style check and to remove
     attempt to import C implementation of djb_hash. -- bd808, 2014-03-04
+
+    Reader can map files with :meth:`Reader.open` and look up keys through
+    the hash tables. Writer buffers records and only keeps the hash and
+    position of each key, producing the same files as before.
 """
 from __future__ import absolute_import
 
-from itertools import chain
+from array import array
 from _struct import Struct
 
+import mmap
 import sys
 
 
@@ -56,8 +61,10 @@ else:
         >>> py_djb_hash('€')
         193278953
         """
+        if isinstance(s, str):
+            s = s.encode("UTF-8")
         h = 5381
-        for c in s.encode("UTF-8"):
+        for c in s:
             h = (((h << 5) + h) ^ c) & 0xFFFFFFFF
         return h
 
@@ -67,6 +74,10 @@ DJB_HASH = py_djb_hash
 
 READ_2_LE4 = Struct("<LL").unpack
 WRITE_2_LE4 = Struct("<LL").pack
+PACK_2_LE4_INTO = Struct("<LL").pack_into
+
+# Array type code of 32-bit unsigned integers, for hash table slots
+SLOT_TYPE = "I" if array("I").itemsize == 4 else "L"
 
 
 class Reader(object):
@@ -75,7 +86,7 @@ class Reader(object):
     A dictionary-like object for reading a Constant Database.
 
     Reader accesses through a string or string-like sequence
-    such as mmap.mmap().
+    such as mmap.mmap(), see :meth:`open`.
     """
 
     def __init__(self, data, hashfn=DJB_HASH):
@@ -95,25 +106,123 @@ class Reader(object):
         self.data = data
         self.hashfn = hashfn
 
+        try:
+            # Slices of a memoryview do not copy the underlying data
+            self._view = memoryview(data)
+        except TypeError:
+            # Python 2 mmap objects do not support memoryview
+            self._view = None
+
         self.index = [READ_2_LE4(data[i : i + 8]) for i in range(0, 2048, 8)]
         self.table_start = min(p[0] for p in self.index)
         # Assume load load factor is 0.5 like official CDB.
         self.length = sum(p[1] >> 1 for p in self.index)
 
-    def iteritems(self):
-        """Like dict.iteritems(). Items are returned in insertion order."""
+    @classmethod
+    def open(cls, path, hashfn=DJB_HASH):
+        """
+        Create an instance reading a file through mmap, so that only the pages
+        actually accessed are read from disk.
+
+        The instance should be closed once done, or used as a context
+        manager.
+        """
+        with open(path, "rb") as f:
+            try:
+                data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            except ValueError:
+                # Empty file
+                raise OSError("CDB too small")
+        return cls(data, hashfn)
+
+    def close(self):
+        """Release the mmap opened by :meth:`open`."""
+        if self._view is not None:
+            # Python 2 memoryviews cannot be released explicitly
+            if hasattr(self._view, "release"):
+                self._view.release()
+            self._view = None
+        if isinstance(self.data, mmap.mmap):
+            self.data.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def __len__(self):
+        return self.length
+
+    def __getitem__(self, key):
+        value = self.get(key)
+        if value is None:
+            raise KeyError(key)
+        return value
+
+    def __contains__(self, key):
+        return self._find(key) is not None
+
+    def get(self, key, default=None):
+        """
+        Like dict.get(). If a key was put more than once, the first value put
+        is returned.
+        """
+        found = self._find(key)
+        if found is None:
+            return default
+        return self.data[found[0] : found[1]]
+
+    def _find(self, key):
+        """Start and end offsets of the value of a key, or None."""
+        if not isinstance(key, bytes):
+            key = key.encode("utf-8")
+
+        h = self.hashfn(key) & 0xFFFFFFFF
+        start, slots = self.index[h & 0xFF]
+        if not slots:
+            return None
+
+        slot = (h >> 8) % slots
+        for i in range(slots):
+            pos = start + ((slot + i) % slots) * 8
+            record_hash, record_pos = READ_2_LE4(self.data[pos : pos + 8])
+            if not record_pos:
+                # Empty slot: the key is not in the table
+                return None
+            if record_hash != h:
+                continue
+
+            klen, dlen = READ_2_LE4(self.data[record_pos : record_pos + 8])
+            key_pos = record_pos + 8
+            if klen == len(key) and self.data[key_pos : key_pos + klen] == key:
+                return key_pos + klen, key_pos + klen + dlen
+        return None
+
+    def iterviews(self):
+        """
+        Like :meth:`iteritems`, but yield memoryview slices of the data
+        instead of copies where supported.
+        """
+        data = self.data if self._view is None else self._view
         pos = 2048
         while pos < self.table_start:
-            klen, dlen = READ_2_LE4(self.data[pos : pos + 8])
+            klen, dlen = READ_2_LE4(data[pos : pos + 8])
             pos += 8
 
-            key = self.data[pos : pos + klen]
+            key = data[pos : pos + klen]
             pos += klen
 
-            data = self.data[pos : pos + dlen]
+            value = data[pos : pos + dlen]
             pos += dlen
 
-            yield key, data
+            yield key, value
+
+    def iteritems(self):
+        """Like dict.iteritems(). Items are returned in insertion order."""
+        if self._view is None:
+            return self.iterviews()
+        return ((k.tobytes(), v.tobytes()) for k, v in self.iterviews())
 
     def items(self):
         """Like dict.items()."""
@@ -124,6 +233,9 @@ class Writer(object):
     """Object for building new Constant Databases, and writing them to a
     seekable file-like object."""
 
+    # Bytes of records buffered before they are written out
+    BUFFER_SIZE = 1 << 20
+
     def __init__(self, fp, hashfn=DJB_HASH):
         """
         Create an instance writing to a file-like object and hash keys.
@@ -139,39 +251,94 @@ class Writer(object):
         self.hashfn = hashfn
 
         fp.write(b"\x00" * 2048)
-        self._unordered = [[] for i in range(256)]
+        # Records are packed into a preallocated buffer, and their positions
+        # computed from the lengths of the records before them instead of
+        # asking the file.
+        self._buffer = bytearray(self.BUFFER_SIZE)
+        self._used = 0
+        self._pos = 2048
+        # Only the hash and position of each record are kept for finalize()
+        self._hashes = array(SLOT_TYPE)
+        self._positions = array("L")
+        self._inline_hash = hashfn is py_djb_hash and sys.version_info.major == 2
 
     def put(self, key, value=""):
         """Write a string key/value pair to the output file."""
         assert isinstance(key, str) and isinstance(value, str)
 
-        pos = self.fp.tell()
-        self.fp.write(WRITE_2_LE4(len(key), len(value)))
-        self.fp.write(key)
-        self.fp.write(value)
-
-        h = self.hashfn(key) & 0xFFFFFFFF
-        self._unordered[h & 0xFF].append((h, pos))
+        klen, vlen = len(key), len(value)
+        size = 8 + klen + vlen
+        if self._used + size > len(self._buffer):
+            self._flush()
+            if size > len(self._buffer):
+                self._buffer = bytearray(size)
+
+        start = self._used
+        PACK_2_LE4_INTO(self._buffer, start, klen, vlen)
+        self._buffer[start + 8 : start + 8 + klen] = key
+        self._buffer[start + 8 + klen : start + size] = value
+        self._used += size
+
+        if self._inline_hash:
+            # Inlined py_djb_hash, iterating over bytes as integers
+            h = 5381
+            for c in bytearray(key):
+                h = ((h * 33) ^ c) & 0xFFFFFFFF
+        else:
+            h = self.hashfn(key) & 0xFFFFFFFF
+        self._hashes.append(h)
+        self._positions.append(self._pos)
+        self._pos += size
+
+    def _flush(self):
+        if self._used:
+            self.fp.write(memoryview(self._buffer)[: self._used])
+            self._used = 0
 
     def finalize(self):
         """Write the final hash tables to the output file, and write out its
         index. The output file remains open upon return."""
-        index = []
-        for tbl in self._unordered:
-            length = len(tbl) << 1
-            ordered = [(0, 0)] * length
-            for pair in tbl:
-                where = (pair[0] >> 8) % length
-                for i in chain(range(where, length), range(0, where)):
-                    if not ordered[i][0]:
-                        ordered[i] = pair
-                        break
-
-            index.append((self.fp.tell(), length))
-            for pair in ordered:
-                self.fp.write(WRITE_2_LE4(*pair))
+        self._flush()
+        self._buffer = None
+
+        hashes = self._hashes
+
+        # Split records by table
+        tables = [[] for i in range(256)]
+        for i, h in enumerate(hashes):
+            tables[h & 0xFF].append(i)
+
+        index = array(SLOT_TYPE)
+        pos = self._pos
+        for records in tables:
+            length = len(records) << 1
+            # Interleaved (hash, position) slots
+            slots = array(SLOT_TYPE, [0]) * (length << 1)
+            for i in records:
+                h = hashes[i]
+                where = (h >> 8) % length
+                # Like the original implementation, a slot is free as long as
+                # its hash is zero
+                while slots[where << 1]:
+                    where = where + 1 if where + 1 < length else 0
+                slots[where << 1] = h
+                slots[(where << 1) + 1] = self._positions[i]
+
+            index.append(pos)
+            index.append(length)
+            self.fp.write(_le_bytes(slots))
+            pos += length << 3
 
         self.fp.seek(0)
-        for pair in index:
-            self.fp.write(WRITE_2_LE4(*pair))
+        self.fp.write(_le_bytes(index))
         self.fp = None  # prevent double finalize()
+
+
+def _le_bytes(values):
+    """Bytes of an array of 32-bit integers, little-endian."""
+    if sys.byteorder != "little":
+        values = array(SLOT_TYPE, values)
+        values.byteswap()
+    if sys.version_info.major == 2:
+        return values.tostring()
+    return values.tobytes()
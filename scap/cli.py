@@ -35,6 +35,7 @@ import scap.arg as arg
 import scap.config as config
 import scap.lock as lock
 import scap.log as log
+import scap.ssh as ssh
 import scap.targets as targets
 import scap.utils as utils
 
@@ -205,6 +206,52 @@ class Application(object):
             os.environ["PHP"] = php_version
         if auth_sock is not None and self.arguments.shared_authsock:
             os.environ["SSH_AUTH_SOCK"] = auth_sock
+        # Share multiplexed SSH connections between all jobs, if enabled
+        if self.config.get("ssh_connection_pool"):
+            ssh.CONNECTION_POOL = ssh.ConnectionPool(
+                persist=self.config["ssh_connection_pool_persist"]
+            )
+        utils.RESOLVER.ttl = self.config.get("dns_cache_ttl", utils.RESOLVER.ttl)
+        # Record the result of every host of every job, if enabled
+        if self.config.get("job_results"):
+            ssh.RESULT_SINK = ssh.ResultSink(
+                os.path.join(self.config["log_dir"], "job-results.jsonl"),
+                max_size=self.config.get("job_results_max_size"),
+            )
+
+    def _close_connection_pool(self):
+        """Tear down the shared SSH connections and report pool usage."""
+        pool = ssh.CONNECTION_POOL
+        if pool is None:
+            return
+
+        ssh.CONNECTION_POOL = None
+        pool.close()
+
+        if pool.hits or pool.misses:
+            self.get_logger().info(
+                "SSH connection pool: %d hit(s), %d miss(es)", pool.hits, pool.misses
+            )
+            stats = self.get_stats()
+            stats.increment("scap.ssh_pool.hit", pool.hits)
+            stats.increment("scap.ssh_pool.miss", pool.misses)
+
+    def _report_resolver(self):
+        """Report how well host name lookups were cached."""
+        resolver = utils.RESOLVER
+        if not resolver.misses:
+            return
+
+        self.get_logger().debug(
+            "DNS cache: %d hit(s), %d miss(es), %.2fs spent resolving",
+            resolver.hits,
+            resolver.misses,
+            resolver.lookup_time,
+        )
+        stats = self.get_stats()
+        stats.increment("scap.dns_cache.hit", resolver.hits)
+        stats.increment("scap.dns_cache.miss", resolver.misses)
+        stats.timing("scap.dns_cache.lookup", resolver.lookup_time * 1000)
 
     def main(self, *extra_args):
         """
@@ -262,6 +309,20 @@ class Application(object):
 
         :returns: exit status
         """
+        try:
+            self._close_connection_pool()
+        except Exception:
+            self.get_logger().warning("Failed to close SSH connections", exc_info=True)
+
+        if ssh.RESULT_SINK is not None:
+            ssh.RESULT_SINK.close()
+            ssh.RESULT_SINK = None
+
+        try:
+            self._report_resolver()
+        except Exception:
+            self.get_logger().warning("Failed to report DNS cache usage", exc_info=True)
+
         try:
             TERM.reset_colors()
             TERM.close()
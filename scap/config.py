@@ -57,6 +57,32 @@ DEFAULT_CONFIG = {
     "udp2log_port": (str, "8420"),
     "wmf_realm": (str, "production"),
     "ssh_user": (str, getpass.getuser()),
+    "ssh_connection_pool": (bool, False),
+    "ssh_connection_pool_persist": (int, 600),
+    "ssh_output_limit": (int, 256 * 1024),
+    "ssh_output_spill": (bool, False),
+    "ssh_adaptive_concurrency": (bool, False),
+    "ssh_timeout": (float, None),
+    "ssh_connection_retries": (int, 2),
+    "ssh_retry_backoff": (float, 1.0),
+    "ssh_straggler_factor": (float, None),
+    "ssh_straggler_kill": (bool, False),
+    "ssh_schedule": (str, "shuffle"),
+    "ssh_host_locations": (str, None),
+    "log_dir": (str, "/var/log/scap"),
+    "job_results": (bool, True),
+    "job_results_max_size": (int, 64 * 1024 * 1024),
+    "dns_cache_ttl": (int, 300),
+    "sync_world_pipeline": (bool, False),
+    "sync_manifest": (bool, False),
+    "rsync_parallelism": (int, 1),
+    "sync_bundle": (bool, False),
+    "sync_tree_width": (int, 0),
+    "sync_proxy_dependencies": (bool, False),
+    "sync_assign_proxies": (bool, False),
+    "sync_proxy_capacities": (str, None),
+    "nearest_host_mode": (str, "hops"),
+    "nearest_host_cache_ttl": (int, 300),
     "datacenter": (str, "eqiad"),
     "dsh_targets": (str, "mediawiki-installation"),
     "dsh_masters": (str, "scap-masters"),
@@ -83,6 +109,8 @@ DEFAULT_CONFIG = {
     "php_fpm_opcache_threshold": (int, 100),
     "php_fpm_always_restart": (bool, False),
     "php_l10n": (bool, False),  # Feature flag for PHP l10n file generation
+    "cdb_rebuild_streaming": (bool, False),
+    "cdb_json_deltas": (bool, False),
     "cache_revs": (int, 5),
     "use_syslog": (bool, False),
 }
@@ -1053,6 +1053,10 @@ class Deploy(cli.Application):
             verbose=self.verbose,
         )
         deploy_stage.output_handler = ssh.JSONOutputHandler
+        spill_dir = None
+        if self.config["ssh_output_spill"]:
+            spill_dir = self.context.log_path("output", stage)
+        deploy_stage.capture(self.config["ssh_output_limit"], spill_dir)
         deploy_stage.max_failure = self.MAX_FAILURES
         deploy_stage.command(deploy_local_cmd)
         display_name = self._get_stage_name(stage)
@@ -1060,6 +1064,19 @@ class Deploy(cli.Application):
         deploy_stage.progress(
             log.reporter(progress_message, self.config["fancy_progress"])
         )
+        deploy_stage.adaptive(
+            self.config["ssh_adaptive_concurrency"],
+            "deploy-{}".format(stage),
+            self.get_stats(),
+        )
+        deploy_stage.timeout(
+            self.config["ssh_timeout"],
+            self.config["ssh_straggler_factor"],
+            self.config["ssh_straggler_kill"],
+        )
+        deploy_stage.retry(
+            self.config["ssh_connection_retries"], self.config["ssh_retry_backoff"]
+        )
 
         failed = 0
         for host, status in deploy_stage.run_with_status(batch_size):
@@ -343,6 +343,10 @@ class ProgressReporter(object):
         self._failed = 0
         self._fd = fd
 
+    @property
+    def name(self):
+        return self._name
+
     @property
     def ok(self):
         return self._ok
@@ -672,6 +676,11 @@ class Stats(object):
         metric = "%s:%s|c" % (name, value)
         self._send_metric(metric)
 
+    def gauge(self, name, value):
+        """Set a gauge to an absolute value."""
+        metric = "%s:%s|g" % (name, value)
+        self._send_metric(metric)
+
     def _send_metric(self, metric):
         try:
             self.socket.sendto(metric, self.address)
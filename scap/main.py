@@ -24,8 +24,11 @@ from __future__ import absolute_import
 from __future__ import print_function
 
 import argparse
+import collections
 from concurrent.futures import ProcessPoolExecutor
 import errno
+import fnmatch
+import json
 import os
 import pwd
 import select
@@ -39,9 +42,12 @@ import scap.cli as cli
 import scap.lint as lint
 import scap.lock as lock
 import scap.log as log
+import scap.manifest as manifest
 import scap.opcache_manager as opcache_manager
 import scap.php_fpm as php_fpm
+import scap.schedule as schedule
 import scap.ssh as ssh
+import scap.sync_state as sync_state
 import scap.targets as targets
 import scap.tasks as tasks
 import scap.utils as utils
@@ -54,11 +60,15 @@ class AbstractSync(cli.Application):
     the deployment server to the rest of the cluster."""
 
     soft_errors = False
+    # Whether the hosts that failed a sync can be synced again with --resume
+    resumable = False
 
     def __init__(self, exe_name):
         super(AbstractSync, self).__init__(exe_name)
         self.include = None
+        self.bundle = None
         self.om = None
+        self.resume_from = None
 
     @cli.argument(
         "--force",
@@ -73,87 +83,198 @@ class AbstractSync(cli.Application):
 
         with lock.Lock(self.get_lock_file(), self.arguments.message):
             self._check_sync_flag()
-            if not self.arguments.force:
-                if self._can_run_check_fatals():
-                    self.get_logger().info("Checking for new runtime errors locally")
-                    self._check_fatals()
-            else:
-                self.get_logger().warning("check_fatals Skipped by --force")
-            self._before_cluster_sync()
-            self._sync_common()
-            self._after_sync_common()
-            self._sync_masters()
-
-            full_target_list = self._get_target_list()
-
-            if not self.arguments.force:
-                canaries = [
-                    node for node in self._get_canary_list() if node in full_target_list
-                ]
-                with log.Timer("sync-check-canaries", self.get_stats()) as timer:
-                    self.sync_canary(canaries)
-                    timer.mark("Canaries Synced")
-                    self._invalidate_opcache(canaries)
-                    self.canary_checks(canaries, timer)
-            else:
-                self.get_logger().warning("Canaries Skipped by --force")
+            with sync_state.SyncState(
+                self._sync_state_path(),
+                self.resumable,
+                self.arguments.message,
+                self.resume_from,
+            ):
+                if self.resume_from is not None:
+                    self._resume(self.resume_from)
+                else:
+                    self._sync()
+
+        self._after_lock_release()
+        if self.soft_errors:
+            return 1
+        return 0
 
-            # Update proxies
-            proxies = [
-                node for node in self._get_proxy_list() if node in full_target_list
+    def _sync(self):
+        """Sync the deploy directory, then every host of the cluster."""
+        if not self.arguments.force:
+            if self._can_run_check_fatals():
+                self.get_logger().info("Checking for new runtime errors locally")
+                self._check_fatals()
+        else:
+            self.get_logger().warning("check_fatals Skipped by --force")
+        self._before_cluster_sync()
+        self._sync_common()
+        self._after_sync_common()
+        self._sync_masters()
+
+        full_target_list = self._get_target_list()
+
+        if not self.arguments.force:
+            canaries = [
+                node for node in self._get_canary_list() if node in full_target_list
             ]
+            with log.Timer("sync-check-canaries", self.get_stats()) as timer:
+                self.sync_canary(canaries)
+                timer.mark("Canaries Synced")
+                self._invalidate_opcache(canaries)
+                self.canary_checks(canaries, timer)
+        else:
+            self.get_logger().warning("Canaries Skipped by --force")
 
-            with log.Timer("sync-proxies", self.get_stats()):
-                sync_cmd = self._apache_sync_command(self.get_master_list())
-                # Proxies should always use the current host as their sync
-                # origin server.
-                sync_cmd.append(socket.getfqdn())
-                update_proxies = ssh.Job(
-                    proxies, user=self.config["ssh_user"], key=self.get_keyholder_key()
+        # Update proxies
+        proxies = [node for node in self._get_proxy_list() if node in full_target_list]
+
+        # Proxies should always use the current host as their sync
+        # origin server.
+        proxy_cmd = self._apache_sync_command(self.get_master_list())
+        proxy_cmd.append(socket.getfqdn())
+
+        # Update apaches
+        update_apaches = ssh.Job(
+            full_target_list,
+            user=self.config["ssh_user"],
+            key=self.get_keyholder_key(),
+        )
+        update_apaches.exclude_hosts(proxies)
+        update_apaches.exclude_hosts(self.get_master_list())
+        if not self.arguments.force:
+            update_apaches.exclude_hosts(canaries)
+        update_apaches.schedule(self._get_schedule("sync-apaches"))
+        self._tune_job(update_apaches, "sync-apaches")
+
+        if proxies and self.config["sync_proxy_dependencies"]:
+            if self.config["sync_tree_width"]:
+                self.get_logger().warning(
+                    "Ignoring sync_tree_width: web servers pull from their "
+                    "assigned proxy with sync_proxy_dependencies"
                 )
-                update_proxies.command(sync_cmd)
-                update_proxies.progress(
-                    log.reporter("sync-proxies", self.config["fancy_progress"])
+            with log.Timer("sync-proxies-and-apaches", self.get_stats()):
+                self._sync_after_proxies(update_apaches, proxies, proxy_cmd)
+        else:
+            update_proxies = ssh.Job(
+                proxies, user=self.config["ssh_user"], key=self.get_keyholder_key()
+            )
+            update_proxies.command(proxy_cmd)
+            self._tune_job(update_proxies, "sync-proxies")
+
+            with log.Timer("sync-proxies", self.get_stats()):
+                broken = set(
+                    host
+                    for host, status in update_proxies.run_with_status()
+                    if status != 0
                 )
-                succeeded, failed = update_proxies.run()
-                if failed:
-                    self.get_logger().warning("%d proxies had sync errors", failed)
+                if broken:
+                    self.get_logger().warning("%d proxies had sync errors", len(broken))
                     self.soft_errors = True
 
-            # Update apaches
             with log.Timer("sync-apaches", self.get_stats()):
-                update_apaches = ssh.Job(
-                    full_target_list,
-                    user=self.config["ssh_user"],
-                    key=self.get_keyholder_key(),
-                )
-                update_apaches.exclude_hosts(proxies)
-                update_apaches.exclude_hosts(self.get_master_list())
-                if not self.arguments.force:
-                    update_apaches.exclude_hosts(canaries)
-                update_apaches.shuffle()
                 if proxies:
                     targets = proxies
                 else:
-                    # scap pull will try to rsync from localhost if it doesn't
-                    # get a list of deploy servers, so use the list of
-                    # masters if there no proxies.
+                    # scap pull will try to rsync from localhost if it
+                    # doesn't get a list of deploy servers, so use the list
+                    # of masters if there no proxies.
                     targets = self.get_master_list()
-                update_apaches.command(self._apache_sync_command(targets))
-                update_apaches.progress(
-                    log.reporter("sync-apaches", self.config["fancy_progress"])
-                )
-                succeeded, failed = update_apaches.run()
+                if self.config["sync_tree_width"]:
+                    succeeded, failed = self._sync_tree(update_apaches, targets)
+                elif proxies and self.config["sync_assign_proxies"]:
+                    assignment = self._assign_proxies(
+                        update_apaches.get_hosts(), proxies
+                    )
+                    update_apaches.command(
+                        lambda host: self._assigned_sync_command(
+                            assignment, host, proxies, broken
+                        )
+                    )
+                    succeeded, failed = update_apaches.run()
+                    self._report_proxy_load(assignment)
+                else:
+                    update_apaches.command(self._apache_sync_command(targets))
+                    succeeded, failed = update_apaches.run()
                 if failed:
                     self.get_logger().warning("%d apaches had sync errors", failed)
                     self.soft_errors = True
 
-            self._after_cluster_sync()
+        self._after_cluster_sync()
 
-        self._after_lock_release()
-        if self.soft_errors:
-            return 1
-        return 0
+    def _resume(self, state):
+        """
+        Complete an earlier sync on the hosts which failed some of its phases.
+
+        :param state: :class:`scap.sync_state.SyncState` of the earlier sync
+        """
+        plan = state.resume_plan()
+        hosts = plan[sync_state.SYNC]
+
+        masters = [host for host in hosts if host in self.get_master_list()]
+        if masters:
+            self.master_only_cmd("sync-masters", self._master_sync_command(), masters)
+            self.master_only_cmd(
+                "sync-pull-masters", self._proxy_sync_command(), masters
+            )
+
+        proxies = self._get_proxy_list()
+        broken = set()
+        resumed_proxies = [host for host in hosts if host in proxies]
+        if resumed_proxies:
+            update_proxies = ssh.Job(
+                resumed_proxies,
+                user=self.config["ssh_user"],
+                key=self.get_keyholder_key(),
+            )
+            proxy_cmd = self._apache_sync_command(self.get_master_list())
+            proxy_cmd.append(socket.getfqdn())
+            update_proxies.command(proxy_cmd)
+            self._tune_job(update_proxies, "sync-proxies")
+            with log.Timer("sync-proxies", self.get_stats()):
+                broken = set(
+                    host
+                    for host, status in update_proxies.run_with_status()
+                    if status != 0
+                )
+            if broken:
+                self.get_logger().warning("%d proxies had sync errors", len(broken))
+                self.soft_errors = True
+
+        apaches = [
+            host for host in hosts if host not in masters and host not in proxies
+        ]
+        if apaches:
+            sources = [proxy for proxy in proxies if proxy not in broken]
+            update_apaches = ssh.Job(
+                apaches, user=self.config["ssh_user"], key=self.get_keyholder_key()
+            )
+            update_apaches.command(
+                self._apache_sync_command(sources or self.get_master_list())
+            )
+            self._tune_job(update_apaches, "sync-apaches")
+            with log.Timer("sync-apaches", self.get_stats()):
+                succeeded, failed = update_apaches.run()
+            if failed:
+                self.get_logger().warning("%d apaches had sync errors", failed)
+                self.soft_errors = True
+
+        self._after_resume(plan)
+
+    def _after_resume(self, plan):
+        """
+        Run the phases following the sync on the hosts resuming them.
+
+        :param plan: dict mapping phases to hosts, as returned by
+                     :meth:`scap.sync_state.SyncState.resume_plan`
+        """
+        hosts = plan[sync_state.SYNC]
+        if hosts:
+            self._invalidate_opcache(hosts)
+
+    def _sync_state_path(self):
+        """Path of the file recording the hosts each phase of a sync reached."""
+        return os.path.join(self.config["log_dir"], "sync-state.json")
 
     def increment_stat(self, stat, all_stat=True, value=1):
         """Increment a stat in deploy.*
@@ -230,6 +351,153 @@ class AbstractSync(cli.Application):
             utils.get_logger().error("%s's sync.flag is blocking deployments", owner)
             raise IOError(errno.EPERM, "Blocked by sync.flag", sync_flag)
 
+    def _get_schedule(self, name):
+        """Strategy ordering the targets of the given job."""
+        return schedule.get(
+            name,
+            self.config["log_dir"],
+            self.config["ssh_schedule"],
+            self.config["ssh_host_locations"],
+        )
+
+    def _tune_job(self, job, name):
+        """Apply progress, concurrency, deadline and retry settings to a job."""
+        job.progress(log.reporter(name, self.config["fancy_progress"]))
+        job.adaptive(self.config["ssh_adaptive_concurrency"], name, self.get_stats())
+        job.timeout(
+            self.config["ssh_timeout"],
+            self.config["ssh_straggler_factor"],
+            self.config["ssh_straggler_kill"],
+        )
+        job.retry(
+            self.config["ssh_connection_retries"], self.config["ssh_retry_backoff"]
+        )
+
+    def _sync_after_proxies(self, job, proxies, proxy_cmd):
+        """
+        Sync proxies and the hosts of a job in a single run.
+
+        Each host is assigned a proxy and starts syncing as soon as that
+        proxy is done, instead of waiting for all proxies. Hosts whose proxy
+        failed pull from their fallback proxies.
+
+        :param job: :class:`scap.ssh.Job` of the hosts pulling from proxies
+        :param proxies: Proxies to sync first
+        :param proxy_cmd: Command syncing a proxy
+        """
+        assignment = self._assign_proxies(job.get_hosts(), proxies)
+        broken = set()
+
+        def sync_command(host):
+            if host not in assignment:
+                return proxy_cmd
+            return self._assigned_sync_command(assignment, host, proxies, broken)
+
+        job.hosts(list(proxies) + job.get_hosts())
+        job.command(sync_command)
+        job.after(dict((host, servers[0]) for host, servers in assignment.items()))
+
+        failed = 0
+        for host, status in job.run_with_status():
+            if status == 0:
+                continue
+            if host in assignment:
+                failed += 1
+            else:
+                broken.add(host)
+
+        self._report_proxy_load(assignment)
+        if broken:
+            self.get_logger().warning("%d proxies had sync errors", len(broken))
+        if failed:
+            self.get_logger().warning("%d apaches had sync errors", failed)
+        if broken or failed:
+            self.soft_errors = True
+
+    def _assign_proxies(self, hosts, proxies):
+        """
+        Assign each host a proxy and fallbacks by consistent hashing.
+
+        Proxies are weighted by ``sync_proxy_capacities`` and hosts prefer
+        proxies of their own location.
+
+        :returns: dict mapping hosts to their proxies, by order of preference
+        """
+        return schedule.assign_proxies(
+            hosts,
+            proxies,
+            schedule.load_host_map(self.config["sync_proxy_capacities"]),
+            schedule.load_host_map(self.config["ssh_host_locations"]),
+        )
+
+    def _assigned_sync_command(self, assignment, host, proxies, broken):
+        """
+        Synchronization command for a host assigned to proxies.
+
+        :param assignment: Proxies by host, see :meth:`_assign_proxies`
+        :param proxies: All proxies, used when all assigned ones failed
+        :param broken: Proxies which failed to sync
+        """
+        servers = [p for p in assignment[host] if p not in broken]
+        if not servers:
+            servers = [p for p in proxies if p not in broken]
+        return self._apache_sync_command(
+            servers or self.get_master_list(), ordered=True
+        )
+
+    def _report_proxy_load(self, assignment):
+        """Log and report the number of hosts assigned to each proxy."""
+        load = collections.Counter(servers[0] for servers in assignment.values())
+        for proxy, hosts in sorted(load.items()):
+            self.get_logger().info("%s served %d hosts", proxy, hosts)
+            self.get_stats().gauge("scap.proxy_load.%s" % proxy.split(".")[0], hosts)
+
+    def _sync_tree(self, job, sources):
+        """
+        Sync the hosts of a job level by level along a distribution tree.
+
+        Each host pulls from its parent in the tree, or from its closest
+        ancestor that synced successfully. Hosts serving others must run an
+        rsync daemon exporting the ``common`` module, like the proxies.
+
+        :param job: :class:`scap.ssh.Job` to run
+        :param sources: Hosts the first level pulls from
+        :returns: (succeeded, failed) counts
+        """
+        levels = schedule.distribution_tree(
+            sources,
+            job.get_hosts(),
+            self.config["sync_tree_width"],
+            schedule.load_host_map(self.config["ssh_host_locations"]),
+        )
+
+        parents = {}
+        broken = set()
+
+        def sync_command(host):
+            server = parents[host]
+            while server in broken and server in parents:
+                server = parents[server]
+            return self._apache_sync_command([server])
+
+        job.command(sync_command)
+
+        succeeded = failed = 0
+        for depth, level in enumerate(levels, 1):
+            self.get_logger().info(
+                "Syncing %d hosts at level %d of %d", len(level), depth, len(levels)
+            )
+            parents.update(level)
+            job.hosts(level)
+            for host, status in job.run_with_status():
+                if status == 0:
+                    succeeded += 1
+                else:
+                    failed += 1
+                    broken.add(host)
+
+        return succeeded, failed
+
     def _get_proxy_list(self):
         """Get list of sync proxy hostnames that should be updated before the
         rest of the cluster."""
@@ -260,15 +528,17 @@ class AbstractSync(cli.Application):
         self.master_only_cmd("sync-masters", self._master_sync_command())
         self.master_only_cmd("sync-pull-masters", self._proxy_sync_command())
 
-    def master_only_cmd(self, timer, cmd):
+    def master_only_cmd(self, timer, cmd, masters=None):
         """
         Run a command on all other master servers than the one we're on
 
         :param timer: String name to use in timer/logging
         :param cmd: List of command/parameters to be executed
+        :param masters: Master servers to run the command on, defaults to all
         """
 
-        masters = self.get_master_list()
+        if masters is None:
+            masters = self.get_master_list()
         with log.Timer(timer, self.get_stats()):
             update_masters = ssh.Job(
                 masters, user=self.config["ssh_user"], key=self.get_keyholder_key()
@@ -292,36 +562,96 @@ class AbstractSync(cli.Application):
     def _proxy_sync_command(self):
         """Synchronization command to run on the proxy hosts."""
         cmd = [self.get_script_path(), "pull", "--no-php-restart", "--no-update-l10n"]
+        if self.config["sync_manifest"]:
+            cmd.append("--manifest")
+        if self.verbose:
+            cmd.append("--verbose")
+        return cmd
+
+    def _bundle_sync_command(self):
+        """Command fetching and unpacking the bundle of the synced files."""
+        cmd = [
+            self.get_script_path(),
+            "pull",
+            "--no-update-l10n",
+            "--no-php-restart",
+            "--bundle",
+            self.bundle,
+        ]
         if self.verbose:
             cmd.append("--verbose")
         return cmd
 
-    def _apache_sync_command(self, proxies):
+    def _apache_sync_command(self, proxies, ordered=False):
         """
         Synchronization command to run on the apache hosts.
 
         :param proxies: List of proxy hostnames
+        :param ordered: Proxies are listed by order of preference
         """
-        return self._proxy_sync_command() + proxies
+        cmd = self._proxy_sync_command()
+        if ordered:
+            cmd.append("--ordered")
+        return cmd + proxies
 
-    def _sync_common(self):
-        """Sync stage_dir to deploy_dir on the deployment host."""
-        includes = None
-
-        if self.include is not None:
-            includes = []
+    def _includes(self):
+        """
+        Paths to sync, as rsync include patterns.
 
-            parts = self.include.split("/")
+        :attr:`include` is either a single pattern or a list of patterns.
+        """
+        if self.include is None:
+            return []
+        if isinstance(self.include, list):
+            return self.include
+        return [self.include]
+
+    def _rsync_includes(self):
+        """Include patterns of the paths to sync and their parents."""
+        includes = []
+        for include in self._includes():
+            parts = include.split("/")
             for i in range(1, len(parts)):
                 # Include parent directories in sync command or the default
                 # exclude will block them and by extension block the target
                 # file.
-                includes.append("/".join(parts[:i]))
+                parent = "/".join(parts[:i])
+                if parent not in includes:
+                    includes.append(parent)
+            if include not in includes:
+                includes.append(include)
+        return includes
+
+    def _include_sync_command(self):
+        """Command syncing the paths to sync on the proxy hosts."""
+        if self.bundle is not None:
+            return self._bundle_sync_command()
+
+        cmd = [self.get_script_path(), "pull", "--no-update-l10n", "--no-php-restart"]
+        for include in self._rsync_includes():
+            cmd.extend(["--include", include])
+        if self.verbose:
+            cmd.append("--verbose")
+        return cmd
 
-            includes.append(self.include)
+    def _sync_common(self):
+        """Sync stage_dir to deploy_dir on the deployment host."""
+        includes = None
+
+        if self.include is not None:
+            includes = self._rsync_includes()
             includes.append("php-*/cache/gitinfo")
 
         tasks.sync_common(self.config, include=includes, verbose=self.verbose)
+        if self.include is not None and self.config["sync_bundle"]:
+            with log.Timer("build-bundle", self.get_stats()):
+                self.bundle = tasks.build_bundle(
+                    self.config,
+                    [include.replace("/***", "") for include in self._includes()],
+                )
+        if self.config["sync_manifest"]:
+            with log.Timer("publish-manifest", self.get_stats()):
+                tasks.publish_manifest(self.config)
 
     def _git_repo(self):
         """Flatten deploy directory into shared git repo."""
@@ -625,9 +955,17 @@ class RebuildCdbs(cli.Application):
             versions = {version: versions[version]}
 
         # Rebuild the CDB files from the JSON versions
-        for version in versions.keys():
-            cache_dir = os.path.join(root_dir, "php-%s" % version, "cache", "l10n")
-            tasks.merge_cdb_updates(cache_dir, use_cores, True, self.arguments.mute)
+        cache_dirs = [
+            os.path.join(root_dir, "php-%s" % active, "cache", "l10n")
+            for active in versions.keys()
+        ]
+        tasks.merge_cdb_updates(
+            cache_dirs,
+            use_cores,
+            True,
+            self.arguments.mute,
+            self.config.get("cdb_rebuild_streaming", False),
+        )
 
 
 @cli.command("sync", help="Deploy MediaWiki to the cluster (formerly scap)")
@@ -688,13 +1026,23 @@ class ScapWorld(AbstractSync):
     #. Ask apaches to sync wikiversions.php
     #. Run refreshMessageBlobs.php
     #. Rolling invalidation of all opcache for php 7.x
+
+    With ``--resume``, only the hosts which failed a phase of the last
+    sync-world go through that phase and the following ones again.
     """
 
+    resumable = True
+
     @cli.argument(
         "--force",
         action="store_true",
         help="Skip canary checks, " "performs ungraceful php-fpm restarts",
     )
+    @cli.argument(
+        "--resume",
+        action="store_true",
+        help="Only sync the hosts which failed the last sync-world",
+    )
     @cli.argument(
         "-w",
         "--canary-wait-time",
@@ -724,6 +1072,26 @@ class ScapWorld(AbstractSync):
         if wait is not None:
             self.config["canary_wait_time"] = wait
 
+        if self.arguments.resume:
+            state = sync_state.load(self._sync_state_path())
+            if state is None or not state.resumable or not state.complete:
+                self.get_logger().error(
+                    "The last sync was not a completed sync-world, nothing to resume"
+                )
+                return 1
+
+            hosts = set()
+            for phase_hosts in state.resume_plan().values():
+                hosts.update(phase_hosts)
+            if not hosts:
+                self.get_logger().info("All hosts completed the last sync-world")
+                return 0
+
+            self.get_logger().info(
+                "Resuming sync-world %s on %d hosts", state.run, len(hosts)
+            )
+            self.resume_from = state
+
         return super(ScapWorld, self).main(*extra_args)
 
     def _before_cluster_sync(self):
@@ -759,12 +1127,53 @@ class ScapWorld(AbstractSync):
 
     def _after_cluster_sync(self):
         target_hosts = self._get_target_list()
+        if self.config["sync_world_pipeline"]:
+            self._rebuild_cdbs_and_sync_wikiversions(target_hosts)
+        else:
+            self._rebuild_cdbs(target_hosts)
+
+            # Update and sync wikiversions.php
+            succeeded, failed = tasks.sync_wikiversions(
+                target_hosts, self.config, key=self.get_keyholder_key()
+            )
+            if failed:
+                self.get_logger().warning(
+                    "%d hosts had sync_wikiversions errors", failed
+                )
+                self.soft_errors = True
+
+        tasks.clear_message_blobs()
+        self._invalidate_opcache()
+        self._restart_php()
+
+    def _after_resume(self, plan):
+        hosts = plan[sync_state.CDB_REBUILD]
+        if hosts:
+            self._rebuild_cdbs(hosts)
+
+        hosts = plan[sync_state.WIKIVERSIONS]
+        if hosts:
+            succeeded, failed = tasks.sync_wikiversions(
+                hosts, self.config, key=self.get_keyholder_key()
+            )
+            if failed:
+                self.get_logger().warning(
+                    "%d hosts had sync_wikiversions errors", failed
+                )
+                self.soft_errors = True
+
+        hosts = set()
+        for phase_hosts in plan.values():
+            hosts.update(phase_hosts)
+        self._invalidate_opcache(sorted(hosts))
+
+    def _rebuild_cdbs(self, target_hosts):
         # Ask apaches to rebuild l10n CDB files
         with log.Timer("scap-cdb-rebuild", self.get_stats()):
             rebuild_cdbs = ssh.Job(
                 target_hosts, user=self.config["ssh_user"], key=self.get_keyholder_key()
             )
-            rebuild_cdbs.shuffle()
+            rebuild_cdbs.schedule(self._get_schedule("scap-cdb-rebuild"))
             rebuild_cdbs.command(
                 "sudo -u mwdeploy -n -- %s cdb-rebuild" % self.get_script_path()
             )
@@ -778,17 +1187,52 @@ class ScapWorld(AbstractSync):
                 )
                 self.soft_errors = True
 
-        # Update and sync wikiversions.php
-        succeeded, failed = tasks.sync_wikiversions(
-            target_hosts, self.config, key=self.get_keyholder_key()
-        )
-        if failed:
-            self.get_logger().warning("%d hosts had sync_wikiversions errors", failed)
-            self.soft_errors = True
+    def _rebuild_cdbs_and_sync_wikiversions(self, target_hosts):
+        """
+        Rebuild l10n CDB files and sync wikiversions in one pass.
 
-        tasks.clear_message_blobs()
-        self._invalidate_opcache()
-        self._restart_php()
+        Each host switches to the new wikiversions as soon as its own CDB
+        files are rebuilt, instead of waiting for the whole cluster.
+        """
+        with log.Timer("scap-cdb-rebuild-sync-wikiversions", self.get_stats()):
+            tasks.compile_wikiversions("stage", self.config)
+
+            job = ssh.Job(
+                target_hosts, user=self.config["ssh_user"], key=self.get_keyholder_key()
+            )
+            job.schedule(self._get_schedule("scap-cdb-rebuild"))
+            job.pipeline(
+                [
+                    (
+                        "scap-cdb-rebuild",
+                        "sudo -u mwdeploy -n -- %s cdb-rebuild"
+                        % self.get_script_path(),
+                    ),
+                    (
+                        "sync_wikiversions",
+                        tasks.wikiversions_rsync_command(self.config),
+                    ),
+                ],
+                stop_on_failure=False,
+            )
+            job.progress(
+                log.reporter(
+                    "scap-cdb-rebuild+sync_wikiversions", self.config["fancy_progress"]
+                )
+            )
+
+            failed = {}
+            for host, status, steps in job.run_pipeline():
+                for step in steps:
+                    self.get_stats().timing(
+                        "scap.%s.host" % step.name, step.duration * 1000
+                    )
+                    if step.status != 0:
+                        failed[step.name] = failed.get(step.name, 0) + 1
+
+            for name, count in sorted(failed.items()):
+                self.get_logger().warning("%d hosts had %s errors", count, name)
+                self.soft_errors = True
 
     def _after_lock_release(self):
         self.announce(
@@ -811,7 +1255,7 @@ class ScapWorld(AbstractSync):
     def _before_exit(self, exit_status):
         if self.config:
             self.get_stats().timing("scap.scap", self.get_duration() * 1000)
-        return exit_status
+        return super(ScapWorld, self)._before_exit(exit_status)
 
 
 @cli.command("pull-master", help=argparse.SUPPRESS)
@@ -854,24 +1298,50 @@ class SyncCommon(cli.Application):
         action="store_true",
         help="Also delete local files not found on the master.",
     )
+    @cli.argument(
+        "--manifest",
+        action="store_true",
+        dest="use_manifest",
+        help="Only fetch files changed according to the master's manifest.",
+    )
+    @cli.argument(
+        "--ordered",
+        action="store_true",
+        help="Servers are listed by preference: use the first reachable one"
+        " instead of the nearest.",
+    )
     @cli.argument(
         "--no-php-restart",
         action="store_false",
         dest="php_restart",
         help="Check to see if php needs a restart",
     )
+    @cli.argument(
+        "--bundle",
+        metavar="DIGEST",
+        help="Fetch and unpack the given bundle instead of syncing.",
+    )
     @cli.argument(
         "servers", nargs=argparse.REMAINDER, help="Rsync server(s) to copy from"
     )
     def main(self, *extra_args):
-        rsync_args = ["--delete-excluded"] if self.arguments.delete_excluded else []
-        tasks.sync_common(
-            self.config,
-            include=self.arguments.include,
-            sync_from=self.arguments.servers,
-            verbose=self.verbose,
-            rsync_args=rsync_args,
-        )
+        if self.arguments.bundle:
+            cmd = [self.get_script_path(), "apply-bundle"]
+            if self.arguments.ordered:
+                cmd.append("--ordered")
+            cmd.append(self.arguments.bundle)
+            utils.sudo_check_call("mwdeploy", " ".join(cmd + self.arguments.servers))
+        else:
+            rsync_args = ["--delete-excluded"] if self.arguments.delete_excluded else []
+            tasks.sync_common(
+                self.config,
+                include=self.arguments.include,
+                sync_from=self.arguments.servers,
+                verbose=self.verbose,
+                rsync_args=rsync_args,
+                use_manifest=self.arguments.use_manifest,
+                ordered=self.arguments.ordered,
+            )
         if self.arguments.update_l10n:
             with log.Timer("scap-cdb-rebuild", self.get_stats()):
                 utils.sudo_check_call(
@@ -898,61 +1368,141 @@ class SyncCommon(cli.Application):
         return 0
 
 
+@cli.command("apply-bundle", help=argparse.SUPPRESS)
+class ApplyBundle(cli.Application):
+    """Unpack a bundle of files into the local MediaWiki deployment directory."""
+
+    @cli.argument(
+        "--ordered",
+        action="store_true",
+        help="Servers are listed by preference: use the first reachable one"
+        " instead of the nearest.",
+    )
+    @cli.argument("bundle", help="Digest of the bundle")
+    @cli.argument(
+        "servers", nargs=argparse.REMAINDER, help="Rsync server(s) to copy from"
+    )
+    def main(self, *extra_args):
+        tasks.apply_bundle(
+            self.config,
+            self.arguments.bundle,
+            sync_from=self.arguments.servers,
+            ordered=self.arguments.ordered,
+        )
+        return 0
+
+
 @cli.command("sync-dir", help=argparse.SUPPRESS)
 @cli.command("sync-file")
 class SyncFile(AbstractSync):
-    """Sync a specific file/directory to the cluster."""
+    """
+    Sync specific files/directories to the cluster.
+
+    All files are linted together, and synced in a single pass over the
+    cluster followed by a single opcache invalidation.
+    """
 
     @cli.argument("--force", action="store_true", help="Skip canary checks")
-    @cli.argument("file", help="File/directory to sync")
+    @cli.argument(
+        "-f",
+        "--file",
+        dest="extra_files",
+        action="append",
+        default=[],
+        metavar="PATH",
+        help="File/directory to sync. Can be used multiple times. All"
+        " positional arguments are then part of the log message.",
+    )
+    @cli.argument(
+        "--files-from",
+        metavar="FILE",
+        help="Sync the files/directories listed in FILE (- for stdin), one per"
+        " line. All positional arguments are then part of the log message.",
+    )
+    @cli.argument(
+        "file",
+        nargs="?",
+        help="File/directory to sync, if neither --file nor --files-from is used",
+    )
     @cli.argument("message", nargs="*", help="Log message for SAL")
     def main(self, *extra_args):
+        self.files = self._get_files()
+        if not self.files:
+            self._argparser.error("no file/directory to sync")
         return super(SyncFile, self).main(*extra_args)
 
-    def _before_cluster_sync(self):
-        # assert file exists
-        abspath = os.path.join(self.config["stage_dir"], self.arguments.file)
-        if not os.path.exists(abspath):
-            raise IOError(errno.ENOENT, "File/directory not found", abspath)
+    def _get_files(self):
+        """Paths to sync, relative to the staging directory."""
+        files = []
+        files_from = getattr(self.arguments, "files_from", None)
+        extra_files = getattr(self.arguments, "extra_files", [])
+        message_only = files_from is not None or bool(extra_files)
+
+        if message_only and self.arguments.file is not None:
+            # The first word of the message was taken for a file
+            if self.arguments.message == "(no justification provided)":
+                self.arguments.message = self.arguments.file
+            else:
+                self.arguments.message = "%s %s" % (
+                    self.arguments.file,
+                    self.arguments.message,
+                )
+        elif self.arguments.file is not None:
+            files.append(self.arguments.file)
 
-        relpath = os.path.relpath(abspath, self.config["stage_dir"])
-        if os.path.isdir(abspath):
-            relpath = "%s/***" % relpath
-        self.include = relpath
+        if files_from == "-":
+            files.extend(sys.stdin.read().splitlines())
+        elif files_from is not None:
+            with open(files_from) as f:
+                files.extend(f.read().splitlines())
 
-        # Notify when syncing a symlink.
-        if os.path.islink(abspath):
-            symlink_dest = os.path.realpath(abspath)
-            self.get_logger().info(
-                "%s: syncing symlink, not its target [%s]", abspath, symlink_dest
-            )
-        else:
-            lint.check_valid_syntax(abspath, utils.cpus_for_jobs())
+        files.extend(extra_files)
+
+        paths = []
+        for path in files:
+            path = path.strip()
+            if path and path not in paths:
+                paths.append(path)
+        return paths
+
+    def _before_cluster_sync(self):
+        includes = []
+        lint_paths = []
+        for path in self.files:
+            # assert file exists
+            abspath = os.path.join(self.config["stage_dir"], path)
+            if not os.path.exists(abspath):
+                raise IOError(errno.ENOENT, "File/directory not found", abspath)
+
+            relpath = os.path.relpath(abspath, self.config["stage_dir"])
+            if os.path.isdir(abspath):
+                relpath = "%s/***" % relpath
+            includes.append(relpath)
+
+            # Notify when syncing a symlink.
+            if os.path.islink(abspath):
+                symlink_dest = os.path.realpath(abspath)
+                self.get_logger().info(
+                    "%s: syncing symlink, not its target [%s]", abspath, symlink_dest
+                )
+            else:
+                lint_paths.append(abspath)
+
+        self.include = includes
+        if lint_paths:
+            lint.check_valid_syntax(lint_paths, utils.cpus_for_jobs())
 
     def _after_cluster_sync(self):
-        self._invalidate_opcache(None, self.arguments.file)
+        self._invalidate_opcache(None, self.files)
         self._restart_php()
 
     def _proxy_sync_command(self):
-        cmd = [self.get_script_path(), "pull", "--no-update-l10n", "--no-php-restart"]
-
-        if "/" in self.include:
-            parts = self.include.split("/")
-            for i in range(1, len(parts)):
-                # Include parent directories in sync command or the default
-                # exclude will block them and by extension block the target
-                # file.
-                cmd.extend(["--include", "/".join(parts[:i])])
-
-        cmd.extend(["--include", self.include])
-        if self.verbose:
-            cmd.append("--verbose")
-        return cmd
+        return self._include_sync_command()
 
     def _after_lock_release(self):
         self.announce(
             "Synchronized %s: %s (duration: %s)",
-            self.arguments.file,
+            ", ".join(self.files),
             self.arguments.message,
             utils.human_duration(self.get_duration()),
         )
@@ -990,19 +1540,7 @@ class SyncL10n(AbstractSync):
         self.include = "%s/***" % relpath
 
     def _proxy_sync_command(self):
-        cmd = [self.get_script_path(), "pull", "--no-update-l10n", "--no-php-restart"]
-
-        parts = self.include.split("/")
-        for i in range(1, len(parts)):
-            # Include parent directories in sync command or the default
-            # exclude will block them and by extension block the target
-            # file.
-            cmd.extend(["--include", "/".join(parts[:i])])
-
-        cmd.extend(["--include", self.include])
-        if self.verbose:
-            cmd.append("--verbose")
-        return cmd
+        return self._include_sync_command()
 
     def _after_cluster_sync(self):
         # Rebuild l10n CDB files
@@ -1011,7 +1549,7 @@ class SyncL10n(AbstractSync):
             rebuild_cdbs = ssh.Job(
                 target_hosts, user=self.config["ssh_user"], key=self.get_keyholder_key()
             )
-            rebuild_cdbs.shuffle()
+            rebuild_cdbs.schedule(self._get_schedule("scap-cdb-rebuild"))
             cdb_cmd = "sudo -u mwdeploy -n -- {} cdb-rebuild --version {}"
             cdb_cmd = cdb_cmd.format(self.get_script_path(), self.arguments.version)
             rebuild_cdbs.command(cdb_cmd)
@@ -1127,6 +1665,11 @@ class RefreshCdbJsonFiles(cli.Application):
         type=int,
         help="Number of threads to use to build json/md5 files",
     )
+    @cli.argument(
+        "--deltas",
+        action="store_true",
+        help="Also write the keys changed since the previous json files",
+    )
     def main(self, *extra_args):
         cdb_dir = os.path.realpath(self.arguments.directory)
         upstream_dir = os.path.join(cdb_dir, "upstream")
@@ -1141,7 +1684,173 @@ class RefreshCdbJsonFiles(cli.Application):
         if not os.path.isdir(upstream_dir):
             os.mkdir(upstream_dir)
 
-        tasks.refresh_cdb_json_files(cdb_dir, use_cores, self.verbose)
+        tasks.refresh_cdb_json_files(
+            cdb_dir, use_cores, self.verbose, self.arguments.deltas
+        )
+
+
+@cli.command("job-results", help="Show per-host results of past jobs")
+class JobResults(cli.Application):
+    """
+    Show the result of each host as recorded while running jobs.
+
+    Shows the most recent scap run unless ``--run`` is given.
+
+    examples::
+
+        job-results --failed --output
+        job-results --job sync-apaches --host 'mw1*'
+    """
+
+    @cli.argument("--run", help="Run to show, as reported by failed jobs")
+    @cli.argument("--job", help="Only show results of this job")
+    @cli.argument("--host", help="Only show hosts matching this glob pattern")
+    @cli.argument("--failed", action="store_true", help="Only show failed hosts")
+    @cli.argument(
+        "--output", action="store_true", help="Show the output of failed hosts"
+    )
+    @cli.argument("--json", action="store_true", help="Show raw JSON records")
+    def main(self, *extra_args):
+        path = os.path.join(self.config["log_dir"], "job-results.jsonl")
+        if not os.path.exists(path):
+            self.get_logger().error("No job results recorded in %s", path)
+            return 1
+
+        # Concurrent scap runs interleave their records, so they are grouped
+        # by run. The latest run is the one that started last.
+        runs = collections.OrderedDict()
+        for record in ssh.read_results(path):
+            run = record.get("run")
+            if self.arguments.run is not None and run != self.arguments.run:
+                continue
+            results = runs.setdefault(run, [])
+            if self._matches(record):
+                results.append(record)
+
+        results = []
+        if runs:
+            results = runs[next(reversed(runs))]
+
+        for record in results:
+            if self.arguments.json:
+                print(json.dumps(record, sort_keys=True))
+                continue
+
+            print(
+                "%s %-16s %-40s %4d %8.1fs"
+                % (
+                    record["run"],
+                    record["job"],
+                    record["host"],
+                    record["status"],
+                    record["duration"] or 0,
+                )
+            )
+            if self.arguments.output and record.get("output"):
+                for line in record["output"].splitlines():
+                    print("    %s" % line)
+
+        return 0
+
+    def _matches(self, record):
+        if self.arguments.job and record.get("job") != self.arguments.job:
+            return False
+        if self.arguments.host and not fnmatch.fnmatch(
+            record.get("host", ""), self.arguments.host
+        ):
+            return False
+        if self.arguments.failed and record.get("status") == 0:
+            return False
+        return True
+
+
+@cli.command("audit", help="Compare deploy directories across the fleet")
+class Audit(cli.Application):
+    """
+    Compare the deploy directory of every target with the local one.
+
+    Each target hashes its deploy directory into a tree of directory hashes,
+    in parallel, and the directories whose content differs from the local
+    copy are listed per host.
+    """
+
+    @cli.argument(
+        "--depth",
+        type=int,
+        default=2,
+        help="Levels of directories to compare (default: %(default)s)",
+    )
+    def main(self, *extra_args):
+        logger = self.get_logger()
+        depth = self.arguments.depth
+
+        with log.Timer("hash-deploy-dir", self.get_stats()):
+            expected = tasks.tree_hashes(self.config, depth)
+
+        hosts = (
+            set(self.get_master_list())
+            | set(targets.get("dsh_proxies", self.config).all)
+            | set(targets.get("dsh_targets", self.config).all)
+        )
+        audit = ssh.Job(
+            hosts, user=self.config["ssh_user"], key=self.get_keyholder_key()
+        )
+        audit.exclude_hosts([socket.getfqdn()])
+        audit.command([self.get_script_path(), "tree-hash", "--depth", str(depth)])
+        audit.progress(log.reporter("audit", self.config["fancy_progress"]))
+
+        matching = 0
+        divergent = {}
+        failed = []
+        for host, status, output in audit.run_with_output():
+            actual = self._parse_tree(output) if status == 0 else None
+            if actual is None:
+                failed.append(host)
+                continue
+
+            paths = manifest.divergent(expected, actual)
+            if paths:
+                divergent[host] = paths
+            else:
+                matching += 1
+
+        for host in sorted(divergent):
+            print("%s: %s" % (host, " ".join(p or "/" for p in divergent[host])))
+
+        logger.info(
+            "%d hosts match, %d diverge, %d could not be audited",
+            matching,
+            len(divergent),
+            len(failed),
+        )
+        if failed:
+            logger.warning("Audit failed on: %s", ", ".join(sorted(failed)))
+
+        return 1 if divergent or failed else 0
+
+    @staticmethod
+    def _parse_tree(output):
+        """Find the tree printed by `scap tree-hash` in a host's output."""
+        for line in reversed(output.splitlines()):
+            try:
+                data = json.loads(line)
+            except ValueError:
+                continue
+            if isinstance(data, dict) and "tree" in data:
+                return data["tree"]
+        return None
+
+
+@cli.command("tree-hash", help=argparse.SUPPRESS)
+class TreeHash(cli.Application):
+    """Print the hash tree of the local deploy directory, for `scap audit`."""
+
+    @cli.argument("--depth", type=int, default=2, help="Levels of directories")
+    def main(self, *extra_args):
+        print(
+            json.dumps({"tree": tasks.tree_hashes(self.config, self.arguments.depth)})
+        )
+        return 0
 
 
 @cli.command("version", help="Show the version number and exit")
@@ -0,0 +1,341 @@
+# -*- coding: utf-8 -*-
+"""
+    scap.manifest
+    ~~~~~~~~~~~~~
+    Content manifests of deployment directories.
+
+    A manifest lists every file synced by :func:`scap.tasks.sync_common`
+    with its size, modification time and content hash. Comparing the
+    manifest published by the server with the one received on the previous
+    sync tells a target exactly which paths changed, without walking either
+    tree.
+
+    The hashes of a manifest also form a Merkle tree: each directory is
+    hashed from the names and hashes of its entries, so two copies of the
+    deployment directory are identical if their root hashes are, and the
+    subtrees whose hashes differ locate any divergence.
+
+    Copyright © 2014-2017 Wikimedia Foundation and Contributors.
+
+    This file is part of Scap.
+
+    Scap is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, version 3.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+from __future__ import absolute_import
+
+import errno
+import fnmatch
+import hashlib
+import json
+import os
+import stat
+import tempfile
+
+# Name of the manifest file, at the root of the directory it describes
+MANIFEST_NAME = ".scap-manifest"
+# Name of the file holding the top of the hash tree, next to the manifest
+TREE_NAME = ".scap-tree"
+# Directory of the bundles published by scap.tasks.build_bundle
+BUNDLE_DIR = ".scap-bundles"
+VERSION = 1
+
+# Paths never synced, see scap.tasks.DEFAULT_RSYNC_ARGS, the manifest files
+# themselves and bundles
+EXCLUDES = [
+    "*/cache/l10n/*.cdb",
+    "*.swp",
+    "*/.git",
+    "/" + MANIFEST_NAME,
+    "/" + TREE_NAME,
+    "/" + BUNDLE_DIR,
+]
+
+
+def excluded(path):
+    """
+    Whether the given path, relative to the manifest root, is left out.
+
+    >>> excluded('php-1.35.0-wmf.1/cache/l10n/l10n_cache-en.cdb')
+    True
+    >>> excluded('php-1.35.0-wmf.1/.git')
+    True
+    >>> excluded('wmf-config/CommonSettings.php')
+    False
+    """
+    path = "/" + path
+    return any(fnmatch.fnmatch(path, pattern) for pattern in EXCLUDES)
+
+
+def file_digest(path):
+    """SHA-1 of the content of the given file."""
+    digest = hashlib.sha1()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1048576), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def build(root, previous=None, paths=None):
+    """
+    Build the manifest of a directory tree.
+
+    Files whose size and modification time match their entry in the
+    ``previous`` manifest keep its hash instead of being read again.
+
+    :param root: Directory to describe
+    :param previous: Earlier manifest of the same directory
+    :param paths: Only describe these files and directories, relative to
+                  ``root``
+    :returns: dict mapping relative paths to (size, mtime, digest). The
+              digest of a symlink is its target prefixed with ``->``.
+    """
+    previous = previous or {}
+    manifest = {}
+
+    for top in paths or [""]:
+        top = top.strip("/")
+        path = os.path.join(root, top)
+        if top and (excluded(top) or not os.path.isdir(path) or os.path.islink(path)):
+            _add_entry(manifest, path, top, previous)
+            continue
+
+        for dirpath, dirnames, filenames in os.walk(path):
+            reldir = os.path.relpath(dirpath, root)
+            if reldir == ".":
+                reldir = ""
+
+            # Prune excluded directories and list symlinks to directories as
+            # files, like rsync --archive does
+            for name in list(dirnames):
+                relpath = os.path.join(reldir, name)
+                if excluded(relpath):
+                    dirnames.remove(name)
+                elif os.path.islink(os.path.join(dirpath, name)):
+                    dirnames.remove(name)
+                    filenames.append(name)
+
+            for name in filenames:
+                relpath = os.path.join(reldir, name)
+                _add_entry(manifest, os.path.join(dirpath, name), relpath, previous)
+
+    return manifest
+
+
+def _add_entry(manifest, path, relpath, previous):
+    if excluded(relpath):
+        return
+
+    try:
+        st = os.lstat(path)
+    except OSError as e:
+        # Removed while walking
+        if e.errno == errno.ENOENT:
+            return
+        raise
+
+    size, mtime = st.st_size, int(st.st_mtime)
+    if stat.S_ISLNK(st.st_mode):
+        digest = "->" + os.readlink(path)
+    elif not stat.S_ISREG(st.st_mode):
+        return
+    else:
+        known = previous.get(relpath)
+        if known is not None and tuple(known[:2]) == (size, mtime):
+            digest = known[2]
+        else:
+            digest = file_digest(path)
+
+    manifest[relpath] = (size, mtime, digest)
+
+
+def diff(old, new):
+    """
+    Compare two manifests.
+
+    >>> diff({'a': (1, 1, 'x'), 'b': (1, 1, 'y')}, {'a': (1, 2, 'x'), 'c': (1, 1, 'z')})
+    (['a', 'c'], ['b'])
+
+    :returns: tuple of sorted lists of the paths added or changed in ``new``,
+              and of the paths removed from ``old``
+    """
+    changed = [
+        path for path, entry in new.items() if tuple(old.get(path, ())) != tuple(entry)
+    ]
+    removed = [path for path in old if path not in new]
+    return sorted(changed), sorted(removed)
+
+
+def tree(files, depth=None):
+    """
+    Hash every directory of a manifest.
+
+    The hash of a directory covers the names and hashes of its files and
+    subdirectories, but not modification times, so it only depends on
+    content.
+
+    >>> hashes = tree({'a/b': (1, 1, 'x'), 'c': (1, 1, 'y')})
+    >>> sorted(hashes)
+    ['', 'a']
+    >>> hashes == tree({'a/b': (1, 2, 'x'), 'c': (1, 1, 'y')})
+    True
+    >>> sorted(tree({'a/b': (1, 1, 'x')}, depth=0))
+    ['']
+    >>> sorted(tree({'a/b/c': (1, 1, 'x')}))
+    ['', 'a', 'a/b']
+
+    :param files: Manifest, as returned by :func:`build`
+    :param depth: Only return directories up to this many levels below the
+                  root, which is at depth 0
+    :returns: dict mapping directories to their hash, the root being ``''``
+    """
+    entries = {"": []}
+    for path, (_, _, digest) in files.items():
+        parent, _, name = path.rpartition("/")
+        entries.setdefault(parent, []).append((name, digest))
+        while parent:
+            parent = parent.rpartition("/")[0]
+            if parent in entries:
+                break
+            entries[parent] = []
+
+    hashes = {}
+    # Hash subdirectories before their parent
+    for directory in sorted(entries, key=_depth, reverse=True):
+        hashes[directory] = _hash_entries(entries[directory])
+        if directory:
+            parent, _, name = directory.rpartition("/")
+            entries[parent].append((name + "/", hashes[directory]))
+
+    if depth is not None:
+        hashes = dict((d, h) for d, h in hashes.items() if _depth(d) <= depth)
+    return hashes
+
+
+def _depth(directory):
+    return directory.count("/") + 1 if directory else 0
+
+
+def _hash_entries(entries):
+    digest = hashlib.sha1()
+    for name, entry_digest in sorted(entries):
+        digest.update(("%s\0%s\n" % (name, entry_digest)).encode("utf-8"))
+    return digest.hexdigest()
+
+
+def divergent(expected, actual):
+    """
+    Directories of two hash trees containing differences.
+
+    Only the deepest differing directories are reported: a directory is
+    left out when the difference is already located in one of its
+    subdirectories.
+
+    >>> divergent({'': 'r1', 'a': 'x', 'b': 'y'}, {'': 'r2', 'a': 'x', 'b': 'z'})
+    ['b']
+    >>> divergent({'': 'r1', 'a': 'x'}, {'': 'r2', 'a': 'x'})
+    ['']
+    >>> divergent({'': 'r', 'a': 'x'}, {'': 'r', 'a': 'x'})
+    []
+    """
+    diffs = set(
+        d for d in set(expected) | set(actual) if expected.get(d) != actual.get(d)
+    )
+
+    located = set()
+    for directory in diffs:
+        while directory:
+            directory = directory.rpartition("/")[0]
+            located.add(directory)
+
+    return sorted(diffs - located)
+
+
+def load(path):
+    """
+    Read a manifest file.
+
+    :returns: manifest dict, or None if the file is missing or unusable
+    """
+    try:
+        with open(path) as f:
+            header = json.loads(f.readline())
+            if header.get("version") != VERSION:
+                return None
+
+            manifest = {}
+            for line in f:
+                relpath, size, mtime, digest = json.loads(line)
+                manifest[relpath] = (size, mtime, digest)
+            return manifest
+    except IOError as e:
+        if e.errno == errno.ENOENT:
+            return None
+        raise
+    except (ValueError, TypeError, AttributeError):
+        return None
+
+
+def save(manifest, path):
+    """
+    Atomically write a manifest file.
+
+    Entries are written one per line, sorted by path, so that rsync only
+    needs to transfer the lines that changed between two versions.
+    """
+    lines = [json.dumps({"version": VERSION})]
+    for relpath in sorted(manifest):
+        size, mtime, digest = manifest[relpath]
+        lines.append(json.dumps([relpath, size, mtime, digest]))
+    _write(path, lines)
+
+
+def load_tree(path):
+    """
+    Read a hash tree file.
+
+    :returns: dict mapping directories to their hash, or None if the file is
+              missing or unusable
+    """
+    try:
+        with open(path) as f:
+            data = json.load(f)
+    except IOError as e:
+        if e.errno == errno.ENOENT:
+            return None
+        raise
+    except ValueError:
+        return None
+
+    if not isinstance(data, dict) or data.get("version") != VERSION:
+        return None
+    return data.get("tree")
+
+
+def save_tree(hashes, path):
+    """Atomically write a hash tree file."""
+    _write(path, [json.dumps({"version": VERSION, "tree": hashes}, sort_keys=True)])
+
+
+def _write(path, lines):
+    fd, tmp = tempfile.mkstemp(
+        dir=os.path.dirname(os.path.abspath(path)), prefix=".scap-"
+    )
+    try:
+        with os.fdopen(fd, "w") as f:
+            for line in lines:
+                f.write(line + "\n")
+        os.chmod(tmp, 0o644)
+        os.rename(tmp, path)
+    except BaseException:
+        os.unlink(tmp)
+        raise
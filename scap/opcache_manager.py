@@ -14,6 +14,15 @@ class OpcacheManager(object):
         self.threadpool = ThreadPoolExecutor(max_workers=10)
 
     def _invalidate_host(self, host, filename):
+        if isinstance(filename, list):
+            # Invalidate files one after the other, stopping at the first
+            # failure
+            for name in filename:
+                result = self._invalidate_host(host, name)
+                if not result[0]:
+                    return result
+            return (True, None)
+
         url = "http://{hostname}:{port}/opcache-free".format(
             hostname=host, port=self.admin_port
         )
@@ -33,7 +42,12 @@ class OpcacheManager(object):
             return (False, str(e))
 
     def invalidate(self, hosts, filename):
-        """Invalidates files/directories (or all) opcache."""
+        """
+        Invalidates files/directories (or all) opcache.
+
+        :param filename: File/directory, or list of files/directories, to
+                         invalidate. All opcache is invalidated if None.
+        """
 
         def invalidate_closure(host):
             return (host, self._invalidate_host(host, filename))
@@ -0,0 +1,377 @@
+# -*- coding: utf-8 -*-
+"""
+    scap.schedule
+    ~~~~~~~~~~~~~
+    Strategies deciding in which order :class:`scap.ssh.Job` reaches its
+    target hosts.
+
+    Copyright © 2014-2017 Wikimedia Foundation and Contributors.
+
+    This file is part of Scap.
+
+    Scap is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, version 3.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+from __future__ import absolute_import
+
+import bisect
+import collections
+import errno
+import hashlib
+import json
+import os
+import random
+import tempfile
+
+from scap import utils
+
+SHUFFLE = "shuffle"
+INTERLEAVE = "interleave"
+LONGEST_FIRST = "longest-first"
+STRATEGIES = [SHUFFLE, INTERLEAVE, LONGEST_FIRST]
+
+
+class Strategy(object):
+    """Keep hosts in the order they were given."""
+
+    def order(self, hosts):
+        """
+        Order hosts for dispatch.
+
+        :param hosts: list of hosts
+        :returns: list of hosts, first to be dispatched first
+        """
+        return list(hosts)
+
+    def record(self, host, duration, status):
+        """Account for a host that completed in ``duration`` seconds."""
+        pass
+
+    def save(self):
+        """Persist whatever was learned from the job."""
+        pass
+
+
+class Shuffle(Strategy):
+    """Dispatch hosts in random order."""
+
+    def __init__(self, seed=None):
+        self._random = random.Random(seed)
+
+    def order(self, hosts):
+        hosts = list(hosts)
+        self._random.shuffle(hosts)
+        return hosts
+
+
+def locality(host):
+    """
+    Location of a host as derived from its name.
+
+    >>> locality('mw1234.eqiad.wmnet')
+    'eqiad.wmnet'
+    >>> locality('localhost')
+    ''
+    """
+    return host.partition(".")[2]
+
+
+class Interleave(Strategy):
+    """
+    Spread hosts of each location evenly across the dispatch order.
+
+    Consecutive hosts are then as far apart as possible, so concurrent
+    connections are shared between datacenters and racks instead of hitting
+    one of them at a time.
+
+    :param locations: Dict mapping hosts to their location (e.g.
+                      ``eqiad/A4``). Other hosts are located by their domain.
+    """
+
+    def __init__(self, locations=None, seed=None):
+        self._locations = locations or {}
+        self._random = random.Random(seed)
+
+    def location(self, host):
+        """Location of the given host."""
+        return self._locations.get(host) or locality(host)
+
+    def order(self, hosts):
+        groups = {}
+        for host in hosts:
+            groups.setdefault(self.location(host), []).append(host)
+
+        ranked = []
+        for group in groups.values():
+            self._random.shuffle(group)
+            for i, host in enumerate(group):
+                # Position of the host within its group, from 0 to 1
+                ranked.append(((i + 0.5) / len(group), host))
+
+        ranked.sort()
+        return [host for _, host in ranked]
+
+
+class LongestFirst(Strategy):
+    """
+    Dispatch the hosts that took longest on previous runs first.
+
+    Durations are kept in a JSON file as an exponentially weighted moving
+    average per host. Hosts without history are assumed to be slow and go
+    first.
+
+    :param path: Path of the history file
+    :param weight: Weight of the latest duration in the moving average
+    """
+
+    @utils.log_context("schedule.longest_first")
+    def __init__(self, path, weight=0.5, logger=None):
+        self.path = path
+        self.weight = weight
+        self.durations = {}
+        self._logger = logger
+
+        try:
+            with open(path) as f:
+                self.durations = json.load(f)
+        except IOError as e:
+            if e.errno != errno.ENOENT:
+                logger.warning("Cannot read host durations: %s", e)
+        except ValueError as e:
+            logger.warning("Ignoring corrupt host durations in %s: %s", path, e)
+
+    def order(self, hosts):
+        unknown = float("inf")
+        return sorted(hosts, key=lambda h: self.durations.get(h, unknown), reverse=True)
+
+    def record(self, host, duration, status):
+        if status != 0:
+            return
+
+        previous = self.durations.get(host)
+        if previous is not None:
+            duration = self.weight * duration + (1 - self.weight) * previous
+        self.durations[host] = duration
+
+    def save(self):
+        """Atomically replace the history file."""
+        directory = os.path.dirname(self.path)
+        try:
+            if not os.path.isdir(directory):
+                os.makedirs(directory)
+
+            fd, tmp = tempfile.mkstemp(dir=directory, prefix=".durations-")
+            with os.fdopen(fd, "w") as f:
+                json.dump(self.durations, f, sort_keys=True)
+            os.rename(tmp, self.path)
+        except (IOError, OSError) as e:
+            self._logger.warning("Cannot save host durations: %s", e)
+
+
+def load_host_map(path):
+    """
+    Read a JSON file mapping hosts to a value, such as their location.
+
+    :param path: Path to the file, or None
+    :returns: dict mapping hosts to their value
+    """
+    if not path:
+        return {}
+    with open(path) as f:
+        return json.load(f)
+
+
+def distribution_tree(sources, hosts, width, locations=None):
+    """
+    Arrange hosts into a tree along which files are distributed.
+
+    Hosts are attached level by level: each host of a level, starting with
+    the sources, serves up to ``width`` hosts of the next level, preferably
+    in its own location. The number of hosts serving others thus grows with
+    each level instead of being limited to the sources.
+
+    >>> levels = distribution_tree(['proxy1'], ['a', 'b', 'c', 'd', 'e'], 2)
+    >>> [sorted(level.items()) for level in levels]
+    [[('a', 'proxy1'), ('b', 'proxy1')], [('c', 'a'), ('d', 'a'), ('e', 'b')]]
+
+    :param sources: Hosts already holding the files
+    :param hosts: Hosts to distribute the files to
+    :param width: Maximum number of hosts served by each host
+    :param locations: Dict mapping hosts to their location (e.g.
+                      ``eqiad/A4``). Other hosts are located by their domain.
+    :returns: list of levels, each an OrderedDict mapping hosts to the host
+              they are served by
+    :raises: ValueError if width is lower than 1
+    """
+    if width < 1:
+        raise ValueError("Distribution tree width must be at least 1")
+
+    locate = Interleave(locations).location
+    parents = list(sources)
+    remaining = [h for h in collections.OrderedDict.fromkeys(hosts) if h not in parents]
+    levels = []
+
+    while remaining and parents:
+        level = collections.OrderedDict()
+        slots = dict((parent, width) for parent in parents)
+
+        by_location = {}
+        for host in remaining:
+            by_location.setdefault(locate(host), collections.deque()).append(host)
+
+        # Serve hosts of the same location first
+        for parent in parents:
+            group = by_location.get(locate(parent))
+            while group and slots[parent]:
+                level[group.popleft()] = parent
+                slots[parent] -= 1
+
+        # Spread the others over the free slots, one per parent at a time
+        free = [
+            parent
+            for slot in range(width)
+            for parent in parents
+            if slots[parent] > slot
+        ]
+        others = [host for host in remaining if host not in level]
+        for host, parent in zip(others, free):
+            level[host] = parent
+
+        levels.append(level)
+        remaining = [host for host in remaining if host not in level]
+        parents = list(level)
+
+    return levels
+
+
+def _ring_position(key):
+    return int(hashlib.md5(key.encode("utf-8")).hexdigest()[:8], 16)
+
+
+class ProxyRing(object):
+    """
+    Consistent hash ring of proxies, weighted by their capacity.
+
+    A host maps to the same proxies from one run to the next, and adding or
+    removing a proxy only moves the hosts it gains or loses.
+
+    >>> ring = ProxyRing(['proxy1', 'proxy2', 'proxy3'])
+    >>> ring.lookup('mw1', 2) == ring.lookup('mw1', 2)
+    True
+    >>> len(set(ring.lookup('mw1', 5)))
+    3
+
+    :param proxies: list of proxies
+    :param capacities: dict mapping proxies to their relative capacity,
+                       defaulting to 1. A proxy with a capacity of 2 gets
+                       about twice as many hosts as one with a capacity of 1.
+    :param replicas: Points of the ring per unit of capacity
+    """
+
+    def __init__(self, proxies, capacities=None, replicas=100):
+        capacities = capacities or {}
+        ring = []
+        for proxy in proxies:
+            points = max(1, int(round(replicas * capacities.get(proxy, 1))))
+            for i in range(points):
+                ring.append((_ring_position("%s-%d" % (proxy, i)), proxy))
+        ring.sort()
+
+        self._positions = [position for position, _ in ring]
+        self._proxies = [proxy for _, proxy in ring]
+        self._count = len(set(self._proxies))
+
+    def lookup(self, host, count=1):
+        """
+        Proxies serving the given host, by order of preference.
+
+        :param count: Number of distinct proxies to return, at most
+        """
+        found = []
+        start = bisect.bisect(self._positions, _ring_position(host))
+        for i in range(len(self._proxies)):
+            if len(found) >= min(count, self._count):
+                break
+            proxy = self._proxies[(start + i) % len(self._proxies)]
+            if proxy not in found:
+                found.append(proxy)
+        return found
+
+
+def assign_proxies(hosts, proxies, capacities=None, locations=None, fallbacks=2):
+    """
+    Assign hosts to proxies by consistent hashing.
+
+    Hosts are assigned proxies of their own location first, then proxies of
+    any location as fallbacks.
+
+    >>> assignment = assign_proxies(
+    ...     ['mw1.codfw.wmnet'], ['p1.eqiad.wmnet', 'p2.codfw.wmnet'], fallbacks=1)
+    >>> assignment['mw1.codfw.wmnet']
+    ['p2.codfw.wmnet', 'p1.eqiad.wmnet']
+
+    :param hosts: Hosts to assign
+    :param proxies: Proxies to assign hosts to
+    :param capacities: dict mapping proxies to their relative capacity
+    :param locations: dict mapping hosts and proxies to their location. Other
+                      hosts are located by their domain.
+    :param fallbacks: Number of fallback proxies per host
+    :returns: OrderedDict mapping hosts to a list of proxies, the first one
+              being their assigned proxy
+    """
+    locate = Interleave(locations).location
+    local_proxies = {}
+    for proxy in proxies:
+        local_proxies.setdefault(locate(proxy), []).append(proxy)
+
+    rings = dict(
+        (location, ProxyRing(members, capacities))
+        for location, members in local_proxies.items()
+    )
+    everywhere = ProxyRing(proxies, capacities)
+
+    assignment = collections.OrderedDict()
+    for host in hosts:
+        local = rings.get(locate(host))
+        servers = local.lookup(host, fallbacks + 1) if local else []
+        for proxy in everywhere.lookup(host, fallbacks + 1):
+            if len(servers) > fallbacks:
+                break
+            if proxy not in servers:
+                servers.append(proxy)
+        assignment[host] = servers
+
+    return assignment
+
+
+def get(name, log_dir, strategy=SHUFFLE, locations=None):
+    """
+    Strategy for the given job.
+
+    :param name: Job name, used to keep a separate history per job
+    :param log_dir: Directory in which to keep host durations
+    :param strategy: One of :data:`STRATEGIES`
+    :param locations: Path to a JSON file mapping hosts to their location
+    :raises: ValueError for unknown strategies
+    """
+    if strategy == SHUFFLE:
+        return Shuffle()
+
+    if strategy == INTERLEAVE:
+        return Interleave(load_host_map(locations))
+
+    if strategy == LONGEST_FIRST:
+        return LongestFirst(os.path.join(log_dir, "durations", name + ".json"))
+
+    raise ValueError(
+        "Unknown schedule '%s', expected one of %s" % (strategy, ", ".join(STRATEGIES))
+    )
@@ -23,13 +23,25 @@
 """
 from __future__ import absolute_import
 
+import bisect
+import collections
 import errno
+import fcntl
+import functools
+import hashlib
+import heapq
+import json
 import os
 import random
 import select
 import shlex
-import socket
+import shutil
+import signal
 import subprocess
+import tempfile
+import time
+
+import six
 
 import scap.log as log
 import scap.utils as utils
@@ -37,6 +49,12 @@ import scap.cmd as cmd
 
 CONNECTION_FAILURE = 255
 DEFAULT_BATCH_SIZE = 80
+DEFAULT_OUTPUT_LIMIT = 256 * 1024
+DEFAULT_BACKOFF = 1.0
+# Status reported for hosts killed after reaching their deadline, as timeout(1)
+TIMEOUT = 124
+# How often running hosts are checked against their deadlines
+_CHECK_INTERVAL = 0.1
 SSH = cmd.Command(
     "/usr/bin/ssh",
     "-oBatchMode=yes",
@@ -44,6 +62,9 @@ SSH = cmd.Command(
     cmd.arg("verbose", "-v"),
     "-F/dev/null",
     cmd.arg("user", "-oUser={}"),
+    cmd.arg("control_master", "-oControlMaster={}"),
+    cmd.arg("control_path", "-oControlPath={}"),
+    cmd.arg("control_persist", "-oControlPersist={}"),
 )
 SSH_WITH_KEY = cmd.Command(
     "/usr/bin/ssh",
@@ -54,24 +75,358 @@ SSH_WITH_KEY = cmd.Command(
     cmd.arg("verbose", "-v"),
     cmd.arg("user", "-oUser={}"),
     cmd.arg("key", "-oIdentityFile={}"),
+    cmd.arg("control_master", "-oControlMaster={}"),
+    cmd.arg("control_path", "-oControlPath={}"),
+    cmd.arg("control_persist", "-oControlPersist={}"),
+)
+SSH_CONTROL = cmd.Command(
+    "/usr/bin/ssh",
+    "-F/dev/null",
+    cmd.arg("control_path", "-oControlPath={}"),
+    cmd.arg("operation", "-O{}"),
 )
 
 
+class Transport(object):
+    """
+    Means of running a command on a target host.
+
+    :func:`cluster_ssh` spawns the command line returned by :meth:`command`
+    for each host and reports its output and exit status as the host's.
+    """
+
+    def command(self, host, command, user=None, key=None, verbose=False, **options):
+        """
+        Build the command line that runs ``command`` on ``host``.
+
+        :param options: Connection options, such as those provided by
+                        :meth:`ConnectionPool.options`
+        :returns: list of arguments
+        """
+        raise NotImplementedError()
+
+
+class SSHTransport(Transport):
+    """Run commands on target hosts over SSH."""
+
+    def command(self, host, command, user=None, key=None, verbose=False, **options):
+        if key:
+            return SSH_WITH_KEY(
+                host, command, user=user, key=key, verbose=verbose, **options
+            )
+        return SSH(host, command, user=user, verbose=verbose, **options)
+
+
+class LocalTransport(Transport):
+    """
+    Simulate target hosts with local processes.
+
+    Instead of running the command, each host sleeps for ``latency`` seconds
+    (give or take ``jitter``), writes ``output`` bytes and exits with
+    ``failure_status`` with probability ``failure_rate``, or 0 otherwise.
+
+    Meant for exercising and benchmarking :func:`cluster_ssh` without a
+    fleet.
+    """
+
+    def __init__(
+        self,
+        latency=0.0,
+        jitter=0.0,
+        output=0,
+        failure_rate=0.0,
+        failure_status=1,
+        seed=None,
+    ):
+        self.latency = latency
+        self.jitter = jitter
+        self.output = output
+        self.failure_rate = failure_rate
+        self.failure_status = failure_status
+        self._random = random.Random(seed)
+
+    def command(self, host, command, user=None, key=None, verbose=False, **options):
+        script = []
+
+        latency = self.latency
+        if self.jitter:
+            latency += self._random.uniform(-self.jitter, self.jitter)
+        if latency > 0:
+            script.append("sleep %.3f" % latency)
+
+        if self.output:
+            script.append("head -c %d /dev/zero | tr '\\0' x" % self.output)
+
+        status = 0
+        if self._random.random() < self.failure_rate:
+            status = self.failure_status
+        script.append("exit %d" % status)
+
+        return ["/bin/sh", "-c", "; ".join(script)]
+
+
+# Prefix of the lines reporting the result of a pipeline step
+STEP_MARKER = "@@scap-step@@ "
+
+StepResult = collections.namedtuple("StepResult", ["name", "status", "duration"])
+
+
+def pipeline_command(steps, stop_on_failure=True):
+    """
+    Build a remote command running several steps in one session.
+
+    After each step, the remote shell reports the index, exit status and
+    duration in milliseconds of the step on a :data:`STEP_MARKER` line, which
+    :class:`StepOutputHandler` turns into :class:`StepResult` objects.
+
+    :param steps: list of (name, command) tuples. Commands are either shell
+                  strings or lists of arguments.
+    :param stop_on_failure: Skip the remaining steps once one fails
+    :returns: list holding the remote shell script. It exits with the status
+              of the first failed step.
+    """
+    script = ["scap_status=0"]
+    for index, (_, command) in enumerate(steps):
+        if not isinstance(command, six.string_types):
+            command = " ".join(six.moves.shlex_quote(arg) for arg in command)
+
+        script.append("scap_start=$(date +%s%N)")
+        script.append("(%s)" % command)
+        script.append("scap_rc=$?")
+        script.append(
+            'echo "%s%d $scap_rc $(( ($(date +%%s%%N) - scap_start) / 1000000 ))"'
+            % (STEP_MARKER, index)
+        )
+        script.append('[ "$scap_status" -ne 0 ] || scap_status=$scap_rc')
+        if stop_on_failure:
+            script.append('[ "$scap_status" -eq 0 ] || exit "$scap_status"')
+
+    script.append('exit "$scap_status"')
+    return ["; ".join(script)]
+
+
+# Connection pool shared by every job of the running scap command, if enabled
+CONNECTION_POOL = None
+
+# Sink recording the results of every job of the running scap command
+RESULT_SINK = None
+
+
+class ConnectionPool(object):
+    """
+    Multiplexed SSH master connections shared across jobs.
+
+    The first connection to a host becomes a persistent master
+    (``ControlMaster=auto`` with ``ControlPersist``) and every later job
+    targeting the same host and user reuses it instead of performing another
+    handshake. Control sockets live in a private temporary directory that is
+    removed by :meth:`close`.
+    """
+
+    def __init__(self, persist=600):
+        """
+        :param persist: Seconds an idle master connection is kept open
+        """
+        self.persist = persist
+        self.hits = 0
+        self.misses = 0
+        self._dir = None
+        self._masters = {}
+
+    def options(self, host, user=None):
+        """
+        Get the keyword arguments enabling multiplexing for the given host.
+
+        Counts a hit when a master connection for the host already exists.
+
+        :returns: dict of arguments for :data:`SSH` or :data:`SSH_WITH_KEY`
+        """
+        if self._dir is None:
+            self._dir = tempfile.mkdtemp(prefix="scap-ssh-")
+
+        # Control socket paths are limited to ~100 bytes so don't use the
+        # host name directly
+        name = hashlib.sha1(("%s@%s" % (user, host)).encode("utf-8")).hexdigest()
+        path = os.path.join(self._dir, name[:16])
+
+        if os.path.exists(path):
+            self.hits += 1
+        else:
+            self.misses += 1
+        self._masters[path] = host
+
+        return {
+            "control_master": "auto",
+            "control_path": path,
+            "control_persist": str(self.persist),
+        }
+
+    def close(self):
+        """Ask every master connection to exit and remove the socket dir."""
+        if self._dir is None:
+            return
+
+        with open(os.devnull, "w") as devnull:
+            for path, host in self._masters.items():
+                if not os.path.exists(path):
+                    continue
+                subprocess.call(
+                    SSH_CONTROL(host, control_path=path, operation="exit"),
+                    stdout=devnull,
+                    stderr=devnull,
+                )
+
+        shutil.rmtree(self._dir, ignore_errors=True)
+        self._dir = None
+        self._masters = {}
+
+
+class OutputBuffer(object):
+    """
+    Bounded capture of a byte stream.
+
+    Keeps the first and the last ``limit / 2`` bytes written and counts what
+    was dropped in between, so memory per host stays constant no matter how
+    chatty the remote command is.
+    """
+
+    def __init__(self, limit=DEFAULT_OUTPUT_LIMIT):
+        """
+        :param limit: Maximum number of bytes to keep
+        """
+        self.head_limit = limit // 2
+        self.tail_limit = limit - self.head_limit
+        self.dropped = 0
+        self._head = bytearray()
+        self._tail = bytearray()
+
+    def write(self, data):
+        """Append data to the buffer."""
+        view = memoryview(data)
+        room = self.head_limit - len(self._head)
+        if room > 0:
+            self._head += view[:room]
+            view = view[room:]
+
+        if not len(view):
+            return
+
+        self._tail += view
+
+        # Trim only once the tail has doubled so the cost stays amortized
+        # linear in the number of bytes written
+        excess = len(self._tail) - self.tail_limit
+        if excess > self.tail_limit:
+            del self._tail[:excess]
+            self.dropped += excess
+
+    def __len__(self):
+        return len(self._head) + min(len(self._tail), self.tail_limit)
+
+    def getvalue(self):
+        """Get the retained bytes, marking where output was dropped."""
+        excess = max(len(self._tail) - self.tail_limit, 0)
+        dropped = self.dropped + excess
+        parts = [bytes(self._head)]
+        if dropped:
+            parts.append(("\n[... %d bytes omitted ...]\n" % dropped).encode("ascii"))
+        parts.append(bytes(self._tail[excess:]))
+        return b"".join(parts)
+
+
+def _native(data):
+    """Convert bytes read from a pipe to the native str type."""
+    if isinstance(data, str):
+        return data
+    return data.decode("utf-8", "replace")
+
+
+def _bytes(text):
+    """Convert text to bytes suitable for an :class:`OutputBuffer`."""
+    if isinstance(text, bytes):
+        return text
+    return text.encode("utf-8", "replace")
+
+
 class OutputHandler(object):
     """
     Standard handler for SSH command output from hosts.
 
-    Simply stores output as a string for future handling.
+    Stores a bounded amount of output for future handling and optionally
+    spills the complete output to ``<spill_dir>/<host>.log``.
     """
 
     host = None
-    output = ""
+    spill_path = None
+    # Seconds the host took to complete, set once it has exited
+    duration = None
 
-    def __init__(self, host):
+    def __init__(self, host, limit=DEFAULT_OUTPUT_LIMIT, spill_dir=None):
+        """
+        :param host: Host producing the output
+        :param limit: Maximum number of output bytes to keep in memory
+        :param spill_dir: Directory in which to save the complete output
+        """
         self.host = host
+        self._spill = None
+        if spill_dir is not None:
+            utils.mkdir_p(spill_dir)
+            self.spill_path = os.path.join(spill_dir, "%s.log" % host)
+            self._spill = open(self.spill_path, "wb")
+        self._buffer = OutputBuffer(limit)
+        self._partial = bytearray()
+        self._digest = hashlib.sha1()
+        self.size = 0
+
+    @property
+    def output(self):
+        return _native(self._buffer.getvalue())
+
+    @property
+    def digest(self):
+        """SHA-1 of the complete output."""
+        return self._digest.hexdigest()
 
     def accept(self, output):
-        self.output += output
+        self._account(output)
+        self._buffer.write(output)
+
+    def _account(self, output):
+        """Spill and hash raw output before it is processed."""
+        if self._spill is not None:
+            self._spill.write(output)
+        self._digest.update(output)
+        self.size += len(output)
+
+    def close(self):
+        """Close the spill file, if any."""
+        if self._spill is not None:
+            self._spill.close()
+            self._spill = None
+
+    def lines(self, output):
+        """
+        Split the given output into complete lines.
+
+        Reconstructs partial lines using the leftovers from previous calls.
+        Each byte is scanned once, so the cost is linear in the output size.
+
+        :returns: list of lines without their trailing newline
+        """
+        partial = self._partial
+        partial += _bytes(output)
+
+        lines = []
+        start = 0
+        while True:
+            pos = partial.find(b"\n", start)
+            if pos < 0:
+                break
+            lines.append(_native(bytes(partial[start:pos])))
+            start = pos + 1
+
+        del partial[:start]
+        return lines
 
 
 class JSONOutputHandler(OutputHandler):
@@ -81,10 +436,9 @@ class JSONOutputHandler(OutputHandler):
     Any non-structured output is stored for future handling.
     """
 
-    def __init__(self, host):
-        super(JSONOutputHandler, self).__init__(host)
+    def __init__(self, host, limit=DEFAULT_OUTPUT_LIMIT, spill_dir=None):
+        super(JSONOutputHandler, self).__init__(host, limit, spill_dir)
         self._logger = utils.get_logger().getChild("target").getChild(host)
-        self._partial = ""
 
     def accept(self, output):
         """
@@ -92,12 +446,14 @@ class JSONOutputHandler(OutputHandler):
 
         Any non-JSON is stored in self.output.
         """
+        self._account(output)
+
         for line in self.lines(output):
             if line.startswith("{"):
                 try:
                     record = log.JSONFormatter.make_record(line)
                 except (ValueError, TypeError):
-                    self.output += line + "\n"
+                    self._buffer.write(_bytes(line + "\n"))
                     record = None
 
                 if record is not None:
@@ -111,25 +467,318 @@ class JSONOutputHandler(OutputHandler):
                     self._logger.handle(record)
 
                     # store the output in case of error
-                    self.output += record.getMessage() + "\n"
+                    self._buffer.write(_bytes(record.getMessage() + "\n"))
             else:
-                self.output += line + "\n"
+                self._buffer.write(_bytes(line + "\n"))
 
-    def lines(self, output):
+
+class StepOutputHandler(OutputHandler):
+    """
+    Collect the status of each step of a pipeline run by :class:`Job`.
+
+    Step results are reported by the remote shell on marker lines, which are
+    removed from the output and stored in :attr:`steps`.
+    """
+
+    def __init__(self, host, limit=DEFAULT_OUTPUT_LIMIT, spill_dir=None, names=None):
         """
-        Generate each line of the given output.
+        :param names: Names of the pipeline steps, in order
+        """
+        super(StepOutputHandler, self).__init__(host, limit, spill_dir)
+        self.names = names or []
+        self.steps = []
 
-        Reconstructs partial lines using the leftovers from previous calls.
+    def accept(self, output):
+        self._account(output)
+
+        for line in self.lines(output):
+            text, marker, result = line.partition(STEP_MARKER)
+            if text or not marker:
+                self._buffer.write(_bytes(text + "\n"))
+            if marker:
+                self._add_step(result)
+
+    def _add_step(self, result):
+        try:
+            index, status, duration = [int(field) for field in result.split()]
+            name = self.names[index]
+        except (ValueError, IndexError):
+            self._buffer.write(_bytes(STEP_MARKER + result + "\n"))
+            return
+
+        self.steps.append(StepResult(name, status, duration / 1000.0))
+
+
+class ResultSink(object):
+    """
+    Append the result of every host to a JSON lines file.
+
+    Records are written as soon as hosts complete, so operators can inspect
+    results without keeping them in memory or flooding the console. Each
+    record holds the run and job names, the host, its exit status, how long
+    it took and the size and SHA-1 digest of its output. Records of failed
+    hosts also hold the (bounded) output.
+
+    The file is only created once the first record is written. If it cannot
+    be written to, results are dropped and :meth:`record` returns False so
+    that callers can report them otherwise. A file that grew past
+    ``max_size`` is rotated to ``<path>.1`` before the first record of a run,
+    so that the records of a run are never split between files.
+    """
+
+    @utils.log_context("ssh.result_sink")
+    def __init__(self, path, run=None, max_size=None, logger=None):
         """
-        while True:
-            pos = output.find("\n")
-            if pos < 0:
-                self._partial += output
-                break
+        :param path: Path of the file records are appended to
+        :param run: Identifier of the scap run, defaults to the current time
+                    and process id
+        :param max_size: Size in bytes past which the file is rotated
+        """
+        self.path = path
+        self.run = run or "%s-%d" % (time.strftime("%Y%m%dT%H%M%S"), os.getpid())
+        self.max_size = max_size
+        self._file = None
+        self._disabled = False
+        self._logger = logger
+
+    def record(self, job, host, status, ohandler):
+        """
+        Append the result of ``host`` for the given job.
+
+        :returns: whether the result was written
+        """
+        if self._disabled:
+            return False
+
+        entry = {
+            "run": self.run,
+            "job": job,
+            "host": host,
+            "status": status,
+            "duration": ohandler.duration,
+            "bytes": ohandler.size,
+            "digest": ohandler.digest,
+            "time": time.time(),
+        }
+        if status != 0:
+            entry["output"] = ohandler.output
+
+        try:
+            if self._file is None:
+                utils.mkdir_p(os.path.dirname(self.path))
+                self._rotate()
+                self._file = open(self.path, "a")
+            self._file.write(json.dumps(entry, sort_keys=True) + "\n")
+            self._file.flush()
+        except (IOError, OSError) as e:
+            self._disabled = True
+            self._logger.debug("Not recording job results to %s: %s", self.path, e)
+            return False
+        return True
+
+    def _rotate(self):
+        if not self.max_size:
+            return
+        try:
+            if os.path.getsize(self.path) > self.max_size:
+                os.rename(self.path, self.path + ".1")
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+
+    def close(self):
+        """Close the results file."""
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+
+def read_results(path):
+    """
+    Read the records written by :class:`ResultSink`, including those of the
+    rotated file.
+
+    Lines that cannot be parsed, such as a record cut short by a crash, are
+    skipped.
+
+    :yields: dict for each record, oldest first
+    """
+    for name in (path + ".1", path):
+        try:
+            f = open(name)
+        except IOError as e:
+            if e.errno == errno.ENOENT:
+                continue
+            raise
+
+        with f:
+            for line in f:
+                try:
+                    yield json.loads(line)
+                except ValueError:
+                    continue
+
+
+class StragglerPolicy(object):
+    """
+    Spot hosts that take much longer than the rest of the job.
+
+    A host becomes a straggler once it has been running for more than
+    ``factor`` times the median completion time of the hosts that finished
+    before it. The median is only trusted after ``min_samples`` hosts.
+
+    With ``kill``, stragglers are killed and retried as long as the job has
+    retries left.
+    """
+
+    @utils.log_context("ssh.straggler")
+    def __init__(self, factor=3.0, min_samples=10, kill=False, logger=None):
+        self.factor = factor
+        self.min_samples = max(min_samples, 1)
+        self.kill = kill
+        self.stragglers = []
+        self._durations = []
+        self._logger = logger
+
+    def record(self, duration):
+        """Account for a host that completed in ``duration`` seconds."""
+        bisect.insort(self._durations, duration)
+
+    def median(self):
+        """Median completion time, or None before ``min_samples`` hosts."""
+        if len(self._durations) < self.min_samples:
+            return None
+        return self._durations[len(self._durations) // 2]
+
+    def threshold(self):
+        """Running time past which a host is a straggler, or None."""
+        median = self.median()
+        if median is None:
+            return None
+        return self.factor * median
+
+    def flag(self, host, elapsed):
+        """Report a straggling host."""
+        self.stragglers.append(host)
+        self._logger.warning(
+            "%s is straggling: running for %.1fs, median completion is %.1fs",
+            host,
+            elapsed,
+            self.median(),
+        )
+
+
+class AdaptiveConcurrency(object):
+    """
+    Size the window of concurrent connections from observed latency.
+
+    Completions are grouped in rounds of ``limit`` hosts. Starting from
+    ``initial``, the window doubles after every round whose mean per-host
+    latency stays within ``tolerance`` times the best round seen so far.
+    After the first slowdown it grows by ``increase`` per round instead. A
+    round that gets slower than that, or in which hosts fail to connect,
+    shrinks the window by ``decrease``.
+
+    The window never exceeds ``ceiling``, the static batch size the job
+    would otherwise use, nor drops below ``floor``.
+    """
+
+    def __init__(
+        self,
+        ceiling,
+        initial=None,
+        floor=1,
+        increase=None,
+        decrease=0.5,
+        tolerance=1.5,
+        name="ssh",
+        stats=None,
+        logger=None,
+    ):
+        self.ceiling = max(ceiling, 1)
+        self.floor = min(max(floor, 1), self.ceiling)
+        if initial is None:
+            initial = self.ceiling // 8
+        self.limit = min(max(initial, self.floor), self.ceiling)
+        self.increase = increase or max(self.ceiling // 16, 1)
+        self.decrease = decrease
+        self.tolerance = tolerance
+        self.baseline = None
+        self.name = name
+        self._stats = stats
+        self._logger = logger
+        self._slow_start = True
+        self._round_start = time.time()
+        self._durations = []
+        self._failures = 0
+
+    def record(self, started, duration, status):
+        """
+        Account for a finished host.
+
+        Hosts started before the last adjustment are ignored since they
+        reflect the previous window.
 
-            yield self._partial + output[0:pos]
-            output = output[pos + 1 :]
-            self._partial = ""
+        :param started: Time the connection to the host was started
+        :param duration: Seconds it took for the host to complete
+        :param status: Exit status of the ssh command
+        """
+        if started < self._round_start:
+            return
+
+        self._durations.append(duration)
+        if status == CONNECTION_FAILURE:
+            self._failures += 1
+
+        if len(self._durations) >= self.limit:
+            self._adjust()
+
+    def _adjust(self):
+        latency = sum(self._durations) / len(self._durations)
+        if self.baseline is None or latency < self.baseline:
+            self.baseline = latency
+
+        previous = self.limit
+        if self._failures:
+            reason = "%d connection failure(s)" % self._failures
+            self._shrink()
+        elif latency > self.baseline * self.tolerance:
+            reason = "latency increase"
+            self._shrink()
+        elif self._slow_start:
+            reason = "slow start"
+            self.limit = min(self.limit * 2, self.ceiling)
+        else:
+            reason = "stable latency"
+            self.limit = min(self.limit + self.increase, self.ceiling)
+
+        if self._logger is not None:
+            self._logger.debug(
+                "%s concurrency %d -> %d (%s, latency %.3fs, baseline %.3fs)",
+                self.name,
+                previous,
+                self.limit,
+                reason,
+                latency,
+                self.baseline,
+            )
+
+        if self._stats is not None:
+            metric = "scap.concurrency.%s" % self.name
+            self._stats.gauge(metric, self.limit)
+            self._stats.timing(metric + ".latency", latency * 1000)
+            if self.limit < previous:
+                self._stats.increment(metric + ".decrease")
+            elif self.limit > previous:
+                self._stats.increment(metric + ".increase")
+
+        self._round_start = time.time()
+        self._durations = []
+        self._failures = 0
+
+    def _shrink(self):
+        self._slow_start = False
+        self.limit = max(int(self.limit * self.decrease), self.floor)
 
 
 class Job(object):
@@ -137,7 +786,15 @@ class Job(object):
 
     @utils.log_context("ssh.job")
     def __init__(
-        self, hosts=None, command=None, user=None, logger=None, key=None, verbose=False
+        self,
+        hosts=None,
+        command=None,
+        user=None,
+        logger=None,
+        key=None,
+        verbose=False,
+        pool=None,
+        transport=None,
     ):
         self.hosts(hosts or [])
         self._command = command
@@ -148,6 +805,21 @@ class Job(object):
         self._logger = logger
         self.output_handler = OutputHandler
         self.verbose = verbose
+        self._pool = pool
+        self._transport = transport
+        self._output_limit = DEFAULT_OUTPUT_LIMIT
+        self._spill_dir = None
+        self._adaptive = False
+        self._adaptive_name = None
+        self._stats = None
+        self._timeout = None
+        self._straggler_factor = None
+        self._kill_stragglers = False
+        self._retries = 0
+        self._backoff = DEFAULT_BACKOFF
+        self._strategy = None
+        self._sink = None
+        self._after = None
 
     def get_logger(self):
         """Lazy getter for a logger instance."""
@@ -163,12 +835,34 @@ class Job(object):
         random.shuffle(self._hosts)
         return self
 
+    def schedule(self, strategy):
+        """
+        Set the strategy deciding the order in which hosts are reached.
+
+        :param strategy: :class:`scap.schedule.Strategy` to order hosts with
+                         and report completed hosts to
+        """
+        self._strategy = strategy
+        return self
+
     def exclude_hosts(self, exclude):
-        exclude = [socket.getfqdn(h) for h in exclude]
-        self.hosts([h for h in self._hosts if socket.getfqdn(h) not in exclude])
+        """Remove hosts resolving to the same FQDN as any excluded host."""
+        resolver = utils.RESOLVER
+        resolver.prefetch(list(exclude) + self._hosts)
+        exclude = set(resolver.getfqdn(h) for h in exclude)
+        self.hosts([h for h in self._hosts if resolver.getfqdn(h) not in exclude])
+
+    def get_hosts(self):
+        """List of hosts the job runs on."""
+        return list(self._hosts)
 
     def command(self, command):
-        """Set command to run."""
+        """
+        Set command to run.
+
+        :param command: Command, or function returning the command to run on
+                        the host it is given
+        """
         self._command = command
         return self
 
@@ -177,6 +871,100 @@ class Job(object):
         self._reporter = reporter
         return self
 
+    def capture(self, limit=DEFAULT_OUTPUT_LIMIT, spill_dir=None):
+        """
+        Set how much output to keep per host.
+
+        :param limit: Bytes of output kept in memory per host (head and tail)
+        :param spill_dir: Directory in which to save each host's full output
+        """
+        self._output_limit = limit
+        self._spill_dir = spill_dir
+        return self
+
+    def adaptive(self, enabled=True, name="ssh", stats=None):
+        """
+        Adjust concurrency to the observed per-host latency.
+
+        The batch size given to :meth:`run` becomes the upper bound.
+
+        :param name: Name under which decisions are logged and reported
+        :param stats: :class:`scap.log.Stats` to report decisions to
+        """
+        self._adaptive = enabled
+        self._adaptive_name = name
+        self._stats = stats
+        return self
+
+    def timeout(self, seconds=None, straggler_factor=None, kill_stragglers=False):
+        """
+        Bound how long each host may run.
+
+        :param seconds: Wall-clock seconds after which a host is killed
+        :param straggler_factor: Flag hosts running longer than this many
+                                 times the median completion time
+        :param kill_stragglers: Kill and retry flagged hosts
+        """
+        self._timeout = seconds
+        self._straggler_factor = straggler_factor
+        self._kill_stragglers = kill_stragglers
+        return self
+
+    def retry(self, retries, backoff=DEFAULT_BACKOFF):
+        """
+        Retry hosts that fail to connect or are killed as stragglers.
+
+        :param retries: Maximum number of retries per host
+        :param backoff: Seconds to wait before the first retry, doubled for
+                        each following one
+        """
+        self._retries = retries
+        self._backoff = backoff
+        return self
+
+    def pipeline(self, steps, stop_on_failure=True):
+        """
+        Run several commands on each host, in order, in a single session.
+
+        Hosts move on to the next step as soon as they are done with the
+        previous one, regardless of other hosts. Use :meth:`run_pipeline` to
+        get the status and duration of each step.
+
+        :param steps: list of (name, command) tuples
+        :param stop_on_failure: Skip the remaining steps of a host once one of
+                                them fails
+        """
+        self._command = pipeline_command(steps, stop_on_failure)
+        self.output_handler = functools.partial(
+            StepOutputHandler, names=[name for name, _ in steps]
+        )
+        return self
+
+    def after(self, dependencies):
+        """
+        Hold hosts back until another host of the job has completed.
+
+        A host is dispatched once the host it depends on has completed,
+        successfully or not, and its result has been yielded. Command
+        functions (see :meth:`command`) can thus take that result into
+        account.
+
+        :param dependencies: dict mapping hosts to the host they wait for
+        """
+        self._after = dependencies
+        return self
+
+    def results(self, sink):
+        """
+        Set where to record the result of each host.
+
+        Defaults to :data:`RESULT_SINK`.
+
+        :param sink: :class:`ResultSink`
+        """
+        self._sink = sink
+        return self
+
     def run(self, batch_size=DEFAULT_BATCH_SIZE):
         """
         Run the job, report progress, and return success/failed counts.
@@ -203,48 +991,309 @@ class Job(object):
         :yields: (host, status)
         :raises: RuntimeError if command has not been set
         """
+        for host, status, _ in self._run(batch_size):
+            yield host, status
+
+    def run_with_output(self, batch_size=DEFAULT_BATCH_SIZE):
+        """
+        Run the job, report progress, and yield the output of each host as
+        execution completes.
+
+        Output is bounded as set with :meth:`capture`.
+
+        :yields: (host, status, output)
+        :raises: RuntimeError if command has not been set
+        """
+        for host, status, ohandler in self._run(batch_size):
+            yield host, status, ohandler.output
+
+    def run_pipeline(self, batch_size=DEFAULT_BATCH_SIZE):
+        """
+        Run the pipeline set with :meth:`pipeline`, report progress, and yield
+        the result of each host as execution completes.
+
+        :yields: (host, status, steps) where steps is a list of
+                 :class:`StepResult` for the steps the host went through
+        :raises: RuntimeError if command has not been set
+        """
+        for host, status, ohandler in self._run(batch_size):
+            yield host, status, ohandler.steps
+
+    def _run(self, batch_size):
         if not self._command:
             raise RuntimeError("Command must be provided")
 
         if not self._reporter:
-            self._reporter = log.reporter(self._command)
+            name = self._command
+            if callable(name):
+                name = getattr(name, "__name__", "job")
+            self._reporter = log.reporter(name)
 
         if self._hosts:
             self._reporter.expect(len(self._hosts))
             self._reporter.start()
 
+            concurrency = None
+            if self._adaptive:
+                concurrency = AdaptiveConcurrency(
+                    batch_size,
+                    name=self._adaptive_name,
+                    stats=self._stats,
+                    logger=self.get_logger(),
+                )
+
+            straggler = None
+            if self._straggler_factor:
+                straggler = StragglerPolicy(
+                    self._straggler_factor,
+                    kill=self._kill_stragglers,
+                    logger=self.get_logger(),
+                )
+
+            sink = self._sink or RESULT_SINK
+
+            hosts = self._hosts
+            if self._strategy is not None:
+                hosts = self._strategy.order(hosts)
+
             for host, status, ohandler in cluster_ssh(
-                self._hosts,
+                hosts,
                 self._command,
                 self._user,
                 self._key,
                 batch_size,
                 self.max_failure,
-                self.output_handler,
+                functools.partial(
+                    self.output_handler,
+                    limit=self._output_limit,
+                    spill_dir=self._spill_dir,
+                ),
                 self.verbose,
+                self._pool or CONNECTION_POOL,
+                self._transport,
+                concurrency,
+                timeout=self._timeout,
+                straggler=straggler,
+                retries=self._retries,
+                backoff=self._backoff,
+                after=self._after,
+                logger=self.get_logger(),
             ):
 
+                recorded = sink is not None and sink.record(
+                    self._reporter.name, host, status, ohandler
+                )
+
                 if status == 0:
                     self._reporter.add_success()
                 else:
-                    self.get_logger().warning(
-                        "%s on %s returned [%d]: %s",
-                        self._command,
-                        host,
-                        status,
-                        ohandler.output,
-                    )
+                    if recorded:
+                        self.get_logger().warning(
+                            "%s on %s returned [%d], see `scap job-results --run %s`",
+                            self._host_command(host),
+                            host,
+                            status,
+                            sink.run,
+                        )
+                        self.get_logger().debug(
+                            "Output of %s: %s", host, ohandler.output
+                        )
+                    else:
+                        self.get_logger().warning(
+                            "%s on %s returned [%d]: %s",
+                            self._host_command(host),
+                            host,
+                            status,
+                            ohandler.output,
+                        )
+                    if ohandler.spill_path:
+                        self.get_logger().warning(
+                            "Full output of %s saved to %s", host, ohandler.spill_path
+                        )
                     self._reporter.add_failure()
 
-                yield host, status
+                if self._strategy is not None:
+                    self._strategy.record(host, ohandler.duration, status)
+
+                yield host, status, ohandler
+
+            if self._strategy is not None:
+                self._strategy.save()
 
             self._reporter.finish()
         else:
             self.get_logger().warning(
-                "Job %s called with an empty host list.", self._command
+                "Job %s called with an empty host list.", self._reporter.name
             )
 
+    def _host_command(self, host):
+        """Command run on the given host, for logging."""
+        if callable(self._command):
+            return self._command(host)
+        return self._command
+
 
+class _ChildWatcher(object):
+    """
+    Wake an epoll loop whenever a child process exits.
+
+    Installs a no-op SIGCHLD handler and points the interpreter's signal
+    wakeup fd at a non-blocking self-pipe registered with the given poll
+    object, so the loop can block in epoll instead of polling ``waitpid``.
+
+    Signal handlers can only be installed from the main thread. Elsewhere the
+    watcher degrades to a short poll timeout.
+    """
+
+    # Upper bound on how long we block when relying on SIGCHLD, in case the
+    # signal is swallowed by a handler installed behind our back.
+    SAFETY_TIMEOUT = 1.0
+    FALLBACK_TIMEOUT = 0.01
+
+    def __init__(self, poll):
+        self._poll = poll
+        self._rfd = None
+        self._wfd = None
+        self._old_handler = None
+        self._old_wakeup_fd = None
+        self.timeout = self.FALLBACK_TIMEOUT
+
+        rfd, wfd = os.pipe()
+        for fd in (rfd, wfd):
+            flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+            fcntl.fcntl(fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+
+        try:
+            self._old_wakeup_fd = signal.set_wakeup_fd(wfd)
+        except ValueError:
+            # Not the main thread
+            os.close(rfd)
+            os.close(wfd)
+            return
+
+        self._old_handler = signal.signal(signal.SIGCHLD, _noop_handler)
+
+        # Restart interrupted system calls made by our consumers between
+        # iterations of the generator
+        signal.siginterrupt(signal.SIGCHLD, False)
+
+        self._rfd = rfd
+        self._wfd = wfd
+        self.timeout = self.SAFETY_TIMEOUT
+        poll.register(rfd, select.EPOLLIN)
+
+    def owns(self, fd):
+        """Whether the given fd is the watcher's wakeup pipe."""
+        return fd == self._rfd
+
+    def drain(self):
+        """Consume pending wakeup bytes."""
+        try:
+            while os.read(self._rfd, 4096):
+                pass
+        except OSError as e:
+            if e.errno not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                raise
+
+    def close(self):
+        """Restore the previous signal setup and release the pipe."""
+        if self._rfd is None:
+            return
+
+        signal.set_wakeup_fd(self._old_wakeup_fd)
+        if self._old_handler is None:
+            # The previous handler was not installed from Python
+            self._old_handler = signal.SIG_DFL
+        signal.signal(signal.SIGCHLD, self._old_handler)
+        self._poll.unregister(self._rfd)
+        os.close(self._rfd)
+        os.close(self._wfd)
+        self._rfd = self._wfd = None
+
+
+def _noop_handler(signum, frame):
+    pass
+
+
+def _reap(procs):
+    """
+    Reap every exited child without blocking.
+
+    :param procs: Dict of running processes keyed by pid
+    :yields: (pid, status) for each exited child we know about
+    """
+    reaped = set()
+    while True:
+        try:
+            pid, status = utils.eintr_retry(os.waitpid, -1, os.WNOHANG)
+        except OSError as e:
+            # We lost track of our children somehow. They're all dead anyway,
+            # so pretend they exited normally.
+            # See https://bugs.python.org/issue1731717
+            if e.errno == errno.ECHILD:
+                for pid in procs:
+                    if pid not in reaped:
+                        yield pid, 0
+                return
+            raise
+
+        if not pid:
+            return
+
+        if pid in procs:
+            reaped.add(pid)
+            yield pid, status
+
+
+def _read_output(fd, handler, poll):
+    """
+    Read whatever is available on a child's output pipe.
+
+    Unregisters the fd from the poll object once it reaches EOF.
+
+    :returns: False once EOF has been reached
+    """
+    while True:
+        try:
+            output = utils.eintr_retry(os.read, fd, 1048576)
+        except OSError as e:
+            if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                return True
+            raise
+
+        if not output:
+            poll.unregister(fd)
+            return False
+
+        handler.accept(output)
+
+
+def _split(command):
+    """Split string commands into arguments."""
+    try:
+        return shlex.split(command)
+    except AttributeError:
+        return command
+
+
+def _spawn(host, command, user, key, verbose, pool, transport):
+    """Start the transport for the given host with a non-blocking output pipe."""
+    options = pool.options(host, user) if pool else {}
+    ssh_cmd = transport.command(
+        host, command, user=user, key=key, verbose=verbose, **options
+    )
+
+    proc = subprocess.Popen(
+        ssh_cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, preexec_fn=os.setsid,
+    )
+
+    fd = proc.stdout.fileno()
+    flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+    fcntl.fcntl(fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+    return proc
+
+
+@utils.log_context("ssh.cluster")
 def cluster_ssh(
     hosts,
     command,
@@ -254,75 +1303,217 @@ def cluster_ssh(
     max_fail=None,
     output_handler=None,
     verbose=False,
+    pool=None,
+    transport=None,
+    concurrency=None,
+    timeout=None,
+    straggler=None,
+    retries=0,
+    backoff=DEFAULT_BACKOFF,
+    after=None,
+    logger=None,
 ):
-    """Run a command via SSH on multiple hosts concurrently."""
-    hosts = set(hosts)
+    """
+    Run a command via SSH on multiple hosts concurrently.
+
+    The loop sleeps in epoll until a child either writes output or exits
+    (signalled through SIGCHLD), then reaps every exited child at once.
+
+    When a :class:`ConnectionPool` is given, connections are multiplexed over
+    its master connections.
+
+    Hosts are reached through ``transport``, :class:`SSHTransport` by default.
+    ``command`` may be a function returning the command to run on the host
+    it is given.
+
+    When an :class:`AdaptiveConcurrency` controller is given, its current
+    window is used instead of ``limit``.
+
+    Hosts still running after ``timeout`` seconds are killed and reported
+    with a :data:`TIMEOUT` status. Hosts that fail to connect are retried up
+    to ``retries`` times, waiting ``backoff`` seconds before the first retry
+    and twice as long before each following one. A :class:`StragglerPolicy`
+    flags slow hosts and may kill and retry them within the same budget.
+
+    Hosts mapped to another one in ``after`` are only dispatched once that
+    host has completed and its result has been yielded.
+
+    :raises: ValueError if ``after`` contains a cycle
+    """
+    # Dispatch hosts in the given order, once each
+    hosts = collections.deque(collections.OrderedDict.fromkeys(hosts))
+    # Hosts waiting for another one, by the host they wait for
+    waiting = _hold(hosts, after) if after else {}
     # Ensure a minimum batch size of 1
     limit = max(limit, 1)
 
     max_failure = len(hosts) if max_fail is None else max_fail
 
-    try:
-        command = shlex.split(command)
-    except AttributeError:
-        pass
+    if output_handler is None:
+        output_handler = OutputHandler
+
+    if transport is None:
+        transport = SSHTransport()
+
+    if not callable(command):
+        command = _split(command)
 
     failures = 0
     procs = {}
     output_handlers = {}
+    open_fds = set()
+    # Heap of (retry time, host, attempt)
+    delayed = []
+    # Reason we killed a process, by pid
+    killed = {}
+    flagged = set()
     poll = select.epoll()
+    watcher = _ChildWatcher(poll)
     try:
-        while hosts or procs:
-            if hosts and len(procs) < limit:
-                host = hosts.pop()
+        while hosts or procs or delayed:
+            if concurrency is not None:
+                limit = concurrency.limit
 
-                if key:
-                    ssh_cmd = SSH_WITH_KEY(
-                        host, command, user=user, key=key, verbose=verbose
-                    )
+            now = time.time()
+            while len(procs) < limit:
+                if delayed and delayed[0][0] <= now:
+                    _, host, attempt = heapq.heappop(delayed)
+                elif hosts:
+                    host, attempt = hosts.popleft(), 0
                 else:
-                    ssh_cmd = SSH(host, command, user=user, verbose=verbose)
+                    break
 
-                proc = subprocess.Popen(
-                    ssh_cmd,
-                    stdout=subprocess.PIPE,
-                    stderr=subprocess.STDOUT,
-                    preexec_fn=os.setsid,
-                )
+                host_command = _split(command(host)) if callable(command) else command
+                proc = _spawn(host, host_command, user, key, verbose, pool, transport)
+                fd = proc.stdout.fileno()
+                procs[proc.pid] = (proc, host, time.time(), attempt)
+                poll.register(fd, select.EPOLLIN)
+                open_fds.add(fd)
+                output_handlers[fd] = output_handler(host)
 
-                procs[proc.pid] = (proc, host)
-                poll.register(proc.stdout, select.EPOLLIN)
-                output_handlers[proc.stdout.fileno()] = output_handler(host)
+            wait = watcher.timeout
+            if delayed:
+                wait = min(wait, delayed[0][0] - now)
+            if timeout or straggler:
+                wait = min(wait, _CHECK_INTERVAL)
 
-            elif procs:
-                try:
-                    pid, status = utils.eintr_retry(os.waitpid, -1, os.WNOHANG)
-                except OSError as e:
-                    # We lost track of our children somehow. So grab any child
-                    # process from procs (they're all dead anyway) and pretend
-                    # it exited normally.
-                    # See https://bugs.python.org/issue1731717
-                    if e.errno == errno.ECHILD:
-                        pid = next(iter(procs))
-                        status = 0
-                    else:
-                        raise
-
-                for fd, event in utils.eintr_retry(poll.poll, 0.01):
-                    output = utils.eintr_retry(os.read, fd, 1048576)
-                    output_handlers[fd].accept(output)
-
-                if pid:
-                    status = -(status & 255) or (status >> 8)
-                    if status != 0:
-                        failures = failures + 1
-                    proc, host = procs.pop(pid)
-                    poll.unregister(proc.stdout)
-                    ohandler = output_handlers.pop(proc.stdout.fileno())
-                    if failures > max_failure:
-                        hosts = []
-                    yield host, status, ohandler
+            for fd, event in utils.eintr_retry(poll.poll, max(wait, 0)):
+                if watcher.owns(fd):
+                    watcher.drain()
+                elif not _read_output(fd, output_handlers[fd], poll):
+                    open_fds.discard(fd)
+
+            for pid, status in list(_reap(procs)):
+                status = -(status & 255) or (status >> 8)
+                proc, host, started, attempt = procs.pop(pid)
+                duration = time.time() - started
+                reason = killed.pop(pid, None)
+                flagged.discard(pid)
+                if reason == "timeout":
+                    status = TIMEOUT
+
+                fd = proc.stdout.fileno()
+                ohandler = output_handlers.pop(fd)
+
+                # Collect any output written right before the child exited
+                if fd in open_fds:
+                    open_fds.discard(fd)
+                    if _read_output(fd, ohandler, poll):
+                        poll.unregister(fd)
+                proc.stdout.close()
+                proc.returncode = status
+                ohandler.duration = duration
+                ohandler.close()
+
+                if concurrency is not None:
+                    concurrency.record(started, duration, status)
+
+                if straggler is not None and reason is None:
+                    straggler.record(duration)
+
+                if attempt < retries and (
+                    status == CONNECTION_FAILURE or reason == "straggler"
+                ):
+                    delay = backoff * 2 ** attempt
+                    logger.info(
+                        "Retrying %s in %.1fs (attempt %d of %d)",
+                        host,
+                        delay,
+                        attempt + 1,
+                        retries,
+                    )
+                    heapq.heappush(delayed, (time.time() + delay, host, attempt + 1))
+                    continue
+
+                if status != 0:
+                    failures = failures + 1
+
+                hosts.extend(waiting.pop(host, ()))
+
+                if failures > max_failure:
+                    hosts.clear()
+                    delayed = []
+                yield host, status, ohandler
+
+            if timeout or straggler:
+                _check_deadlines(
+                    procs, killed, flagged, timeout, straggler, retries, logger
+                )
     finally:
+        watcher.close()
         poll.close()
-        for pid, (proc, host) in procs.items():
+        for proc, _, _, _ in procs.values():
+            proc.kill()
+        for ohandler in output_handlers.values():
+            ohandler.close()
+
+
+def _hold(hosts, after):
+    """
+    Remove the hosts waiting for another one from a deque of hosts.
+
+    :returns: dict mapping hosts to the list of hosts waiting for them
+    :raises: ValueError if hosts wait for each other
+    """
+    pending = set(hosts)
+    for host in pending:
+        seen = set([host])
+        prerequisite = after.get(host)
+        while prerequisite in pending:
+            if prerequisite in seen:
+                raise ValueError("Circular dependency involving %s" % host)
+            seen.add(prerequisite)
+            prerequisite = after.get(prerequisite)
+
+    waiting = {}
+    ready = [h for h in hosts if after.get(h) not in pending]
+    for host in hosts:
+        if after.get(host) in pending:
+            waiting.setdefault(after[host], []).append(host)
+
+    hosts.clear()
+    hosts.extend(ready)
+    return waiting
+
+
+def _check_deadlines(procs, killed, flagged, timeout, straggler, retries, logger):
+    """Kill hosts past their deadline and flag stragglers."""
+    now = time.time()
+    threshold = straggler.threshold() if straggler else None
+
+    for pid, (proc, host, started, attempt) in procs.items():
+        if pid in killed:
+            continue
+
+        elapsed = now - started
+        if timeout and elapsed > timeout:
+            logger.warning("Killing %s after %.1fs", host, elapsed)
+            killed[pid] = "timeout"
             proc.kill()
+        elif threshold and elapsed > threshold and pid not in flagged:
+            flagged.add(pid)
+            straggler.flag(host, elapsed)
+            if straggler.kill and attempt < retries:
+                logger.warning("Killing straggler %s after %.1fs", host, elapsed)
+                killed[pid] = "straggler"
+                proc.kill()
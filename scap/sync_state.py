@@ -0,0 +1,257 @@
+# -*- coding: utf-8 -*-
+"""
+    scap.sync_state
+    ~~~~~~~~~~~~~~~
+    Record of which hosts completed which phase of a sync, so that a sync
+    which partially failed can be resumed on the failed hosts only.
+
+    Copyright © 2014-2017 Wikimedia Foundation and Contributors.
+
+    This file is part of Scap.
+
+    Scap is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, version 3.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+from __future__ import absolute_import
+
+import collections
+import errno
+import json
+import os
+import tempfile
+import time
+
+from scap import ssh
+from scap import utils
+
+VERSION = 1
+
+# Phases of a sync, in the order they run. Each phase depends on the
+# previous ones: a host that failed a phase must go through all later ones.
+SYNC = "sync"
+CDB_REBUILD = "scap-cdb-rebuild"
+WIKIVERSIONS = "sync_wikiversions"
+PHASES = [SYNC, CDB_REBUILD, WIKIVERSIONS]
+
+# Phase each job, named after its progress reporter, belongs to. Other jobs
+# are not recorded.
+JOB_PHASES = {
+    "sync-masters": SYNC,
+    "sync-pull-masters": SYNC,
+    "check-canaries": SYNC,
+    "sync-proxies": SYNC,
+    "sync-apaches": SYNC,
+    "scap-cdb-rebuild": CDB_REBUILD,
+    "sync_wikiversions": WIKIVERSIONS,
+}
+
+
+class SyncState(object):
+    """
+    Per-host results of the phases of a sync.
+
+    While in use as a context manager, the state stands in for
+    :data:`scap.ssh.RESULT_SINK` so that it sees the result of every host of
+    every job, and forwards them to the previous result sink. The state file
+    is written when the sync starts and when it ends; a sync that did not
+    end, e.g. because it was interrupted, cannot be resumed.
+
+    A sync resuming another one starts from the results of that sync, with
+    the hosts it resumes pending. It can thus be resumed again even if it
+    did not end, and the hosts it did not reach are not forgotten.
+    """
+
+    @utils.log_context("sync_state")
+    def __init__(
+        self, path, resumable=False, message=None, resume_from=None, logger=None
+    ):
+        """
+        :param path: Path of the state file
+        :param resumable: Whether the sync can be resumed from this state
+        :param message: Log message of the sync
+        :param resume_from: :class:`SyncState` of the sync this one resumes
+        """
+        self.path = path
+        self.resumable = resumable
+        self.message = message
+        self.finished = False
+        self.results = {}
+        # Run of the sync this one (ultimately) resumes
+        self.resumed = None
+        if resume_from is not None:
+            self.resumed = resume_from.resumed or resume_from.run
+            for phase, hosts in resume_from.resume_plan().items():
+                results = dict(resume_from.results.get(phase, {}))
+                results.update((host, None) for host in hosts)
+                if results:
+                    self.results[phase] = results
+        self.sink = None
+        self._run = None
+        self._logger = logger
+
+    @property
+    def run(self):
+        """Identifier of the run, as recorded by the forwarded result sink."""
+        if self.sink is not None:
+            return self.sink.run
+        return self._run
+
+    @property
+    def complete(self):
+        """
+        Whether the state holds the result of every host of the sync.
+
+        A resumed sync does even if it did not end, as it started from the
+        results of the sync it resumes.
+        """
+        return self.finished or self.resumed is not None
+
+    def __enter__(self):
+        self.sink = ssh.RESULT_SINK
+        ssh.RESULT_SINK = self
+        self.save()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        ssh.RESULT_SINK = self.sink
+        self.finished = exc_type is None
+        self.save()
+
+    def record(self, job, host, status, ohandler):
+        """
+        Record the result of ``host`` for the given job.
+
+        :returns: whether the forwarded result sink wrote the result
+        """
+        recorded = False
+        if self.sink is not None:
+            recorded = self.sink.record(job, host, status, ohandler)
+
+        steps = getattr(ohandler, "steps", None)
+        if steps is None:
+            self._record(job, host, status)
+            return recorded
+
+        # Hosts that went through a pipeline have a result for each step. A
+        # step without a result did not run, and counts as failed if the
+        # pipeline did.
+        reported = set()
+        for step in steps:
+            self._record(step.name, host, step.status)
+            reported.add(step.name)
+        for name in ohandler.names:
+            if name not in reported:
+                self._record(name, host, status)
+        return recorded
+
+    def _record(self, job, host, status):
+        phase = JOB_PHASES.get(job)
+        if phase is None:
+            return
+        hosts = self.results.setdefault(phase, {})
+        # A host failing any job of a phase failed the phase. Pending hosts
+        # have no status yet.
+        if not hosts.get(host):
+            hosts[host] = status
+
+    def failed(self):
+        """
+        Hosts that failed a phase.
+
+        :returns: dict mapping hosts to the first phase they failed
+        """
+        failed = {}
+        for phase in reversed(PHASES):
+            for host, status in self.results.get(phase, {}).items():
+                if status != 0:
+                    failed[host] = phase
+        return failed
+
+    def resume_plan(self):
+        """
+        Hosts to run each phase on to complete the sync.
+
+        Hosts resume from the first phase they failed, and go through every
+        later phase they were part of.
+
+        >>> state = SyncState('sync-state.json')
+        >>> state.results = {
+        ...     SYNC: {'mw1': 0, 'mw2': 1, 'mw3': 0},
+        ...     CDB_REBUILD: {'mw1': 0, 'mw2': 255, 'mw3': 2},
+        ...     WIKIVERSIONS: {'mw1': 0, 'mw2': 255, 'mw3': 0}}
+        >>> plan = state.resume_plan()
+        >>> plan[SYNC]
+        ['mw2']
+        >>> plan[CDB_REBUILD]
+        ['mw2', 'mw3']
+
+        :returns: OrderedDict mapping phases to sorted lists of hosts
+        """
+        failed = self.failed()
+        plan = collections.OrderedDict()
+        for index, phase in enumerate(PHASES):
+            plan[phase] = sorted(
+                host
+                for host in self.results.get(phase, {})
+                if host in failed and PHASES.index(failed[host]) <= index
+            )
+        return plan
+
+    def save(self):
+        """Atomically replace the state file."""
+        data = {
+            "version": VERSION,
+            "run": self.run,
+            "message": self.message,
+            "resumable": self.resumable,
+            "finished": self.finished,
+            "resumed": self.resumed,
+            "time": time.time(),
+            "results": self.results,
+        }
+
+        directory = os.path.dirname(os.path.abspath(self.path))
+        try:
+            utils.mkdir_p(directory)
+            fd, tmp = tempfile.mkstemp(dir=directory, prefix=".sync-state-")
+            with os.fdopen(fd, "w") as f:
+                json.dump(data, f, sort_keys=True)
+            os.rename(tmp, self.path)
+        except (IOError, OSError) as e:
+            self._logger.warning("Cannot save sync state: %s", e)
+
+
+def load(path):
+    """
+    Read a state file written by :class:`SyncState`.
+
+    :returns: :class:`SyncState`, or None if the file is missing or unusable
+    """
+    try:
+        with open(path) as f:
+            data = json.load(f)
+    except IOError as e:
+        if e.errno == errno.ENOENT:
+            return None
+        raise
+    except ValueError:
+        return None
+
+    if not isinstance(data, dict) or data.get("version") != VERSION:
+        return None
+
+    state = SyncState(path, data.get("resumable", False), data.get("message"))
+    state.finished = data.get("finished", False)
+    state.resumed = data.get("resumed")
+    state._run = data.get("run")
+    state.results = data.get("results", {})
+    return state
@@ -314,6 +314,9 @@ class DeployGroup(object):
     def exclude(self, target):
         """
         Excludes the given target from future iterations of `subgroups`.
+
+        Targets are matched by FQDN, so short and fully qualified names of
+        the same host are both excluded.
         """
         self.excludes.append(target)
 
@@ -325,7 +328,14 @@ class DeployGroup(object):
         """
 
         label = self.name
-        targets = [host for host in self.targets if host not in self.excludes]
+        targets = self.targets
+        if self.excludes:
+            resolver = utils.RESOLVER
+            resolver.prefetch(self.targets + self.excludes)
+            excludes = set(resolver.getfqdn(host) for host in self.excludes)
+            targets = [
+                host for host in targets if resolver.getfqdn(host) not in excludes
+            ]
 
         for i in range(0, len(targets), self.size):
             if len(targets) > self.size:
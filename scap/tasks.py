@@ -25,25 +25,31 @@ from __future__ import absolute_import
 import collections
 import distutils.version
 import errno
+import functools
 import glob
-import itertools
+import hashlib
 import json
 import logging
 import multiprocessing
 import os
+import re
 import shutil
 import socket
+import struct
 import subprocess
 import sys
+import tarfile
 import time
 import tempfile
 
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
 
 import scap.cdblib as cdblib
 import scap.checks as checks
 import scap.git as git
 import scap.log as log
+import scap.manifest as manifest
 import scap.ssh as ssh
 import scap.utils as utils
 
@@ -58,9 +64,27 @@ DEFAULT_RSYNC_ARGS = [
     "--delete",
     "--exclude=**/cache/l10n/*.cdb",
     "--exclude=*.swp",
+    "--exclude=/.scap-bundles",
+    "--exclude=/.scap-manifest",
+    "--exclude=/.scap-tree",
     "--no-perms",
 ]
 
+# Exit codes of rsync when the server cannot be reached: error starting the
+# client-server protocol, socket I/O error, timeouts
+RSYNC_CONNECTION_ERRORS = [5, 10, 30, 35]
+
+# Directories synced as their own shard besides the active MediaWiki
+# versions, see sync_common
+CONFIG_SHARDS = ["dblists", "multiversion", "wmf-config"]
+
+# Name of the manifest within a bundle, see build_bundle
+BUNDLE_INDEX = ".scap-bundle.json"
+# Age, in seconds, past which bundles are removed
+BUNDLE_TTL = 86400
+
+# Number of successive l10n deltas kept, see refresh_cdb_json_file
+CDB_DELTA_HISTORY = 5
 
 RESTART = "restart"
 RELOAD = "reload"
@@ -262,50 +286,83 @@ def compile_wikiversions(source_tree, cfg, logger=None):
 
 
 @utils.log_context("merge_cdb_updates")
-def merge_cdb_updates(directory, pool_size, trust_mtime=False, mute=False, logger=None):
+def merge_cdb_updates(
+    directories, pool_size, trust_mtime=False, mute=False, streaming=False, logger=None
+):
     """
     Update l10n CDB files using JSON data.
 
-    :param directory: L10n cache directory
+    The files of all directories are updated by a single pool of processes,
+    largest JSON file first, so that the longest updates do not start last
+    and hold up the whole run.
+
+    :param directories: L10n cache directory, or list of them
     :param pool_size: Number of parallel processes to use
     :param trust_mtime: Trust file modification time?
     :param mute: Disable progress indicator
+    :param streaming: Parse JSON files incrementally, see
+                      :func:`update_l10n_cdb`
     """
+    if not isinstance(directories, list):
+        directories = [directories]
 
-    cache_dir = os.path.realpath(directory)
-    upstream_dir = os.path.join(cache_dir, "upstream")
+    jobs = []
+    for directory in directories:
+        cache_dir = os.path.realpath(directory)
+        upstream_dir = os.path.join(cache_dir, "upstream")
 
-    files = [
-        os.path.splitext(os.path.basename(f))[0]
-        for f in glob.glob("%s/*.json" % upstream_dir)
-    ]
-    if not files:
-        logger.warning("Directory %s is empty", upstream_dir)
+        files = glob.glob("%s/*.json" % upstream_dir)
+        if not files:
+            logger.warning("Directory %s is empty", upstream_dir)
+            continue
+
+        for path in files:
+            cdb_file = os.path.splitext(os.path.basename(path))[0]
+            jobs.append((os.path.getsize(path), cache_dir, cdb_file))
+
+    if not jobs:
         return 0
 
-    pool = multiprocessing.Pool(pool_size)
-    updated = 0
+    # Tasks are handed to the workers in order
+    jobs.sort(key=lambda job: job[0], reverse=True)
+    json_bytes = sum(job[0] for job in jobs)
+    updated = collections.Counter()
 
     if mute:
         reporter = log.MuteReporter()
     else:
         reporter = log.ProgressReporter("l10n merge")
-    reporter.expect(len(files))
+    reporter.expect(len(jobs))
     reporter.start()
 
-    l10n_update_pool = pool.imap_unordered(
-        update_l10n_cdb_wrapper,
-        itertools.izip(
-            itertools.repeat(cache_dir), files, itertools.repeat(trust_mtime)
-        ),
-    )
-    for i, result in enumerate(l10n_update_pool, 1):
-        if result:
-            updated += 1
-        reporter.add_success()
+    pool = multiprocessing.Pool(min(pool_size, len(jobs)))
+    try:
+        with log.Timer("l10n merge") as timer:
+            l10n_update_pool = pool.imap_unordered(
+                update_l10n_cdb_wrapper,
+                [(job[1], job[2], trust_mtime, streaming) for job in jobs],
+            )
+            for args, result, duration in l10n_update_pool:
+                if result:
+                    updated[args[0]] += 1
+                    logger.debug("Updated %s in %.2fs", args[1], duration)
+                reporter.add_success()
+            elapsed = time.time() - timer.start
+        pool.close()
+    except BaseException:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
 
     reporter.finish()
-    logger.info("Updated %d CDB files(s) in %s", updated, cache_dir)
+    for cache_dir in sorted(updated):
+        logger.info("Updated %d CDB files(s) in %s", updated[cache_dir], cache_dir)
+    logger.info(
+        "Merged %d JSON file(s) at %.1f MiB/s",
+        len(jobs),
+        json_bytes / 1024.0 / 1024.0 / max(elapsed, 0.001),
+    )
     return 0
 
 
@@ -359,7 +416,14 @@ def sync_master(cfg, master, verbose=False, logger=None):
 
 @utils.log_context("sync_common")
 def sync_common(
-    cfg, include=None, sync_from=None, verbose=False, logger=None, rsync_args=None
+    cfg,
+    include=None,
+    sync_from=None,
+    verbose=False,
+    logger=None,
+    rsync_args=None,
+    use_manifest=False,
+    ordered=False,
 ):
     """
     Sync local deploy dir with upstream rsync server's copy.
@@ -376,6 +440,18 @@ def sync_common(
         server will be transferred. Rsync syntax for syncing a directory is
         ``<dirname>/***``.
     :param sync_from: List of rsync servers to fetch from.
+    :param ordered: Servers in ``sync_from`` are listed by preference: fetch
+        from the first one, and only move on to the next one if it cannot
+        be reached, instead of selecting the nearest one.
+    :param use_manifest: Only fetch the paths that changed according to the
+        manifest published by the server (see :mod:`scap.manifest`). Ignored
+        when ``include`` is given, falls back to a full sync when either the
+        local or the remote manifest is missing.
+
+    When ``rsync_parallelism`` is greater than one, a full sync is split
+    into shards: each active MediaWiki version and configuration directory
+    is fetched by its own rsync, up to ``rsync_parallelism`` at a time,
+    before a final rsync fetches everything else.
     """
 
     if not os.path.isdir(cfg["deploy_dir"]):
@@ -387,15 +463,127 @@ def sync_common(
             % cfg["deploy_dir"]
         )
 
+    _from_sync_servers(
+        cfg,
+        sync_from,
+        ordered,
+        lambda server: _fetch_common(
+            cfg, server, include, verbose, rsync_args, use_manifest, logger
+        ),
+        logger,
+    )
+
+    # Bug 58618: Invalidate local configuration cache by updating the
+    # timestamp of wmf-config/InitialiseSettings.php
+    settings_path = os.path.join(
+        cfg["deploy_dir"], "wmf-config", "InitialiseSettings.php"
+    )
+    logger.debug("Touching %s", settings_path)
+    subprocess.check_call(
+        ("sudo", "-u", "mwdeploy", "-n", "--", "/usr/bin/touch", settings_path)
+    )
+
+
+def _sync_servers(cfg, sync_from, ordered):
+    """Servers to fetch from, by order of preference, see sync_common."""
+    if ordered and sync_from:
+        return [server.strip() for server in sync_from]
+
     server = None
     if sync_from:
-        server = utils.find_nearest_host(sync_from)
+        cache_ttl = cfg.get("nearest_host_cache_ttl", 0)
+        server = utils.find_nearest_host(
+            sync_from,
+            mode=cfg.get("nearest_host_mode", utils.NEAREST_HOPS),
+            cache=utils.NEAREST_HOST_CACHE if cache_ttl else None,
+            cache_ttl=cache_ttl,
+        )
     if server is None:
         server = cfg["master_rsync"]
-    server = server.strip()
+    return [server.strip()]
+
+
+def _from_sync_servers(cfg, sync_from, ordered, fetch, logger):
+    """
+    Fetch from the servers selected by _sync_servers.
+
+    The nearest server may have been remembered from an earlier probe, and
+    have gone away since. If it cannot be reached, it is forgotten and the
+    other servers probed again.
+    """
+    servers = _sync_servers(cfg, sync_from, ordered)
+    try:
+        return _from_servers(servers, fetch, logger)
+    except subprocess.CalledProcessError as e:
+        if ordered or e.returncode not in RSYNC_CONNECTION_ERRORS:
+            raise
+        others = [host for host in sync_from or [] if host.strip() != servers[0]]
+        if len(others) == len(sync_from or []):
+            raise
+
+        logger.warning(
+            "Cannot sync from %s (rsync returned [%d]), probing other servers",
+            servers[0],
+            e.returncode,
+        )
+        if cfg.get("nearest_host_cache_ttl", 0):
+            utils.forget_nearest_host(utils.NEAREST_HOST_CACHE, servers[0])
+        return _from_servers(_sync_servers(cfg, others, ordered), fetch, logger)
+
+
+def _from_servers(servers, fetch, logger):
+    """
+    Fetch from the first server that can be reached.
+
+    :param fetch: Callable fetching from the given server, raising
+                  subprocess.CalledProcessError on rsync errors
+    """
+    for i, server in enumerate(servers):
+        try:
+            return fetch(server)
+        except subprocess.CalledProcessError as e:
+            if i + 1 == len(servers) or e.returncode not in RSYNC_CONNECTION_ERRORS:
+                raise
+            logger.warning(
+                "Cannot sync from %s (rsync returned [%d]), trying %s",
+                server,
+                e.returncode,
+                servers[i + 1],
+            )
+
+
+def _fetch_common(cfg, server, include, verbose, rsync_args, use_manifest, logger):
+    """Rsync the deploy directory from the given server, see sync_common."""
+    if not use_manifest or include:
+        return _rsync_common(cfg, server, include, verbose, rsync_args, None, logger)
+
+    # The server's manifest is only installed once the paths it lists were
+    # all fetched, so that paths which failed are fetched again next time
+    tmpdir = tempfile.mkdtemp(prefix="scap-manifest-")
+    try:
+        os.chmod(tmpdir, 0o755)
+        files = _manifest_changes(cfg, server, tmpdir, logger)
+        _rsync_common(cfg, server, include, verbose, rsync_args, files, logger)
+        _install_manifest(cfg, tmpdir, logger)
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+def _rsync_common(cfg, server, include, verbose, rsync_args, files, logger):
+    """
+    Rsync the deploy directory from the given server.
+
+    :param files: Only fetch these paths, or everything if None
+    """
 
     # Execute rsync fetch locally via sudo
     rsync = ["sudo", "-u", "mwdeploy", "-n", "--"] + DEFAULT_RSYNC_ARGS
+    if files is not None:
+        # Transfer the listed paths only. Deletions cannot rely on --delete,
+        # which needs a recursive transfer: deleted paths are listed as well
+        # and removed since they are missing on the server.
+        rsync = [arg for arg in rsync if not arg.startswith("--delete")]
+        rsync += ["--files-from=-", "--from0", "--delete-missing-args"]
     # Exclude .git metadata
     rsync.append("--exclude=**/.git")
     if verbose:
@@ -417,16 +605,426 @@ def sync_common(
     logger.debug("Running rsync command: `%s`", " ".join(rsync))
     stats = log.Stats(cfg["statsd_host"], int(cfg["statsd_port"]))
     with log.Timer("rsync common", stats):
-        subprocess.check_call(rsync)
+        jobs = cfg.get("rsync_parallelism", 1)
+        if files is None and not include and jobs > 1:
+            _sync_shards(cfg, server, rsync[:-2], jobs, stats, logger)
+        elif files is None:
+            subprocess.check_call(rsync)
+        elif files:
+            logger.info("Copying %d changed paths", len(files))
+            proc = subprocess.Popen(rsync, stdin=subprocess.PIPE)
+            proc.communicate("\0".join(files).encode("utf-8"))
+            if proc.returncode:
+                raise subprocess.CalledProcessError(proc.returncode, rsync)
+        else:
+            logger.info("Manifest unchanged, nothing to copy")
 
-    # Bug 58618: Invalidate local configuration cache by updating the
-    # timestamp of wmf-config/InitialiseSettings.php
-    settings_path = os.path.join(
-        cfg["deploy_dir"], "wmf-config", "InitialiseSettings.php"
-    )
-    logger.debug("Touching %s", settings_path)
+
+def _sync_shards(cfg, server, rsync, jobs, stats, logger):
+    """
+    Fetch the deploy directory with concurrent rsyncs.
+
+    Falls back to a single rsync of the whole directory if any shard fails.
+
+    :param rsync: rsync command, without source and destination
+    :param jobs: Number of rsyncs to run at once
+    """
+    shards = _shard_dirs(cfg)
+
+    def sync_shard(shard):
+        cmd = rsync + [
+            "--stats",
+            "%s::common/%s/" % (server, shard),
+            os.path.join(cfg["deploy_dir"], shard) + "/",
+        ]
+        with log.Timer("rsync shard %s" % shard, stats):
+            proc = subprocess.Popen(
+                cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT
+            )
+            output = proc.communicate()[0].decode("utf-8", "replace")
+        return shard, proc.returncode, output
+
+    failed = []
+    pool = ThreadPoolExecutor(max_workers=jobs)
+    try:
+        for shard, status, output in pool.map(sync_shard, shards):
+            if status != 0:
+                logger.warning(
+                    "rsync of %s returned [%d]: %s", shard, status, output.strip()
+                )
+                failed.append(shard)
+                continue
+
+            logger.debug(output)
+            received = _received_bytes(output)
+            logger.info("Received %d bytes for %s", received, shard)
+            stats.increment(
+                "scap.rsync_shard.%s.bytes" % re.sub(r"\W", "_", shard.lower()),
+                received,
+            )
+    finally:
+        pool.shutdown()
+
+    final = list(rsync)
+    if failed:
+        logger.warning("Fetching the whole deploy directory again")
+    else:
+        # Shards are excluded from the final pass, and protected so that
+        # --delete-excluded in rsync_args does not delete them either
+        for shard in shards:
+            final += ["--filter=P /%s" % shard, "--exclude=/%s" % shard]
+
+    with log.Timer("rsync top-level", stats):
+        subprocess.check_call(final + ["%s::common" % server, cfg["deploy_dir"]])
+
+
+def _shard_dirs(cfg):
+    """Directories of the deploy directory to fetch as separate shards."""
+    try:
+        versions = utils.get_active_wikiversions(cfg["deploy_dir"], cfg["wmf_realm"])
+    except (IOError, ValueError):
+        versions = {}
+
+    shards = ["php-%s" % version for version in versions] + CONFIG_SHARDS
+    return [
+        shard
+        for shard in shards
+        if os.path.isdir(os.path.join(cfg["deploy_dir"], shard))
+    ]
+
+
+def _received_bytes(output):
+    """
+    Bytes received according to the output of ``rsync --stats``.
+
+    >>> _received_bytes('Total bytes sent: 1,234\\nTotal bytes received: 56,789\\n')
+    56789
+    """
+    match = re.search(r"^Total bytes received: ([\d,]+)", output, re.MULTILINE)
+    if match is None:
+        return 0
+    return int(match.group(1).replace(",", ""))
+
+
+def _manifest_changes(cfg, server, tmpdir, logger):
+    """
+    Paths of the deploy directory that differ from the server copy.
+
+    The server's hash tree is fetched into ``tmpdir``. Nothing is fetched
+    when its root matches the tree installed after the last complete pull.
+    Otherwise the manifest of the server is fetched into ``tmpdir`` too,
+    over a copy of the previous one so that only its changed lines are
+    transferred, and compared to it.
+
+    :returns: list of paths to fetch, or None when manifests cannot be
+              compared
+    """
+    local_path = os.path.join(cfg["deploy_dir"], manifest.MANIFEST_NAME)
+    local = manifest.load(local_path)
+    local_tree = manifest.load_tree(os.path.join(cfg["deploy_dir"], manifest.TREE_NAME))
+
+    # Fetched even without a local tree, to be installed along the manifest
+    tree_path = os.path.join(tmpdir, manifest.TREE_NAME)
+    if _fetch_file(server, manifest.TREE_NAME, tree_path, logger):
+        remote_tree = manifest.load_tree(tree_path)
+        if remote_tree is None:
+            _discard(tree_path)
+        elif local is not None and local_tree is not None:
+            if remote_tree.get("") == local_tree.get(""):
+                logger.info("Deploy directory matches %s", server)
+                _discard(tree_path)
+                return []
+
+    remote_path = os.path.join(tmpdir, manifest.MANIFEST_NAME)
+    if local is not None:
+        shutil.copy(local_path, remote_path)
+    if not _fetch_file(server, manifest.MANIFEST_NAME, remote_path, logger):
+        _discard(remote_path)
+        return None
+
+    remote = manifest.load(remote_path)
+    if remote is None:
+        logger.warning("Unusable manifest on %s, falling back to a full sync", server)
+        _discard(remote_path)
+        return None
+    if local is None:
+        logger.info("No local manifest, falling back to a full sync")
+        return None
+
+    changed, deleted = manifest.diff(local, remote)
+    logger.debug("%d paths changed, %d deleted", len(changed), len(deleted))
+    return changed + deleted
+
+
+def _discard(path):
+    if os.path.exists(path):
+        os.unlink(path)
+
+
+def _install_manifest(cfg, tmpdir, logger):
+    """Install the manifest files fetched by _manifest_changes."""
+    paths = [
+        os.path.join(tmpdir, name)
+        for name in (manifest.MANIFEST_NAME, manifest.TREE_NAME)
+        if os.path.exists(os.path.join(tmpdir, name))
+    ]
+    if not paths:
+        return
+
+    logger.debug("Installing manifest of %s", cfg["deploy_dir"])
     subprocess.check_call(
-        ("sudo", "-u", "mwdeploy", "-n", "--", "/usr/bin/touch", settings_path)
+        ["sudo", "-u", "mwdeploy", "-n", "--", "/usr/bin/install", "-m", "0644"]
+        + paths
+        + [cfg["deploy_dir"]]
+    )
+
+
+def _fetch_file(server, name, dest, logger):
+    """Fetch a file from the root of the server's ``common`` module."""
+    try:
+        subprocess.check_call(
+            ["/usr/bin/rsync", "--compress", "%s::common/%s" % (server, name), dest]
+        )
+    except subprocess.CalledProcessError as e:
+        logger.warning("Cannot fetch %s from %s: %s", name, server, e)
+        return False
+    return True
+
+
+@utils.log_context("publish_manifest")
+def publish_manifest(cfg, logger=None):
+    """
+    Update the manifest and hash tree of the staging directory, which hosts
+    fetch from ``server::common``.
+
+    Hashes are only computed for files whose size or modification time
+    changed since the previous manifest. The published tree is limited to
+    the root and top-level directories.
+
+    :param cfg: Dict of global configuration values
+    """
+    path = os.path.join(cfg["stage_dir"], manifest.MANIFEST_NAME)
+    files = manifest.build(cfg["stage_dir"], manifest.load(path))
+    hashes = manifest.tree(files, depth=1)
+
+    logger.debug(
+        "Publishing manifest of %d files, root hash %s", len(files), hashes[""]
+    )
+    manifest.save(files, path)
+    manifest.save_tree(hashes, os.path.join(cfg["stage_dir"], manifest.TREE_NAME))
+
+
+def tree_hashes(cfg, depth=None):
+    """
+    Hash tree of the files actually present in the deploy directory.
+
+    Hashes recorded in the manifest received on the last sync are reused for
+    files whose size and modification time did not change.
+
+    :param cfg: Dict of global configuration values
+    :param depth: Only return directories up to this many levels deep
+    :returns: dict mapping directories to their hash
+    """
+    # Deployment hosts keep the manifest in the staging directory, synced to
+    # the deploy directory with the same modification times
+    previous = None
+    for directory in (cfg["deploy_dir"], cfg.get("stage_dir")):
+        if previous is None and directory:
+            previous = manifest.load(os.path.join(directory, manifest.MANIFEST_NAME))
+    return manifest.tree(manifest.build(cfg["deploy_dir"], previous), depth)
+
+
+def bundle_digest(roots, files):
+    """
+    Content address of a bundle.
+
+    It only depends on the paths covered by the bundle and on the content of
+    its files.
+
+    >>> digest = bundle_digest(['a'], {'a/b': (1, 1, 'x')})
+    >>> digest == bundle_digest(['a'], {'a/b': (1, 2, 'x')})
+    True
+    >>> digest == bundle_digest(['a/b'], {'a/b': (1, 1, 'x')})
+    False
+
+    :param roots: Files and directories covered by the bundle
+    :param files: Manifest of the files of the bundle
+    """
+    data = json.dumps([sorted(roots), manifest.tree(files, depth=0)[""]])
+    return hashlib.sha1(data.encode("utf-8")).hexdigest()
+
+
+@utils.log_context("build_bundle")
+def build_bundle(cfg, roots, logger=None):
+    """
+    Publish files of the staging directory as a single compressed bundle for
+    targets to fetch from ``server::common`` with :func:`apply_bundle`.
+
+    Bundles are named after their :func:`bundle_digest` in the
+    ``.scap-bundles`` directory of the staging directory, so a bundle is only
+    built once for a given content. Bundles older than ``BUNDLE_TTL`` are
+    removed.
+
+    :param cfg: Dict of global configuration values
+    :param roots: Files and directories to bundle, relative to the staging
+                  directory
+    :returns: digest of the bundle
+    """
+    roots = sorted(set(root.strip("/") for root in roots))
+    files = manifest.build(cfg["stage_dir"], paths=roots)
+    digest = bundle_digest(roots, files)
+
+    bundle_dir = os.path.join(cfg["stage_dir"], manifest.BUNDLE_DIR)
+    name = "%s.tar.gz" % digest
+    if os.path.exists(os.path.join(bundle_dir, name)):
+        logger.debug("Bundle %s is already published", digest)
+        return digest
+
+    tmpdir = tempfile.mkdtemp(prefix="scap-bundle-")
+    try:
+        os.chmod(tmpdir, 0o755)
+        index = os.path.join(tmpdir, BUNDLE_INDEX)
+        with open(index, "w") as f:
+            json.dump(
+                {"version": manifest.VERSION, "roots": roots, "files": files},
+                f,
+                sort_keys=True,
+            )
+
+        path = os.path.join(tmpdir, name)
+        with tarfile.open(path, "w:gz") as tar:
+            tar.add(index, BUNDLE_INDEX)
+            for relpath in sorted(files):
+                tar.add(
+                    os.path.join(cfg["stage_dir"], relpath), relpath, recursive=False
+                )
+
+        logger.debug(
+            "Publishing bundle %s of %d files (%d bytes)",
+            digest,
+            len(files),
+            os.path.getsize(path),
+        )
+        os.chmod(path, 0o644)
+        utils.mkdir_p(bundle_dir)
+        shutil.move(path, os.path.join(bundle_dir, name))
+
+        expired = time.time() - BUNDLE_TTL
+        for old in glob.glob(os.path.join(bundle_dir, "*.tar.gz")):
+            if os.path.getmtime(old) < expired:
+                os.unlink(old)
+    finally:
+        shutil.rmtree(tmpdir)
+
+    return digest
+
+
+@utils.log_context("apply_bundle")
+def apply_bundle(cfg, digest, sync_from=None, ordered=False, logger=None):
+    """
+    Fetch a bundle published by :func:`build_bundle` and unpack it into the
+    local deploy directory.
+
+    The bundle is kept in the ``.scap-bundles`` directory of the deploy
+    directory, so that it is only downloaded once and hosts serving the
+    deploy directory, such as proxies, serve it in turn. It is unpacked to a
+    temporary directory, and every changed file checked against the
+    bundle's manifest before any is renamed into place. Files of the bundled
+    directories which are not in the bundle are removed.
+
+    :param cfg: Dict of global configuration values
+    :param digest: Digest of the bundle
+    :param sync_from: List of rsync servers to fetch from, see
+                      :func:`sync_common`
+    :param ordered: Servers are listed by order of preference
+    :raises: IOError if the bundle does not match its manifest
+    """
+    deploy_dir = cfg["deploy_dir"]
+    bundle_dir = os.path.join(deploy_dir, manifest.BUNDLE_DIR)
+    name = "%s.tar.gz" % digest
+    path = os.path.join(bundle_dir, name)
+
+    if os.path.exists(path):
+        logger.info("Bundle %s already fetched", digest)
+        os.utime(path, None)
+    else:
+        utils.mkdir_p(bundle_dir)
+        _from_sync_servers(
+            cfg,
+            sync_from,
+            ordered,
+            lambda server: subprocess.check_call(
+                [
+                    "/usr/bin/rsync",
+                    "--compress",
+                    "%s::common/%s/%s" % (server, manifest.BUNDLE_DIR, name),
+                    path,
+                ]
+            ),
+            logger,
+        )
+
+    tmpdir = tempfile.mkdtemp(dir=deploy_dir, prefix=".scap-bundle-")
+    try:
+        with tarfile.open(path, "r:gz") as tar:
+            tar.extract(BUNDLE_INDEX, tmpdir)
+            with open(os.path.join(tmpdir, BUNDLE_INDEX)) as f:
+                index = json.load(f)
+            roots = index["roots"]
+            files = dict(
+                (relpath, tuple(entry)) for relpath, entry in index["files"].items()
+            )
+            if bundle_digest(roots, files) != digest:
+                raise IOError(errno.EINVAL, "Bundle does not match its digest", path)
+
+            current = manifest.build(deploy_dir, previous=files, paths=roots)
+            changed, removed = manifest.diff(current, files)
+            for relpath in changed:
+                tar.extract(relpath, tmpdir)
+
+        # Extracted symlinks do not keep their modification time
+        unpacked = manifest.build(tmpdir, paths=changed)
+        for relpath in changed:
+            if unpacked.get(relpath, ())[::2] != files[relpath][::2]:
+                raise IOError(errno.EINVAL, "Corrupt file in bundle", relpath)
+
+        for relpath in changed:
+            dest = os.path.join(deploy_dir, relpath)
+            utils.mkdir_p(os.path.dirname(dest))
+            os.rename(os.path.join(tmpdir, relpath), dest)
+        for relpath in removed:
+            os.unlink(os.path.join(deploy_dir, relpath))
+    finally:
+        shutil.rmtree(tmpdir)
+
+    logger.info(
+        "Applied bundle %s: %d files updated, %d removed",
+        digest,
+        len(changed),
+        len(removed),
+    )
+
+    # Drop bundles nobody asked for in a while
+    for old in glob.glob(os.path.join(bundle_dir, "*.tar.gz")):
+        if time.time() - os.path.getmtime(old) > BUNDLE_TTL:
+            os.unlink(old)
+
+    # Invalidate the configuration cache, as sync_common does
+    settings_path = os.path.join(deploy_dir, "wmf-config", "InitialiseSettings.php")
+    if os.path.exists(settings_path):
+        os.utime(settings_path, None)
+
+
+def wikiversions_rsync_command(cfg):
+    """
+    Command fetching wikiversions files from the master on a target.
+
+    :param cfg: Dict of global configuration values
+    """
+    return (
+        "sudo -u mwdeploy -n -- /usr/bin/rsync -l "
+        "%(master_rsync)s::common/wikiversions*.{json,php} "
+        "%(deploy_dir)s" % cfg
     )
 
 
@@ -442,24 +1040,26 @@ def sync_wikiversions(hosts, cfg, key=None):
         compile_wikiversions("stage", cfg)
 
         rsync = ssh.Job(hosts, user=cfg["ssh_user"], key=key).shuffle()
-        rsync.command(
-            "sudo -u mwdeploy -n -- /usr/bin/rsync -l "
-            "%(master_rsync)s::common/wikiversions*.{json,php} "
-            "%(deploy_dir)s" % cfg
-        )
+        rsync.command(wikiversions_rsync_command(cfg))
         return rsync.progress(
             log.reporter("sync_wikiversions", cfg["fancy_progress"])
         ).run()
 
 
 @utils.log_context("update_l10n_cdb")
-def update_l10n_cdb(cache_dir, cdb_file, trust_mtime=False, logger=None):
+def update_l10n_cdb(
+    cache_dir, cdb_file, trust_mtime=False, streaming=False, logger=None
+):
     """
     Update a localization CDB database.
 
     :param cache_dir: L10n cache directory
     :param cdb_file: L10n CDB database
     :param trust_mtime: Trust file modification time?
+    :param streaming: Parse the JSON file incrementally, writing each message
+                      to the CDB file as it is read, instead of loading all
+                      messages first. This bounds the memory used by large
+                      languages.
     """
 
     md5_path = os.path.join(cache_dir, "upstream", "%s.MD5" % cdb_file)
@@ -488,29 +1088,110 @@ def update_l10n_cdb(cache_dir, cdb_file, trust_mtime=False, logger=None):
     else:
         need_rebuild = True
 
-    if need_rebuild:
-        with open(json_path) as f:
-            data = json.load(f)
+    if not need_rebuild:
+        return False
+
+    # Write temp cdb file
+    tmp_cdb_path = "%s.tmp" % cdb_path
+    # Patched CDB files do not match the upstream MD5, so they are only
+    # built when modification times are trusted
+    if not (trust_mtime and _patch_l10n_cdb(cdb_path, tmp_cdb_path, json_mtime)):
+        with open(json_path) as f, open(tmp_cdb_path, "wb") as fp:
+            if streaming:
+                items = utils.iter_json_object(f)
+            else:
+                items = json.load(f).items()
 
-        # Write temp cdb file
-        tmp_cdb_path = "%s.tmp" % cdb_path
-        with open(tmp_cdb_path, "wb") as fp:
             writer = cdblib.Writer(fp)
-            for key, value in data.items():
+            for key, value in items:
                 writer.put(key.encode("utf-8"), value.encode("utf-8"))
             writer.finalize()
             utils.eintr_retry(os.fsync, fp.fileno())
 
-        if not os.path.isfile(tmp_cdb_path):
-            raise IOError(errno.ENOENT, "Failed to create CDB", tmp_cdb_path)
+    if not os.path.isfile(tmp_cdb_path):
+        raise IOError(errno.ENOENT, "Failed to create CDB", tmp_cdb_path)
+
+    # Move temp file over old file
+    os.chmod(tmp_cdb_path, 0o664)
+    os.rename(tmp_cdb_path, cdb_path)
+    # Set timestamp to match upstream json
+    os.utime(cdb_path, (json_mtime, json_mtime))
+    return True
+
+
+@utils.log_context("patch_l10n_cdb")
+def _patch_l10n_cdb(cdb_path, tmp_cdb_path, json_mtime, logger=None):
+    """
+    Build a CDB file from the previous one and the l10n deltas written by
+    :func:`refresh_cdb_json_file`.
+
+    A CDB file was built from the upstream JSON file whose modification time
+    it has. The deltas from that JSON file to the current one are applied to
+    the records of the CDB file, which saves decoding the whole JSON file.
+
+    :returns: whether the CDB file was built. It is not when there is no
+              delta from the previous CDB file to the current JSON file, or
+              the previous CDB file cannot be read.
+    """
+    if not os.path.exists(cdb_path):
+        return False
 
-        # Move temp file over old file
-        os.chmod(tmp_cdb_path, 0o664)
-        os.rename(tmp_cdb_path, cdb_path)
-        # Set timestamp to match upstream json
-        os.utime(cdb_path, (json_mtime, json_mtime))
-        return True
-    return False
+    cache_dir, cdb_file = os.path.split(cdb_path)
+    delta_path = os.path.join(cache_dir, "upstream", "%s.delta" % cdb_file)
+    try:
+        with open(delta_path) as f:
+            steps = json.load(f)["steps"]
+    except IOError as e:
+        if e.errno == errno.ENOENT:
+            return False
+        raise
+    except (ValueError, KeyError, TypeError):
+        logger.warning("Ignoring unreadable delta %s", delta_path)
+        return False
+
+    # Deltas are identified by the modification time, in seconds, of the
+    # JSON files they go from and to
+    base = int(os.path.getmtime(cdb_path))
+    starts = [step["from"] for step in steps]
+    if not steps or base not in starts or steps[-1]["to"] != int(json_mtime):
+        logger.debug("Delta chain broken for %s; rebuilding", cdb_file)
+        return False
+
+    changes = {}
+    removed = set()
+    for step in steps[starts.index(base) :]:
+        for key in step["remove"]:
+            key = key.encode("utf-8")
+            changes.pop(key, None)
+            removed.add(key)
+        for key, value in step["set"].items():
+            key = key.encode("utf-8")
+            changes[key] = value.encode("utf-8")
+            removed.discard(key)
+
+    count = len(changes)
+    try:
+        with cdblib.Reader.open(cdb_path) as reader, open(tmp_cdb_path, "wb") as fp:
+            writer = cdblib.Writer(fp)
+            for key, value in reader.iteritems():
+                if key not in changes and key not in removed:
+                    writer.put(key, value)
+                    count += 1
+            for key, value in changes.items():
+                writer.put(key, value)
+            writer.finalize()
+            utils.eintr_retry(os.fsync, fp.fileno())
+    except (EnvironmentError, ValueError, struct.error) as e:
+        logger.warning("Cannot patch %s (%s); rebuilding", cdb_file, e)
+        if os.path.exists(tmp_cdb_path):
+            os.unlink(tmp_cdb_path)
+        return False
+
+    if count != steps[-1]["keys"]:
+        logger.warning("Delta does not match %s; rebuilding", cdb_file)
+        os.unlink(tmp_cdb_path)
+        return False
+    return True
 
 
 @utils.log_context("update_l10n_cdb_wrapper")
@@ -519,9 +1200,13 @@ def update_l10n_cdb_wrapper(args, logger=None):
     argument can be provided.
 
     :param args: Sequence of arguments to pass to update_l10n_cdb
+    :returns: tuple of the arguments, the result of update_l10n_cdb and the
+              seconds it took
     """
     try:
-        return update_l10n_cdb(*args)
+        start = time.time()
+        result = update_l10n_cdb(*args)
+        return args, result, time.time() - start
     except Exception:
         # Log detailed error; multiprocessing will truncate the stack trace
         logger.exception("Failure processing %s", args)
@@ -686,21 +1371,26 @@ def update_localization_cache(version, wikidb, verbose, cfg, logger=None):
     # Include JSON versions of the CDB files and add MD5 files
     logger.info("Generating JSON versions and md5 files")
     scap_path = os.path.join(os.path.dirname(sys.argv[0]), "scap")
+    delta_option = ""
+    if cfg.get("cdb_json_deltas", False):
+        delta_option = "--deltas"
     utils.sudo_check_call(
         "l10nupdate",
         "%s cdb-json-refresh "
-        '--directory="%s" --threads=%s %s'
-        % (scap_path, cache_dir, use_cores, verbose_messagelist),
+        '--directory="%s" --threads=%s %s %s'
+        % (scap_path, cache_dir, use_cores, verbose_messagelist, delta_option),
     )
 
 
-def refresh_cdb_json_files(in_dir, pool_size, verbose):
+def refresh_cdb_json_files(in_dir, pool_size, verbose, deltas=False):
     """
     Update json files from corresponding cdb file in parallel.
 
     :param in_dir: directory containing cdb files
     :param pool_size: number of "threads" to use
     :param verbose: output verbosely
+    :param deltas: also write key-level deltas, see
+                   :func:`refresh_cdb_json_file`
     """
     logger = utils.get_logger()
     cdb_files = glob.glob(os.path.join(in_dir, "*.cdb"))
@@ -715,7 +1405,8 @@ def refresh_cdb_json_files(in_dir, pool_size, verbose):
     reporter.expect(len(cdb_files))
     reporter.start()
 
-    for result in pool.imap_unordered(refresh_cdb_json_file, cdb_files):
+    refresh = functools.partial(refresh_cdb_json_file, deltas=deltas)
+    for result in pool.imap_unordered(refresh, cdb_files):
         if result:
             updated += 1
         reporter.add_success()
@@ -724,7 +1415,7 @@ def refresh_cdb_json_files(in_dir, pool_size, verbose):
     logger.info("Updated %s JSON file(s) in %s", updated, in_dir)
 
 
-def refresh_cdb_json_file(file_path):
+def refresh_cdb_json_file(file_path, deltas=False):
     """
     Rebuild json file from cdb file.
 
@@ -734,12 +1425,18 @@ def refresh_cdb_json_file(file_path):
     #. Change permissions on named temporary file
     #. Overwrite upstream json file
     #. Write upstream md5 file
+    #. Write upstream delta file, if requested
+
+    The delta file lists the keys set and removed by each of the last few
+    updates of the json file, so that :func:`update_l10n_cdb` can patch the
+    cdb file built from a previous json file instead of rebuilding it.
     """
     cdb_dir = os.path.dirname(file_path)
     file_name = os.path.basename(file_path)
     upstream_dir = os.path.join(cdb_dir, "upstream")
     upstream_md5 = os.path.join(upstream_dir, "{}.MD5".format(file_name))
     upstream_json = os.path.join(upstream_dir, "{}.json".format(file_name))
+    upstream_delta = os.path.join(upstream_dir, "{}.delta".format(file_name))
 
     logger = utils.get_logger()
     logger.debug("Processing: %s", file_name)
@@ -757,12 +1454,14 @@ def refresh_cdb_json_file(file_path):
         pass
 
     tmp_json = tempfile.NamedTemporaryFile(delete=False)
-    with open(file_path, "r") as fp:
-        reader = cdblib.Reader(fp.read())
-
     out = collections.OrderedDict()
-    for k, v in reader.items():
-        out[k] = v
+    with cdblib.Reader.open(file_path) as reader:
+        for k, v in reader.iteritems():
+            out[k] = v
+
+    step = None
+    if deltas:
+        step = _cdb_json_delta(upstream_json, out)
 
     json_data = json.dumps(out, indent=0, separators=(",", ":"))
 
@@ -785,9 +1484,69 @@ def refresh_cdb_json_file(file_path):
     with open(upstream_md5, "w") as md5:
         md5.write(cdb_md5)
 
+    if step is not None:
+        step["to"] = int(os.path.getmtime(upstream_json))
+        _save_cdb_json_delta(upstream_delta, step)
+    elif os.path.exists(upstream_delta):
+        # Deltas no longer lead to the json file
+        os.unlink(upstream_delta)
+
     return True
 
 
+def _cdb_json_delta(json_path, data):
+    """
+    Keys set and removed in ``data`` compared to the json file, or None if
+    there is no json file.
+    """
+    try:
+        with open(json_path) as f:
+            mtime = int(os.fstat(f.fileno()).st_mtime)
+            old = json.load(f)
+    except IOError as e:
+        if e.errno == errno.ENOENT:
+            return None
+        raise
+    except ValueError:
+        return None
+
+    old = dict((k.encode("utf-8"), v.encode("utf-8")) for k, v in old.items())
+    return {
+        "from": mtime,
+        "keys": len(data),
+        "set": dict((k, v) for k, v in data.items() if old.get(k) != v),
+        "remove": sorted(k for k in old if k not in data),
+    }
+
+
+def _save_cdb_json_delta(delta_path, step):
+    """Append a step to a delta file, dropping steps it does not follow."""
+    steps = []
+    try:
+        with open(delta_path) as f:
+            steps = json.load(f)["steps"]
+    except (IOError, ValueError, KeyError, TypeError):
+        pass
+
+    if steps and steps[-1]["to"] != step["from"]:
+        steps = []
+    steps = (steps + [step])[-CDB_DELTA_HISTORY:]
+    # Successive updates within a second cannot be told apart
+    if step["from"] == step["to"]:
+        steps = []
+
+    if not steps:
+        if os.path.exists(delta_path):
+            os.unlink(delta_path)
+        return
+
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(delta_path), prefix=".delta-")
+    with os.fdopen(fd, "w") as f:
+        json.dump({"steps": steps}, f, sort_keys=True)
+    os.chmod(tmp, 0o644)
+    os.rename(tmp, delta_path)
+
+
 def handle_services(services, require_valid_service=False):
     """
     Take a comma-separated list of services, and restart each of them.
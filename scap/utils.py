@@ -25,13 +25,18 @@ import os
 import pwd
 import random
 import re
+import select
 import socket
 import struct
 import subprocess
 import sys
 import tempfile
+import threading
+import time
 import yaml
 
+from concurrent.futures import ThreadPoolExecutor
+
 from six.moves import input as _input
 
 import pygments
@@ -178,10 +183,122 @@ def confirm(question="Continue?", default=False, on_fulfilled=None, on_rejected=
     return result
 
 
-def find_nearest_host(hosts, port=22, timeout=1):
+class Resolver(object):
+    """
+    Cache of host name lookups shared by a whole scap run.
+
+    Results, failures included, are kept for ``ttl`` seconds. Since lookups
+    mostly wait on the network, :meth:`prefetch` resolves many names at once
+    on a pool of ``workers`` threads.
+
+    >>> resolver = Resolver()
+    >>> resolver.getaddrinfo('127.0.0.1', 22)[0][4]
+    ('127.0.0.1', 22)
+    >>> resolver.hits, resolver.misses
+    (0, 1)
+    >>> resolver.getaddrinfo('127.0.0.1', 22)[0][4]
+    ('127.0.0.1', 22)
+    >>> resolver.hits, resolver.misses
+    (1, 1)
+    """
+
+    def __init__(self, ttl=300, workers=16):
+        self.ttl = ttl
+        self.workers = workers
+        self.hits = 0
+        self.misses = 0
+        # Seconds spent waiting on lookups, summed over all threads
+        self.lookup_time = 0.0
+        self._cache = {}
+        self._lock = threading.Lock()
+
+    def getfqdn(self, host):
+        """Cached :func:`socket.getfqdn`."""
+        return self._lookup(("fqdn", host), socket.getfqdn, host)
+
+    def getaddrinfo(self, host, port):
+        """Cached :func:`socket.getaddrinfo`."""
+        return self._lookup(("addrinfo", host, port), socket.getaddrinfo, host, port)
+
+    def prefetch(self, hosts, port=None):
+        """
+        Resolve uncached hosts concurrently.
+
+        :param hosts: Host names to resolve
+        :param port: Resolve addresses for this port instead of FQDNs
+        """
+        if port is None:
+            keys = dict((("fqdn", host), host) for host in hosts)
+        else:
+            keys = dict((("addrinfo", host, port), host) for host in hosts)
+
+        now = time.time()
+        with self._lock:
+            missing = [
+                host
+                for key, host in keys.items()
+                if key not in self._cache or self._cache[key][0] <= now
+            ]
+
+        if len(missing) < 2:
+            return
+
+        def resolve(host):
+            try:
+                if port is None:
+                    self.getfqdn(host)
+                else:
+                    self.getaddrinfo(host, port)
+            except socket.error:
+                pass
+
+        with ThreadPoolExecutor(max_workers=min(self.workers, len(missing))) as pool:
+            list(pool.map(resolve, missing))
+
+    def _lookup(self, key, func, *args):
+        now = time.time()
+        with self._lock:
+            entry = self._cache.get(key)
+            if entry is not None and entry[0] > now:
+                self.hits += 1
+            else:
+                entry = None
+                self.misses += 1
+
+        if entry is None:
+            try:
+                result = func(*args)
+            except socket.error as e:
+                result = e
+
+            with self._lock:
+                self.lookup_time += time.time() - now
+                entry = self._cache[key] = (now + self.ttl, result)
+
+        if isinstance(entry[1], Exception):
+            raise entry[1]
+        return entry[1]
+
+
+# Resolver cache shared by the running scap command
+RESOLVER = Resolver()
+
+
+NEAREST_HOPS = "hops"
+NEAREST_RTT = "rtt"
+NEAREST_HOST_CACHE = os.path.expanduser("~/.cache/scap/nearest-hosts.json")
+
+
+def find_nearest_host(
+    hosts, port=22, timeout=1, mode=NEAREST_HOPS, cache=None, cache_ttl=300
+):
     """
     Given a collection of hosts, find the one that is the fewest
-    number of hops away.
+    number of hops away, or the one answering the fastest.
+
+    All hosts are probed at once. In ``hops`` mode, connections are opened
+    with increasing TTLs, from 1 to 29, until one of them reaches its host.
+    In ``rtt`` mode, the first host accepting a connection wins.
 
     >>> # Begin test fixture
     >>> import socket
@@ -192,38 +309,159 @@ def find_nearest_host(hosts, port=22, timeout=1):
     >>> # End test fixture
     >>> find_nearest_host(['127.0.0.1'], port=fixture_port)
     '127.0.0.1'
+    >>> find_nearest_host(['127.0.0.1'], port=fixture_port, mode='rtt')
+    '127.0.0.1'
 
     :param hosts: Hosts to check
     :param port: Port to try to connect on (default: 22)
     :param timeout: Timeout in seconds (default: 1)
+    :param mode: ``hops`` or ``rtt``
+    :param cache: Path of a file in which to remember the result
+    :param cache_ttl: Seconds during which a remembered result is used
     """
-    host_map = {}
+    hosts = list(hosts)
+    key = "%s:%d:%s" % (mode, port, ",".join(sorted(hosts)))
+    if cache:
+        nearest = _read_nearest_host(cache, key, cache_ttl)
+        if nearest in hosts:
+            return nearest
+
+    addresses = {}
+    RESOLVER.prefetch(hosts, port)
     for host in hosts:
         try:
-            host_map[host] = socket.getaddrinfo(host, port)[0]
+            addresses[host] = RESOLVER.getaddrinfo(host, port)[0]
         except socket.gaierror:
             continue
 
-    for ttl in range(1, 30):
-        if not host_map:
+    nearest = None
+    for ttl in [None] if mode == NEAREST_RTT else range(1, 30):
+        if not addresses:
             break
-        for host, info in random.sample(host_map.items(), len(host_map)):
-            family, sock_type, proto, _, addr = info
+        nearest, failed = _probe_hosts(addresses, ttl, timeout)
+        if nearest is not None:
+            break
+        for host in failed:
+            del addresses[host]
+
+    if nearest is not None and cache:
+        _write_nearest_host(cache, key, nearest)
+    return nearest
+
+
+def _probe_hosts(addresses, ttl, timeout):
+    """
+    Open non-blocking connections to all hosts at once.
+
+    :param addresses: dict mapping hosts to their getaddrinfo() entry
+    :param ttl: IP TTL of the connections, None for the system default
+    :returns: tuple of the first host accepting its connection, or None, and
+              the set of hosts that cannot be reached with any TTL
+    """
+    poll = select.poll()
+    probes = {}
+    failed = set()
+    try:
+        for host, (family, sock_type, proto, _, addr) in addresses.items():
             s = socket.socket(family, sock_type, proto)
-            s.setsockopt(socket.IPPROTO_IP, socket.IP_TTL, struct.pack("I", ttl))
-            s.settimeout(timeout)
-            try:
-                s.connect(addr)
-            except socket.error as e:
-                if e.errno != errno.EHOSTUNREACH:
-                    del host_map[host]
-                continue
-            except socket.timeout:
+            if ttl is not None:
+                s.setsockopt(socket.IPPROTO_IP, socket.IP_TTL, struct.pack("I", ttl))
+            s.setblocking(0)
+            err = s.connect_ex(addr)
+            if err not in (0, errno.EINPROGRESS):
+                if err != errno.EHOSTUNREACH:
+                    failed.add(host)
+                s.close()
                 continue
-            else:
-                return host
-            finally:
+            probes[s.fileno()] = (host, s)
+            poll.register(s.fileno(), select.POLLOUT)
+
+        deadline = time.time() + timeout
+        while probes:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                break
+
+            for fd, _ in eintr_retry(poll.poll, remaining * 1000):
+                host, s = probes.pop(fd)
+                poll.unregister(fd)
+                err = s.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
                 s.close()
+                if err == 0:
+                    return host, failed
+                # Hosts beyond the TTL answer with EHOSTUNREACH
+                if err != errno.EHOSTUNREACH:
+                    failed.add(host)
+    finally:
+        for _, s in probes.values():
+            s.close()
+
+    return None, failed
+
+
+def _read_nearest_host(path, key, ttl):
+    try:
+        with open(path) as f:
+            entry = json.load(f).get(key)
+    except (IOError, OSError, ValueError, AttributeError):
+        return None
+
+    if entry and time.time() - entry.get("time", 0) < ttl:
+        return entry.get("host")
+    return None
+
+
+def _write_nearest_host(path, key, host):
+    try:
+        with open(path) as f:
+            entries = json.load(f)
+    except (IOError, OSError, ValueError):
+        entries = {}
+
+    now = time.time()
+    entries = dict(
+        (k, v)
+        for k, v in entries.items()
+        if isinstance(v, dict) and now - v.get("time", 0) < 86400
+    )
+    entries[key] = {"host": host, "time": now}
+
+    try:
+        mkdir_p(os.path.dirname(path))
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), prefix=".nearest-")
+        with os.fdopen(fd, "w") as f:
+            json.dump(entries, f)
+        os.rename(tmp, path)
+    except (IOError, OSError):
+        pass
+
+
+def forget_nearest_host(path, host):
+    """
+    Remove the results of :func:`find_nearest_host` naming the given host
+    from its cache, e.g. because it could not be synced from.
+    """
+    try:
+        with open(path) as f:
+            entries = json.load(f)
+    except (IOError, OSError, ValueError):
+        return
+
+    kept = dict(
+        (k, v)
+        for k, v in entries.items()
+        if not isinstance(v, dict) or v.get("host") != host
+    )
+    if len(kept) == len(entries):
+        return
+
+    try:
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), prefix=".nearest-")
+        with os.fdopen(fd, "w") as f:
+            json.dump(kept, f)
+        os.rename(tmp, path)
+    except (IOError, OSError):
+        pass
 
 
 def get_real_username():
@@ -774,6 +1012,95 @@ def ordered_load(
     return yaml.load(stream, OrderedLoader)
 
 
+def iter_json_object(fp, chunk_size=65536):
+    """
+    Iterate over the members of the JSON object read from a file, without
+    loading the whole object.
+
+    Only the current member and a chunk of input are held in memory at a
+    time. Members are yielded in the order of the file, including
+    duplicated keys.
+
+    >>> import io
+    >>> pairs = iter_json_object(io.StringIO(u'{"a": "b", "c\\/d": [1, 2]}'), 4)
+    >>> list(pairs) == [(u'a', u'b'), (u'c/d', [1, 2])]
+    True
+    >>> list(iter_json_object(io.StringIO(u' {} ')))
+    []
+
+    :param fp: File object to read the object from
+    :param chunk_size: Number of characters read at a time
+    :yields: (key, value) tuples
+    :raises: ValueError if the file does not hold a JSON object
+    """
+    stream = _JSONStream(fp, chunk_size)
+    stream.expect("{")
+    if stream.peek() == "}":
+        return
+
+    while True:
+        key = stream.value()
+        stream.expect(":")
+        yield key, stream.value()
+        if stream.expect(",}") == "}":
+            return
+
+
+class _JSONStream(object):
+    """Tokens and values of JSON text read from a file in chunks."""
+
+    SPACE = re.compile(r"\s*")
+
+    def __init__(self, fp, chunk_size):
+        self.fp = fp
+        self.chunk_size = chunk_size
+        self.decoder = json.JSONDecoder()
+        self.buf = ""
+        self.pos = 0
+        self.eof = False
+
+    def _read(self):
+        if self.eof:
+            raise ValueError("Unexpected end of JSON data")
+        # Read at least as much as is buffered, so that values longer than a
+        # chunk only take a logarithmic number of attempts to decode
+        chunk = self.fp.read(max(self.chunk_size, len(self.buf) - self.pos))
+        self.buf = self.buf[self.pos :] + chunk
+        self.pos = 0
+        self.eof = not chunk
+
+    def peek(self):
+        """Next character which is not whitespace."""
+        while True:
+            self.pos = self.SPACE.match(self.buf, self.pos).end()
+            if self.pos < len(self.buf):
+                return self.buf[self.pos]
+            self._read()
+
+    def expect(self, chars):
+        """Consume the next character, which must be one of ``chars``."""
+        char = self.peek()
+        if char not in chars:
+            raise ValueError("Expected one of %r, got %r" % (chars, char))
+        self.pos += 1
+        return char
+
+    def value(self):
+        """Decode the next value."""
+        self.peek()
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buf, self.pos)
+            except ValueError:
+                self._read()
+                continue
+            # A value ending the buffer, such as a number, might continue
+            if end < len(self.buf) or self.eof:
+                self.pos = end
+                return value
+            self._read()
+
+
 class VarDumpJSONEncoder(JSONEncoder):
     """ encode python objects to json """
 
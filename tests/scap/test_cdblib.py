@@ -0,0 +1,79 @@
+from __future__ import absolute_import
+
+import pytest
+
+from scap import cdblib
+
+
+@pytest.fixture
+def cdb_path(tmpdir):
+    path = str(tmpdir.join("test.cdb"))
+    with open(path, "wb") as fp:
+        writer = cdblib.Writer(fp)
+        for i in range(1000):
+            writer.put("key%d" % i, "value%d" % i)
+        writer.put("key1", "again")
+        writer.put("empty", "")
+        writer.finalize()
+    return path
+
+
+def test_reader_lookup(cdb_path):
+    with cdblib.Reader.open(cdb_path) as reader:
+        assert len(reader) == 1002
+        assert reader.get("key42") == b"value42"
+        assert reader[b"key999"] == b"value999"
+        # The first value put wins
+        assert reader["key1"] == b"value1"
+        assert reader["empty"] == b""
+        assert "key0" in reader
+        assert "key1000" not in reader
+        assert reader.get("key1000", b"default") == b"default"
+        with pytest.raises(KeyError):
+            reader["missing"]
+
+
+def test_reader_iteration(cdb_path):
+    with cdblib.Reader.open(cdb_path) as reader:
+        items = reader.items()
+    assert items[:2] == [(b"key0", b"value0"), (b"key1", b"value1")]
+    assert items[-2:] == [(b"key1", b"again"), (b"empty", b"")]
+
+    with open(cdb_path, "rb") as fp:
+        assert cdblib.Reader(fp.read()).items() == items
+
+
+def test_reader_empty_file(tmpdir):
+    path = tmpdir.join("empty.cdb")
+    path.write("")
+    with pytest.raises(OSError):
+        cdblib.Reader.open(str(path))
+
+
+def collide(key):
+    """Hash sending every key to table 0, a third of them with hash 0."""
+    return (len(key) % 3) * 256
+
+
+@pytest.mark.parametrize(
+    "hashfn,expected",
+    [
+        (cdblib.DJB_HASH, "16a18cc768a76f0291691436a0d4c0e2"),
+        (collide, "452503eb147ec1d3f71d6792ae4d4a8f"),
+    ],
+)
+def test_writer_output_unchanged(tmpdir, monkeypatch, hashfn, expected):
+    """Digests of the output of the writer as originally imported."""
+    # Flush records several times
+    monkeypatch.setattr(cdblib.Writer, "BUFFER_SIZE", 4096)
+
+    path = tmpdir.join("test.cdb")
+    with open(str(path), "wb") as fp:
+        writer = cdblib.Writer(fp, hashfn)
+        for i in range(2000):
+            writer.put("key%d" % i, "value%d" % (i * 7))
+        writer.put("key1", "again")
+        writer.put("", "")
+        writer.finalize()
+
+    assert path.computehash("md5") == expected
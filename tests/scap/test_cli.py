@@ -11,7 +11,7 @@ except ImportError:
 
 import pytest
 
-from scap import arg, cli, lock, utils
+from scap import arg, cli, lock, ssh, utils
 
 
 @cli.command("dummy")
@@ -24,6 +24,13 @@ class DummyApp(cli.Application):
         return 666
 
 
+@pytest.fixture(autouse=True)
+def reset_result_sink():
+    """Keep the shared result sink set up by some tests from leaking."""
+    yield
+    ssh.RESULT_SINK = None
+
+
 @pytest.fixture
 def app(name="cmd.exe"):
     """Simple, non-initialized version of the class"""
@@ -2,6 +2,7 @@ from __future__ import absolute_import
 
 import pytest
 import os
+import socket
 from scap import cli
 
 
@@ -123,3 +124,268 @@ def test__check_sync_flag(cmd, mocker, lock_exists):
     else:
         isthere.return_value = False
         cmd._check_sync_flag()
+
+
+@pytest.mark.parametrize("cmd", [["job-results", "--failed"]], indirect=True)
+def test_job_results_shows_latest_run(cmd, tmpdir, capsys):
+    import json
+
+    with open(str(tmpdir.join("job-results.jsonl")), "w") as f:
+        # Records of concurrent runs are interleaved
+        for run, host, status in [
+            ("run1", "mw1", 1),
+            ("run2", "mw2", 255),
+            ("run1", "mw3", 1),
+            ("run2", "mw1", 0),
+        ]:
+            record = {"run": run, "job": "sync-apaches", "host": host}
+            record.update({"status": status, "duration": 1.5})
+            f.write(json.dumps(record) + "\n")
+        f.write('{"run": "run2", "truncated\n')
+
+    cmd.config["log_dir"] = str(tmpdir)
+    assert cmd.main() == 0
+
+    out = capsys.readouterr()[0].splitlines()
+    assert len(out) == 1
+    assert out[0].split() == ["run2", "sync-apaches", "mw2", "255", "1.5s"]
+
+
+@pytest.mark.parametrize("cmd", [["audit", "--depth", "1"]], indirect=True)
+def test_audit_lists_divergent_subtrees(cmd, mocker, capsys):
+    import json
+    from scap import main, ssh
+
+    expected = {"": "root", "php-1.0": "a", "wmf-config": "b"}
+    drifted = {"": "other", "php-1.0": "a", "wmf-config": "c"}
+    mocker.patch.object(main.tasks, "tree_hashes", return_value=expected)
+    mocker.patch.object(
+        main.targets, "get", return_value=mocker.Mock(all=["mw1", "mw2", "mw3"])
+    )
+    mocker.patch.object(cmd, "get_keyholder_key", return_value=None)
+    mocker.patch.object(ssh.Job, "exclude_hosts")
+    mocker.patch.object(
+        ssh.Job,
+        "run_with_output",
+        return_value=[
+            ("mw1", 0, "noise\n" + json.dumps({"tree": expected})),
+            ("mw2", 0, json.dumps({"tree": drifted})),
+            ("mw3", 255, "ssh: connect to host mw3: Connection refused"),
+        ],
+    )
+
+    assert cmd.main() == 1
+    assert capsys.readouterr()[0].splitlines() == ["mw2: wmf-config"]
+
+
+@pytest.mark.parametrize("cmd", [["sync-world"]], indirect=True)
+def test_sync_tree_falls_back_to_ancestors(cmd, mocker):
+    from scap import ssh
+
+    cmd.config["sync_tree_width"] = 1
+    cmd.config["ssh_host_locations"] = None
+    commands = {}
+
+    def run_with_status():
+        for host in job.hosts.call_args[0][0]:
+            commands[host] = job.command.call_args[0][0](host)
+            yield host, 1 if host == "mw1" else 0
+
+    job = mocker.Mock(spec=ssh.Job)
+    job.get_hosts.return_value = ["mw1", "mw2", "mw3"]
+    job.run_with_status.side_effect = run_with_status
+
+    assert cmd._sync_tree(job, ["proxy1"]) == (2, 1)
+    assert commands["mw1"][-1] == "proxy1"
+    # mw2 was to pull from mw1, which failed
+    assert commands["mw2"][-1] == "proxy1"
+    assert commands["mw3"][-1] == "mw2"
+
+
+@pytest.mark.parametrize("cmd", [["sync-world"]], indirect=True)
+def test_sync_after_proxies(cmd, mocker):
+    from scap import ssh
+
+    cmd.config["ssh_host_locations"] = None
+    commands = {}
+
+    def run_with_status():
+        # proxy1 fails before its apaches are dispatched
+        for host in ["proxy1", "proxy2", "mw1.eqiad", "mw2.eqiad", "mw3.codfw"]:
+            commands[host] = job.command.call_args[0][0](host)
+            yield host, 1 if host == "proxy1" else 0
+
+    job = mocker.Mock(spec=ssh.Job)
+    job.get_hosts.return_value = ["mw1.eqiad", "mw2.eqiad", "mw3.codfw"]
+    job.run_with_status.side_effect = run_with_status
+
+    cmd._sync_after_proxies(job, ["proxy1", "proxy2"], ["proxy-command"])
+
+    assignment = job.after.call_args[0][0]
+    assert sorted(assignment.values()) == ["proxy1", "proxy1", "proxy2"]
+    assert commands["proxy1"] == ["proxy-command"]
+    for host, proxy in assignment.items():
+        assert commands[host][-1] == "proxy2"
+    assert cmd.soft_errors
+
+
+@pytest.mark.parametrize("cmd", [["sync-world", "--resume"]], indirect=True)
+def test_resume_failed_hosts(cmd, mocker):
+    from scap import main, ssh, sync_state
+
+    mocker.patch.object(cmd, "get_master_list", return_value=["deploy1"])
+    mocker.patch.object(cmd, "_get_proxy_list", return_value=["proxy1", "proxy2"])
+    rebuild_cdbs = mocker.patch.object(cmd, "_rebuild_cdbs")
+    invalidate_opcache = mocker.patch.object(cmd, "_invalidate_opcache")
+    sync_wikiversions = mocker.patch.object(
+        main.tasks, "sync_wikiversions", return_value=(2, 0)
+    )
+
+    jobs = []
+    job_class = ssh.Job
+
+    def make_job(hosts, **kwargs):
+        job = mocker.Mock(spec=job_class)
+        job.run_with_status.return_value = [(host, 0) for host in hosts]
+        job.run.return_value = (len(hosts), 0)
+        jobs.append((hosts, job))
+        return job
+
+    mocker.patch.object(main.ssh, "Job", side_effect=make_job)
+
+    state = sync_state.SyncState("sync-state.json")
+    state.results = {
+        sync_state.SYNC: {"proxy1": 1, "proxy2": 0, "mw1": 0, "mw2": 255},
+        sync_state.CDB_REBUILD: {"proxy1": 0, "proxy2": 0, "mw1": 1, "mw2": 0},
+        sync_state.WIKIVERSIONS: {"proxy1": 0, "proxy2": 0, "mw1": 0, "mw2": 0},
+    }
+    cmd._resume(state)
+
+    (proxies, proxy_job), (apaches, apache_job) = jobs
+    assert proxies == ["proxy1"]
+    assert proxy_job.command.call_args[0][0][-2:] == ["deploy1", socket.getfqdn()]
+    assert apaches == ["mw2"]
+    assert apache_job.command.call_args[0][0][-2:] == ["proxy1", "proxy2"]
+
+    rebuild_cdbs.assert_called_once_with(["mw1", "mw2", "proxy1"])
+    assert sync_wikiversions.call_args[0][0] == ["mw1", "mw2", "proxy1"]
+    invalidate_opcache.assert_called_once_with(["mw1", "mw2", "proxy1"])
+    assert not cmd.soft_errors
+
+
+@pytest.mark.parametrize("cmd", [["sync-world", "--resume"]], indirect=True)
+def test_resume_requires_completed_sync_world(cmd, mocker, tmpdir):
+    from scap import sync_state
+
+    cmd.config["log_dir"] = str(tmpdir)
+    mocker.patch.object(cmd, "_assert_auth_sock")
+    assert cmd.main() == 1
+
+    state = sync_state.SyncState(cmd._sync_state_path(), resumable=True)
+    state.results = {sync_state.SYNC: {"mw1": 1}}
+    state.save()
+    assert cmd.main() == 1
+
+    state.finished = True
+    state.results = {sync_state.SYNC: {"mw1": 0}}
+    state.save()
+    assert cmd.main() == 0
+
+    # An interrupted resume can be resumed again
+    state.finished = False
+    state.resumed = "run-1"
+    state.save()
+    assert cmd.main() == 0
+
+
+@pytest.mark.parametrize("cmd", [["sync-file", "wmf-config"]], indirect=True)
+def test_sync_file_bundle_command(cmd):
+    cmd.include = "wmf-config/***"
+    assert "--include" in cmd._apache_sync_command(["proxy1"])
+
+    cmd.bundle = "abc123"
+    sync_cmd = cmd._apache_sync_command(["proxy1"])
+    assert "--include" not in sync_cmd
+    assert sync_cmd[-3:] == ["--bundle", "abc123", "proxy1"]
+
+
+@pytest.mark.parametrize(
+    "cmd",
+    [
+        [
+            "sync-file",
+            "-f",
+            "wmf-config/a.php",
+            "-f",
+            "wmf-config/b.php",
+            "-f",
+            "docroot",
+        ]
+    ],
+    indirect=True,
+)
+def test_sync_file_multiple_paths(cmd, mocker, tmpdir):
+    from scap import main
+
+    stage = tmpdir.join("stage")
+    stage.join("wmf-config", "a.php").write("<?php", ensure=True)
+    stage.join("wmf-config", "b.php").write("<?php", ensure=True)
+    stage.join("docroot", "index.php").write("<?php", ensure=True)
+    cmd.config["stage_dir"] = str(stage)
+    lint = mocker.patch.object(main.lint, "check_valid_syntax")
+
+    cmd.files = cmd._get_files()
+    cmd._before_cluster_sync()
+
+    assert cmd.files == ["wmf-config/a.php", "wmf-config/b.php", "docroot"]
+    lint.assert_called_once_with(
+        [str(stage.join(path)) for path in cmd.files], mocker.ANY
+    )
+    assert cmd._proxy_sync_command()[4:] == [
+        "--include",
+        "wmf-config",
+        "--include",
+        "wmf-config/a.php",
+        "--include",
+        "wmf-config/b.php",
+        "--include",
+        "docroot",
+        "--include",
+        "docroot/***",
+    ]
+
+
+@pytest.mark.parametrize(
+    "cmd", [["sync-file", "--files-from", "-", "fix", "things"]], indirect=True
+)
+def test_sync_file_files_from(cmd, mocker):
+    from scap import main
+
+    mocker.patch.object(main.sys, "stdin", mocker.Mock())
+    main.sys.stdin.read.return_value = "wmf-config/a.php\n\nwmf-config/a.php\nb\n"
+    cmd._process_arguments(cmd.arguments, [])
+
+    assert cmd._get_files() == ["wmf-config/a.php", "b"]
+    assert cmd.arguments.message == "fix things"
+
+
+@pytest.mark.parametrize(
+    "cmd", [["sync-file", "-f", "a.php", "php-1.36", "backport"]], indirect=True
+)
+def test_sync_file_extra_files_message(cmd, tmpdir):
+    # Positional arguments are never paths once --file is used
+    stage = tmpdir.join("stage")
+    stage.join("a.php").write("<?php", ensure=True)
+    stage.join("php-1.36").ensure(dir=True)
+    cmd.config["stage_dir"] = str(stage)
+    cmd._process_arguments(cmd.arguments, [])
+
+    assert cmd._get_files() == ["a.php"]
+    assert cmd.arguments.message == "php-1.36 backport"
+
+
+@pytest.mark.parametrize("cmd", [["sync-file"]], indirect=True)
+def test_sync_file_requires_path(cmd):
+    with pytest.raises(SystemExit) as exc:
+        cmd.main()
+    assert exc.value.code == 2
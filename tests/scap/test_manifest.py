@@ -0,0 +1,71 @@
+from __future__ import absolute_import
+
+import os
+
+from scap import manifest
+
+
+def make_tree(tmpdir):
+    tmpdir.join("wmf-config", "CommonSettings.php").write("<?php", ensure=True)
+    tmpdir.join("php-1.0", "index.php").write("<?php echo 1;", ensure=True)
+    tmpdir.join("php-1.0", "cache", "l10n", "l10n_cache-en.cdb").write(
+        "cdb", ensure=True
+    )
+    tmpdir.join("php-1.0", ".git", "HEAD").write("ref", ensure=True)
+    tmpdir.join("php").mksymlinkto("php-1.0")
+    return str(tmpdir)
+
+
+def test_build_skips_excluded_paths(tmpdir):
+    files = manifest.build(make_tree(tmpdir))
+
+    assert sorted(files) == [
+        "php",
+        "php-1.0/index.php",
+        "wmf-config/CommonSettings.php",
+    ]
+    assert files["php"][2] == "->php-1.0"
+
+
+def test_build_reuses_unchanged_hashes(tmpdir, mocker):
+    root = make_tree(tmpdir)
+    previous = manifest.build(root)
+
+    digest = mocker.patch.object(manifest, "file_digest", return_value="new")
+    os.utime(os.path.join(root, "php-1.0", "index.php"), (1, 1))
+
+    files = manifest.build(root, previous)
+
+    digest.assert_called_once_with(os.path.join(root, "php-1.0", "index.php"))
+    assert manifest.diff(previous, files) == (["php-1.0/index.php"], [])
+
+
+def test_save_and_load(tmpdir):
+    files = manifest.build(make_tree(tmpdir))
+    path = str(tmpdir.join(manifest.MANIFEST_NAME))
+
+    manifest.save(files, path)
+
+    assert manifest.load(path) == files
+    # The manifest does not list itself
+    assert manifest.build(str(tmpdir)) == files
+
+
+def test_load_unusable(tmpdir):
+    assert manifest.load(str(tmpdir.join("missing"))) is None
+
+    path = tmpdir.join("corrupt")
+    path.write('{"version": 1}\n["truncated"\n')
+    assert manifest.load(str(path)) is None
+
+
+def test_tree_locates_changes(tmpdir):
+    files = manifest.build(make_tree(tmpdir))
+    before = manifest.tree(files)
+
+    files["php-1.0/index.php"] = (1, 1, "changed")
+    after = manifest.tree(files)
+
+    assert before[""] != after[""]
+    assert before["wmf-config"] == after["wmf-config"]
+    assert manifest.divergent(before, after) == ["php-1.0"]
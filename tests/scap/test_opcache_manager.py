@@ -111,3 +111,13 @@ def test_invalidate_all(om, mocker):
     assert om.invalidate_all(config, "test.php") == {}
     om.invalidate.assert_any_call(["host1", "host2"], "test.php")
     om.invalidate.assert_any_call(["host4", "host3"], "test.php")
+
+
+def test_invalidate_host_files(om, mocker):
+    """Test that a list of files is invalidated in a single pass"""
+    req(mocker, 200)
+    assert om._invalidate_host("foo1.example.com", ["a.php", "b"]) == (True, None)
+    assert [c[1]["params"] for c in requests.get.call_args_list] == [
+        {"file": "a.php"},
+        {"file": "b"},
+    ]
@@ -0,0 +1,101 @@
+from __future__ import absolute_import
+
+import pytest
+
+from scap import schedule
+
+
+def test_interleave_spreads_locations():
+    hosts = ["mw%d.eqiad.wmnet" % i for i in range(6)]
+    hosts += ["mw%d.codfw.wmnet" % i for i in range(3)]
+
+    ordered = schedule.Interleave(seed=0).order(hosts)
+
+    assert sorted(ordered) == sorted(hosts)
+    locations = [schedule.locality(host) for host in ordered]
+    # No two codfw hosts in a row, and no more than two eqiad hosts
+    for prev, cur, nxt in zip(locations, locations[1:], locations[2:]):
+        assert len(set([prev, cur, nxt])) == 2
+
+
+def test_interleave_uses_known_locations():
+    locations = {"a": "rack1", "b": "rack1", "c": "rack2", "d": "rack2"}
+    ordered = schedule.Interleave(locations, seed=0).order(["a", "b", "c", "d"])
+    assert [locations[h] for h in ordered][:2] in (
+        ["rack1", "rack2"],
+        ["rack2", "rack1"],
+    )
+
+
+def test_longest_first_persists_durations(tmpdir):
+    path = str(tmpdir.join("durations", "job.json"))
+
+    strategy = schedule.LongestFirst(path)
+    strategy.record("fast", 1.0, 0)
+    strategy.record("slow", 10.0, 0)
+    strategy.record("broken", 100.0, 1)
+    strategy.save()
+
+    strategy = schedule.LongestFirst(path)
+    assert strategy.order(["fast", "slow", "new"]) == ["new", "slow", "fast"]
+
+    # Durations are averaged across runs
+    strategy.record("slow", 2.0, 0)
+    assert strategy.durations["slow"] == 6.0
+
+
+def test_longest_first_ignores_corrupt_history(tmpdir):
+    path = tmpdir.join("job.json")
+    path.write("{not json")
+    strategy = schedule.LongestFirst(str(path))
+    assert strategy.durations == {}
+
+
+def test_get_rejects_unknown_strategy(tmpdir):
+    assert isinstance(schedule.get("job", str(tmpdir)), schedule.Shuffle)
+    with pytest.raises(ValueError):
+        schedule.get("job", str(tmpdir), "fastest")
+
+
+def test_distribution_tree_prefers_local_parents():
+    sources = ["proxy.eqiad.wmnet", "proxy.codfw.wmnet"]
+    hosts = ["mw%d.eqiad.wmnet" % i for i in range(10)]
+    hosts += ["mw%d.codfw.wmnet" % i for i in range(4)]
+
+    levels = schedule.distribution_tree(sources, hosts, 3)
+
+    assert sorted(h for level in levels for h in level) == sorted(hosts)
+    served = {}
+    for depth, level in enumerate(levels):
+        parents = sources if depth == 0 else list(levels[depth - 1])
+        for host, parent in level.items():
+            assert parent in parents
+            served[parent] = served.get(parent, 0) + 1
+            if schedule.locality(host) == "codfw.wmnet":
+                assert schedule.locality(parent) == "codfw.wmnet"
+    assert max(served.values()) <= 3
+    assert [len(level) for level in levels] == [6, 8]
+
+
+def test_distribution_tree_rejects_empty_width():
+    with pytest.raises(ValueError):
+        schedule.distribution_tree(["proxy"], ["mw1"], 0)
+
+
+def test_proxy_ring_weights_and_stability():
+    hosts = ["mw%d" % i for i in range(3000)]
+    ring = schedule.ProxyRing(["p1", "p2", "p3"], {"p3": 2})
+
+    load = {}
+    before = {}
+    for host in hosts:
+        proxy = ring.lookup(host)[0]
+        before[host] = proxy
+        load[proxy] = load.get(proxy, 0) + 1
+    assert 1.5 < load["p3"] / float(load["p1"]) < 2.5
+
+    # Removing a proxy only moves the hosts it served
+    ring = schedule.ProxyRing(["p1", "p3"], {"p3": 2})
+    for host in hosts:
+        if before[host] != "p2":
+            assert ring.lookup(host)[0] == before[host]
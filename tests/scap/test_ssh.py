@@ -1,9 +1,13 @@
 from __future__ import absolute_import
 
 import logging
+import os
+import time
 import unittest
 from io import StringIO
 
+import pytest
+
 from scap import ssh
 
 
@@ -48,3 +52,429 @@ class JSONOutputHandlerTest(unittest.TestCase):
     def tearDown(self):
         self.logger.removeHandler(self.log_handler)
         self.log_handler.close()
+
+
+def fake_ssh(host, command, **kwargs):
+    """Stand-in for ssh.SSH that runs the command locally."""
+    return ["/bin/sh", "-c", "echo %s; exit %s" % (host, host.split("-")[1])]
+
+
+def test_cluster_ssh_reaps_all_hosts(mocker):
+    mocker.patch.object(ssh, "SSH", side_effect=fake_ssh)
+    hosts = ["host-0", "host-1", "host-2", "host-0"]
+
+    results = {}
+    for host, status, ohandler in ssh.cluster_ssh(hosts, "true", limit=2):
+        results[host] = (status, ohandler.output)
+
+    assert results == {
+        "host-0": (0, "host-0\n"),
+        "host-1": (1, "host-1\n"),
+        "host-2": (2, "host-2\n"),
+    }
+
+
+def test_cluster_ssh_restores_sigchld_handler(mocker):
+    import signal
+
+    mocker.patch.object(ssh, "SSH", side_effect=fake_ssh)
+    before = signal.getsignal(signal.SIGCHLD)
+
+    list(ssh.cluster_ssh(["host-0"], "true"))
+
+    assert signal.getsignal(signal.SIGCHLD) == before
+
+
+def test_connection_pool_counts_hits_and_misses(mocker):
+    call = mocker.patch("subprocess.call")
+    pool = ssh.ConnectionPool(persist=30)
+    try:
+        options = pool.options("host1", "deployer")
+        assert options["control_master"] == "auto"
+        assert options["control_persist"] == "30"
+        assert pool.misses == 1 and pool.hits == 0
+
+        # Simulate the master connection having been established
+        open(options["control_path"], "w").close()
+        assert pool.options("host1", "deployer") == options
+        assert pool.hits == 1
+
+        assert pool.options("host2", "deployer") != options
+        assert pool.misses == 2
+
+        cmd = ssh.SSH("host1", ["true"], user="deployer", **options)
+        assert "-oControlPath=%s" % options["control_path"] in cmd
+    finally:
+        control_dir = os.path.dirname(options["control_path"])
+        pool.close()
+
+    assert not os.path.exists(control_dir)
+    # Only the established master is asked to exit
+    assert call.call_count == 1
+    assert "-Oexit" in call.call_args[0][0]
+
+
+def test_output_buffer_keeps_head_and_tail():
+    buf = ssh.OutputBuffer(limit=8)
+    for chunk in [b"abc", b"defgh", b"ijklmnopq", b"rstuvwxyz"]:
+        buf.write(chunk)
+
+    assert len(buf) == 8
+    assert buf.getvalue() == b"abcd\n[... 18 bytes omitted ...]\nwxyz"
+
+
+def test_output_buffer_under_limit_is_verbatim():
+    buf = ssh.OutputBuffer(limit=64)
+    buf.write(b"one\n")
+    buf.write(b"two\n")
+    assert buf.getvalue() == b"one\ntwo\n"
+
+
+def test_output_handler_spills_full_output(tmpdir):
+    handler = ssh.OutputHandler("host1", limit=4, spill_dir=str(tmpdir))
+    handler.accept(b"0123456789")
+    handler.close()
+
+    assert handler.output == "01\n[... 6 bytes omitted ...]\n89"
+    assert tmpdir.join("host1.log").read() == "0123456789"
+
+
+def _complete_round(concurrency, duration, status=0):
+    started = time.time()
+    for _ in range(concurrency.limit):
+        concurrency.record(started, duration, status)
+
+
+def test_adaptive_concurrency_grows_up_to_ceiling():
+    concurrency = ssh.AdaptiveConcurrency(40, initial=5, increase=3)
+
+    _complete_round(concurrency, 1.0)
+    assert concurrency.limit == 10
+    _complete_round(concurrency, 1.0)
+    assert concurrency.limit == 20
+    _complete_round(concurrency, 1.0)
+    assert concurrency.limit == 40
+    _complete_round(concurrency, 1.0)
+    assert concurrency.limit == 40
+
+
+def test_adaptive_concurrency_backs_off(mocker):
+    stats = mocker.MagicMock()
+    concurrency = ssh.AdaptiveConcurrency(80, initial=20, increase=3, stats=stats)
+
+    _complete_round(concurrency, 1.0)
+    assert concurrency.limit == 40
+    stats.gauge.assert_called_with("scap.concurrency.ssh", 40)
+
+    # Latency rising past the tolerance halves the window
+    _complete_round(concurrency, 2.0)
+    assert concurrency.limit == 20
+    stats.increment.assert_called_with("scap.concurrency.ssh.decrease")
+
+    # Growth is additive after the first slowdown
+    _complete_round(concurrency, 1.0)
+    assert concurrency.limit == 23
+
+    # So is a connection failure, however fast
+    started = time.time()
+    for _ in range(22):
+        concurrency.record(started, 0.5, 0)
+    concurrency.record(started, 0.5, ssh.CONNECTION_FAILURE)
+    assert concurrency.limit == 11
+
+
+def test_adaptive_concurrency_ignores_previous_window():
+    concurrency = ssh.AdaptiveConcurrency(80, initial=2)
+    started = time.time()
+    concurrency.record(started, 1.0, 0)
+    concurrency.record(started, 1.0, 0)
+    assert concurrency.limit == 4
+
+    # Hosts started before the adjustment do not count toward the new round
+    for _ in range(4):
+        concurrency.record(started - 1, 10.0, ssh.CONNECTION_FAILURE)
+    assert concurrency.limit == 4
+
+
+def test_cluster_ssh_adaptive_concurrency(mocker):
+    mocker.patch.object(ssh, "SSH", side_effect=fake_ssh)
+    hosts = ["host%d-0" % i for i in range(12)]
+    concurrency = ssh.AdaptiveConcurrency(8, initial=1)
+
+    results = list(ssh.cluster_ssh(hosts, "true", concurrency=concurrency))
+
+    assert sorted(host for host, _, _ in results) == sorted(hosts)
+    assert concurrency.baseline is not None
+    assert concurrency.limit <= 8
+
+
+def slow_ssh(host, command, **kwargs):
+    """Stand-in for ssh.SSH that hangs on hosts named slow*."""
+    if host.startswith("slow"):
+        return ["/bin/sh", "-c", "echo %s; exec sleep 5" % host]
+    return fake_ssh(host, command)
+
+
+def test_cluster_ssh_kills_hosts_past_deadline(mocker):
+    mocker.patch.object(ssh, "SSH", side_effect=slow_ssh)
+
+    start = time.time()
+    results = dict(
+        (host, status)
+        for host, status, _ in ssh.cluster_ssh(
+            ["host-0", "slow-0"], "true", timeout=0.3
+        )
+    )
+
+    assert results == {"host-0": 0, "slow-0": ssh.TIMEOUT}
+    assert time.time() - start < 3
+
+
+def test_cluster_ssh_retries_connection_failures(mocker):
+    attempts = []
+
+    def flaky_ssh(host, command, **kwargs):
+        attempts.append(host)
+        status = ssh.CONNECTION_FAILURE if len(attempts) < 3 else 0
+        return ["/bin/sh", "-c", "exit %d" % status]
+
+    mocker.patch.object(ssh, "SSH", side_effect=flaky_ssh)
+
+    results = list(ssh.cluster_ssh(["host-0"], "true", retries=2, backoff=0.01))
+    assert [(host, status) for host, status, _ in results] == [("host-0", 0)]
+    assert attempts == ["host-0"] * 3
+
+    # Retries are bounded
+    del attempts[:]
+    results = list(ssh.cluster_ssh(["host-0"], "true", retries=1, backoff=0.01))
+    assert results[0][1] == ssh.CONNECTION_FAILURE
+    assert len(attempts) == 2
+
+
+def test_cluster_ssh_retries_stragglers(mocker):
+    spawned = []
+
+    def straggling_ssh(host, command, **kwargs):
+        spawned.append(host)
+        if host == "slow-0" and spawned.count(host) == 1:
+            return slow_ssh(host, command)
+        return fake_ssh(host, command)
+
+    mocker.patch.object(ssh, "SSH", side_effect=straggling_ssh)
+    straggler = ssh.StragglerPolicy(factor=3.0, min_samples=2, kill=True)
+    hosts = ["a-0", "b-0", "c-0", "slow-0"]
+
+    start = time.time()
+    results = dict(
+        (host, status)
+        for host, status, _ in ssh.cluster_ssh(
+            hosts, "true", straggler=straggler, retries=1, backoff=0.01
+        )
+    )
+
+    assert results == dict((host, 0) for host in hosts)
+    assert straggler.stragglers == ["slow-0"]
+    assert spawned.count("slow-0") == 2
+    assert time.time() - start < 3
+
+
+def test_straggler_policy_threshold():
+    straggler = ssh.StragglerPolicy(factor=2.0, min_samples=3)
+    straggler.record(1.0)
+    straggler.record(4.0)
+    assert straggler.threshold() is None
+
+    straggler.record(2.0)
+    assert straggler.median() == 2.0
+    assert straggler.threshold() == 4.0
+
+
+def test_local_transport_simulates_hosts():
+    transport = ssh.LocalTransport(output=100, failure_rate=0.5, seed=1)
+    hosts = ["host%d" % i for i in range(20)]
+
+    results = list(ssh.cluster_ssh(hosts, "true", limit=5, transport=transport))
+
+    assert sorted(host for host, _, _ in results) == sorted(hosts)
+    assert all(len(ohandler.output) == 100 for _, _, ohandler in results)
+    failed = [host for host, status, _ in results if status == 1]
+    assert 0 < len(failed) < len(hosts)
+
+
+def test_job_dispatches_in_scheduled_order(mocker):
+    mocker.patch.object(ssh, "SSH", side_effect=fake_ssh)
+    strategy = mocker.MagicMock()
+    strategy.order.side_effect = lambda hosts: list(reversed(hosts))
+    hosts = ["host%d-0" % i for i in range(5)]
+
+    job = ssh.Job(hosts, command="true").schedule(strategy)
+    job.progress(mocker.MagicMock())
+    completed = [host for host, _ in job.run_with_status(batch_size=1)]
+
+    assert completed == list(reversed(hosts))
+    assert strategy.record.call_count == 5
+    strategy.save.assert_called_once_with()
+
+
+class ShellTransport(ssh.Transport):
+    """Run the remote command with the local shell."""
+
+    def command(self, host, command, **kwargs):
+        return ["/bin/sh", "-c", " ".join(command)]
+
+
+def test_cluster_ssh_per_host_command():
+    hosts = ["host1", "host2"]
+    command = lambda host: "echo pulling from parent-of-%s" % host  # noqa: E731
+
+    results = ssh.cluster_ssh(hosts, command, transport=ShellTransport())
+
+    outputs = dict((host, ohandler.output) for host, _, ohandler in results)
+    assert outputs == {
+        "host1": "pulling from parent-of-host1\n",
+        "host2": "pulling from parent-of-host2\n",
+    }
+
+
+def test_job_logs_per_host_command(mocker):
+    job = ssh.Job(["host1"], transport=ShellTransport())
+    job.command(lambda host: "exit 3 # %s" % host)
+    job.progress(mocker.MagicMock())
+    warning = mocker.patch.object(job.get_logger(), "warning")
+
+    assert job.run() == (0, 1)
+    assert warning.call_args[0][1:3] == ("exit 3 # host1", "host1")
+
+
+def test_cluster_ssh_waits_for_dependencies():
+    after = {"apache1": "proxy1", "apache2": "proxy2", "apache3": "proxy1"}
+    hosts = ["apache1", "apache2", "apache3", "proxy1", "proxy2"]
+    transport = ssh.LocalTransport(latency=0.05, seed=0)
+
+    completed = [
+        host
+        for host, _, _ in ssh.cluster_ssh(
+            hosts, "true", limit=2, transport=transport, after=after
+        )
+    ]
+
+    assert sorted(completed) == sorted(hosts)
+    for host, proxy in after.items():
+        assert completed.index(proxy) < completed.index(host)
+
+
+def test_cluster_ssh_rejects_circular_dependencies():
+    with pytest.raises(ValueError):
+        list(ssh.cluster_ssh(["a", "b"], "true", after={"a": "b", "b": "a"}))
+
+
+def test_job_pipeline_reports_steps(mocker):
+    steps = [
+        ("first", "echo one"),
+        ("second", ["sh", "-c", "echo two; exit 3"]),
+        ("third", "echo three"),
+    ]
+    job = ssh.Job(["host1"], transport=ShellTransport()).pipeline(steps)
+    job.progress(mocker.MagicMock())
+
+    [(host, status, results)] = list(job.run_pipeline())
+
+    assert host == "host1"
+    assert status == 3
+    assert [(r.name, r.status) for r in results] == [("first", 0), ("second", 3)]
+    assert all(r.duration >= 0 for r in results)
+
+    # Carry on after failures
+    job.pipeline(steps, stop_on_failure=False)
+    [(host, status, results)] = list(job.run_pipeline())
+    assert status == 3
+    assert [r.status for r in results] == [0, 3, 0]
+
+
+def test_step_output_handler_strips_markers():
+    handler = ssh.StepOutputHandler("host1", names=["a", "b"])
+    handler.accept(b"hello\n%s0 0 1500\npartial" % ssh.STEP_MARKER.encode())
+    handler.accept(b"%s1 2 20\n" % ssh.STEP_MARKER.encode())
+
+    assert handler.output == "hello\npartial\n"
+    assert handler.steps == [
+        ssh.StepResult("a", 0, 1.5),
+        ssh.StepResult("b", 2, 0.02),
+    ]
+
+
+def test_result_sink_streams_records(mocker, tmpdir):
+    mocker.patch.object(ssh, "SSH", side_effect=fake_ssh)
+    path = str(tmpdir.join("log", "job-results.jsonl"))
+    sink = ssh.ResultSink(path, run="run1")
+
+    job = ssh.Job(["host-0", "host-2"], command="true").results(sink)
+    reporter = mocker.MagicMock()
+    reporter.name = "test-job"
+    job.progress(reporter)
+    assert job.run() == (1, 1)
+    sink.close()
+    reporter.add_failure.assert_called_once_with()
+
+    records = dict((r["host"], r) for r in ssh.read_results(path))
+    assert sorted(records) == ["host-0", "host-2"]
+    assert records["host-0"]["status"] == 0
+    assert records["host-0"]["job"] == "test-job"
+    assert records["host-0"]["run"] == "run1"
+    assert records["host-0"]["bytes"] == len("host-0\n")
+    assert "output" not in records["host-0"]
+    assert records["host-2"]["status"] == 2
+    assert records["host-2"]["output"] == "host-2\n"
+    assert records["host-0"]["digest"] != records["host-2"]["digest"]
+
+
+def test_result_sink_disables_itself_on_errors(tmpdir):
+    blocker = tmpdir.join("file")
+    blocker.write("")
+    sink = ssh.ResultSink(str(blocker.join("results.jsonl")))
+    handler = ssh.OutputHandler("host1")
+
+    assert not sink.record("job", "host1", 0, handler)
+    assert not sink.record("job", "host1", 0, handler)
+    assert sink._disabled
+
+
+def test_job_logs_output_not_recorded(mocker, tmpdir):
+    blocker = tmpdir.join("file")
+    blocker.write("")
+    sink = ssh.ResultSink(str(blocker.join("results.jsonl")), run="run1")
+    job = ssh.Job(["host1"], command="echo oops; exit 1", transport=ShellTransport())
+    job.results(sink).progress(mocker.MagicMock())
+    warning = mocker.patch.object(job.get_logger(), "warning")
+
+    assert job.run() == (0, 1)
+    assert "job-results" not in warning.call_args[0][0]
+    assert warning.call_args[0][-1] == "oops\n"
+
+
+def test_result_sink_rotates(tmpdir):
+    path = str(tmpdir.join("job-results.jsonl"))
+    handler = ssh.OutputHandler("host1")
+
+    for run in ["run1", "run2", "run3"]:
+        sink = ssh.ResultSink(path, run=run, max_size=1)
+        sink.record("job", "host1", 0, handler)
+        sink.record("job", "host2", 0, handler)
+        sink.close()
+
+    # Runs are not split between files, and only one rotated file is kept
+    assert len(tmpdir.join("job-results.jsonl").readlines()) == 2
+    assert [r["run"] for r in ssh.read_results(path)] == ["run2"] * 2 + ["run3"] * 2
+
+
+def test_job_exclude_hosts_by_fqdn(mocker):
+    fqdns = {"mw1": "mw1.eqiad.wmnet", "mw2": "mw2.eqiad.wmnet"}
+    mocker.patch("socket.getfqdn", side_effect=lambda h: fqdns.get(h, h))
+    mocker.patch.object(ssh.utils, "RESOLVER", ssh.utils.Resolver())
+
+    job = ssh.Job(["mw1.eqiad.wmnet", "mw2.eqiad.wmnet", "mw3.eqiad.wmnet"])
+    job.exclude_hosts(["mw1"])
+    job.exclude_hosts(["mw2.eqiad.wmnet"])
+
+    assert job._hosts == ["mw3.eqiad.wmnet"]
+    assert ssh.utils.RESOLVER.hits > 0
@@ -0,0 +1,100 @@
+from __future__ import absolute_import
+
+from scap import ssh
+from scap import sync_state
+
+
+def test_records_phases_and_forwards_results(tmpdir, mocker):
+    path = str(tmpdir.join("sync-state.json"))
+    sink = mocker.Mock(run="run-1")
+    mocker.patch.object(ssh, "RESULT_SINK", sink)
+
+    ohandler = mocker.Mock(spec=["output"])
+    pipeline = ssh.StepOutputHandler(
+        "mw2", names=["scap-cdb-rebuild", "sync_wikiversions"]
+    )
+    pipeline.steps = [ssh.StepResult("scap-cdb-rebuild", 0, 1.0)]
+
+    with sync_state.SyncState(path, resumable=True, message="msg") as state:
+        assert ssh.RESULT_SINK is state
+        assert not sync_state.load(path).finished
+
+        state.record("sync-masters", "deploy2", 0, ohandler)
+        state.record("sync-pull-masters", "deploy2", 1, ohandler)
+        state.record("sync-apaches", "mw1", 0, ohandler)
+        state.record("sync-apaches", "mw2", 0, ohandler)
+        state.record("php-fpm-restart", "mw1", 1, ohandler)
+        state.record("scap-cdb-rebuild+sync_wikiversions", "mw2", 255, pipeline)
+
+        # Whether the forwarded sink wrote the result is passed on
+        sink.record.return_value = False
+        assert not state.record("sync-apaches", "mw1", 0, ohandler)
+
+    assert ssh.RESULT_SINK is sink
+    assert sink.record.call_count == 7
+
+    loaded = sync_state.load(path)
+    assert loaded.finished
+    assert loaded.resumable
+    assert loaded.run == "run-1"
+    assert loaded.message == "msg"
+    assert loaded.results == {
+        sync_state.SYNC: {"deploy2": 1, "mw1": 0, "mw2": 0},
+        sync_state.CDB_REBUILD: {"mw2": 0},
+        sync_state.WIKIVERSIONS: {"mw2": 255},
+    }
+    assert loaded.failed() == {
+        "deploy2": sync_state.SYNC,
+        "mw2": sync_state.WIKIVERSIONS,
+    }
+
+
+def test_interrupted_sync_is_not_finished(tmpdir):
+    path = str(tmpdir.join("sync-state.json"))
+
+    try:
+        with sync_state.SyncState(path):
+            raise KeyboardInterrupt()
+    except KeyboardInterrupt:
+        pass
+
+    assert not sync_state.load(path).finished
+
+
+def test_interrupted_resume_can_be_resumed(tmpdir):
+    path = str(tmpdir.join("sync-state.json"))
+    state = sync_state.SyncState(path, resumable=True)
+    state._run = "run-1"
+    state.finished = True
+    state.results = {
+        sync_state.SYNC: {"mw1": 1, "mw2": 1, "mw3": 0},
+        sync_state.CDB_REBUILD: {"mw1": 0, "mw2": 0, "mw3": 0},
+    }
+    state.save()
+
+    resumed = sync_state.load(path)
+    try:
+        with sync_state.SyncState(path, True, resume_from=resumed) as state:
+            state.record("sync-apaches", "mw1", 0, None)
+            raise KeyboardInterrupt()
+    except KeyboardInterrupt:
+        pass
+
+    loaded = sync_state.load(path)
+    assert not loaded.finished
+    assert loaded.complete
+    assert loaded.resumed == "run-1"
+    # mw1 was synced but its l10n was not rebuilt, mw2 was not reached
+    assert loaded.resume_plan() == {
+        sync_state.SYNC: ["mw2"],
+        sync_state.CDB_REBUILD: ["mw1", "mw2"],
+        sync_state.WIKIVERSIONS: [],
+    }
+
+
+def test_load_unusable(tmpdir):
+    assert sync_state.load(str(tmpdir.join("missing"))) is None
+
+    path = tmpdir.join("corrupt")
+    path.write('{"version": 1, "results"')
+    assert sync_state.load(str(path)) is None
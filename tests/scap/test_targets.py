@@ -301,3 +301,13 @@ def test_dsh_direct_deploy_groups():
         "label", {"label": dsh_files}, extra_paths=[dsh_path]
     )
     assert sorted(_HOSTS) == sorted(target_obj.get_deploy_groups()["all_targets"])
+
+
+def test_subgroups__excludes_targets_by_fqdn(mocker):
+    fqdns = {"target1": "target1.eqiad.wmnet"}
+    mocker.patch("socket.getfqdn", side_effect=lambda h: fqdns.get(h, h))
+    mocker.patch.object(targets.utils, "RESOLVER", targets.utils.Resolver())
+
+    group = targets.DeployGroup("foo", _TARGETS)
+    group.exclude("target1.eqiad.wmnet")
+    assert list(group.subgroups()) == [("foo", ["target2", "target3"])]
@@ -1,8 +1,14 @@
 from __future__ import absolute_import
 
+import json
+import os
+
 from datetime import datetime, timedelta
 
-from scap import tasks
+import py
+import pytest
+
+from scap import cdblib, manifest, tasks
 
 
 def test_get_old_wikiversions():
@@ -33,3 +39,446 @@ def test_get_old_wikiversions():
 
     # Returns versions to remove in reverse order
     assert remove_static == ["php-1.29.0-wmf.3", "php-1.29.0-wmf.2"]
+
+
+def manifest_sync(tmpdir, mocker, returncode=0):
+    """Set up a pull with a manifest, returning its configuration and the
+    mocks of check_call and Popen."""
+    deploy_dir = tmpdir.join("deploy")
+    deploy_dir.join("unchanged").write("a", ensure=True)
+    local = {"unchanged": (1, 1, "x"), "changed": (1, 1, "y"), "gone": (1, 1, "z")}
+    remote = {"unchanged": (1, 1, "x"), "changed": (2, 2, "y2"), "new": (1, 1, "n")}
+    manifest.save(local, str(deploy_dir.join(manifest.MANIFEST_NAME)))
+
+    def check_call(cmd):
+        if cmd[-2].endswith("::common/" + manifest.MANIFEST_NAME):
+            manifest.save(remote, cmd[-1])
+
+    check_call = mocker.patch("subprocess.check_call", side_effect=check_call)
+    popen = mocker.patch("subprocess.Popen")
+    popen.return_value.returncode = returncode
+
+    cfg = {
+        "deploy_dir": str(deploy_dir),
+        "master_rsync": "deploy1001",
+        "statsd_host": "127.0.0.1",
+        "statsd_port": 8125,
+    }
+    return cfg, check_call, popen
+
+
+def test_sync_common_fetches_manifest_changes(tmpdir, mocker):
+    cfg, check_call, popen = manifest_sync(tmpdir, mocker)
+    tasks.sync_common(cfg, use_manifest=True)
+
+    rsync = popen.call_args[0][0]
+    assert "--files-from=-" in rsync
+    assert "--delete" not in rsync
+    assert "--exclude=/.scap-manifest" in rsync
+    popen.return_value.communicate.assert_called_once_with(b"changed\0new\0gone")
+
+    # The new manifest is installed after the changed paths were fetched
+    install = check_call.call_args_list[-2][0][0]
+    assert "/usr/bin/install" in install
+    assert install[-2].endswith(manifest.MANIFEST_NAME)
+    assert install[-1] == str(tmpdir.join("deploy"))
+
+
+def test_sync_common_installs_tree_after_full_pull(tmpdir, mocker):
+    deploy_dir = tmpdir.join("deploy").ensure(dir=True)
+
+    def check_call(cmd):
+        if cmd[-2].endswith("::common/" + manifest.MANIFEST_NAME):
+            manifest.save({}, cmd[-1])
+        elif cmd[-2].endswith("::common/" + manifest.TREE_NAME):
+            manifest.save_tree({"": "root"}, cmd[-1])
+
+    check_call = mocker.patch("subprocess.check_call", side_effect=check_call)
+    cfg = {
+        "deploy_dir": str(deploy_dir),
+        "master_rsync": "deploy1001",
+        "statsd_host": "127.0.0.1",
+        "statsd_port": 8125,
+    }
+    tasks.sync_common(cfg, use_manifest=True)
+
+    commands = [call[0][0] for call in check_call.call_args_list]
+    assert commands[2][-2:] == ["deploy1001::common", str(deploy_dir)]
+    assert [os.path.basename(path) for path in commands[3][-3:-1]] == [
+        manifest.MANIFEST_NAME,
+        manifest.TREE_NAME,
+    ]
+
+
+def test_sync_common_keeps_manifest_on_errors(tmpdir, mocker):
+    import subprocess
+
+    cfg, check_call, popen = manifest_sync(tmpdir, mocker, returncode=23)
+    with pytest.raises(subprocess.CalledProcessError):
+        tasks.sync_common(cfg, use_manifest=True)
+
+    commands = [" ".join(call[0][0]) for call in check_call.call_args_list]
+    assert not [cmd for cmd in commands if "/usr/bin/install" in cmd]
+
+
+def test_publish_manifest(tmpdir):
+    stage_dir = tmpdir.join("stage")
+    stage_dir.join("wmf-config", "CommonSettings.php").write("<?php", ensure=True)
+
+    tasks.publish_manifest({"stage_dir": str(stage_dir)})
+
+    files = manifest.load(str(stage_dir.join(manifest.MANIFEST_NAME)))
+    assert sorted(files) == ["wmf-config/CommonSettings.php"]
+    tree = manifest.load_tree(str(stage_dir.join(manifest.TREE_NAME)))
+    assert tree == manifest.tree(files, depth=1)
+
+
+def test_sync_common_skips_matching_tree(tmpdir, mocker):
+    deploy_dir = tmpdir.join("deploy")
+    deploy_dir.ensure(dir=True)
+    manifest.save({}, str(deploy_dir.join(manifest.MANIFEST_NAME)))
+    manifest.save_tree({"": "root"}, str(deploy_dir.join(manifest.TREE_NAME)))
+
+    def check_call(cmd):
+        if cmd[-2].endswith("::common/" + manifest.TREE_NAME):
+            manifest.save_tree({"": "root", "php": "x"}, cmd[-1])
+
+    check_call = mocker.patch("subprocess.check_call", side_effect=check_call)
+    popen = mocker.patch("subprocess.Popen")
+
+    cfg = {
+        "deploy_dir": str(deploy_dir),
+        "master_rsync": "deploy1001",
+        "statsd_host": "127.0.0.1",
+        "statsd_port": 8125,
+    }
+    tasks.sync_common(cfg, use_manifest=True)
+
+    assert not popen.called
+    # Only the tree was fetched, before touching InitialiseSettings.php
+    assert check_call.call_count == 2
+
+
+def test_sync_common_shards(tmpdir, mocker):
+    deploy_dir = tmpdir.join("deploy")
+    deploy_dir.join("wikiversions.json").write('{"enwiki": "php-1.0"}', ensure=True)
+    deploy_dir.join("php-1.0").ensure(dir=True)
+    deploy_dir.join("php-0.9").ensure(dir=True)
+    deploy_dir.join("wmf-config").ensure(dir=True)
+
+    check_call = mocker.patch("subprocess.check_call")
+    popen = mocker.patch("subprocess.Popen")
+    popen.return_value.communicate.return_value = (
+        b"Total bytes received: 1,024\n",
+        None,
+    )
+    popen.return_value.returncode = 0
+
+    cfg = {
+        "deploy_dir": str(deploy_dir),
+        "master_rsync": "deploy1001",
+        "wmf_realm": "production",
+        "rsync_parallelism": 2,
+        "statsd_host": "127.0.0.1",
+        "statsd_port": 8125,
+    }
+    tasks.sync_common(cfg)
+
+    sources = sorted(call[0][0][-2] for call in popen.call_args_list)
+    assert sources == ["deploy1001::common/php-1.0/", "deploy1001::common/wmf-config/"]
+
+    final = check_call.call_args_list[0][0][0]
+    assert final[-2:] == ["deploy1001::common", str(deploy_dir)]
+    assert "--exclude=/php-1.0" in final
+    assert "--exclude=/wmf-config" in final
+    assert "--exclude=/php-0.9" not in final
+
+
+def test_sync_common_shards_delete_excluded(tmpdir, mocker):
+    deploy_dir = tmpdir.join("deploy")
+    deploy_dir.join("wikiversions.json").write('{"enwiki": "php-1.0"}', ensure=True)
+    deploy_dir.join("php-1.0").ensure(dir=True)
+    deploy_dir.join("wmf-config").ensure(dir=True)
+
+    check_call = mocker.patch("subprocess.check_call")
+    popen = mocker.patch("subprocess.Popen")
+    popen.return_value.communicate.return_value = (b"", None)
+    popen.return_value.returncode = 0
+
+    cfg = {
+        "deploy_dir": str(deploy_dir),
+        "master_rsync": "deploy1001",
+        "wmf_realm": "production",
+        "rsync_parallelism": 2,
+        "statsd_host": "127.0.0.1",
+        "statsd_port": 8125,
+    }
+    tasks.sync_common(cfg, rsync_args=["--delete-excluded"])
+
+    # The final pass must not delete the shards it skips
+    final = check_call.call_args_list[0][0][0]
+    assert "--delete-excluded" in final
+    for shard in ["php-1.0", "wmf-config"]:
+        exclude = final.index("--exclude=/%s" % shard)
+        assert final.index("--filter=P /%s" % shard) < exclude
+
+
+def test_sync_common_ordered_servers(tmpdir, mocker):
+    import subprocess
+
+    deploy_dir = tmpdir.join("deploy")
+    deploy_dir.ensure(dir=True)
+    sources = []
+
+    def check_call(cmd):
+        if "rsync" in " ".join(cmd):
+            sources.append(cmd[-2])
+            if cmd[-2].startswith("proxy1"):
+                raise subprocess.CalledProcessError(10, cmd)
+
+    mocker.patch("subprocess.check_call", side_effect=check_call)
+    nearest = mocker.patch.object(tasks.utils, "find_nearest_host")
+
+    cfg = {
+        "deploy_dir": str(deploy_dir),
+        "master_rsync": "deploy1001",
+        "statsd_host": "127.0.0.1",
+        "statsd_port": 8125,
+    }
+    tasks.sync_common(cfg, sync_from=["proxy1", "proxy2", "proxy3"], ordered=True)
+
+    assert sources == ["proxy1::common", "proxy2::common"]
+    assert not nearest.called
+
+
+def test_sync_common_forgets_unreachable_nearest_host(tmpdir, mocker):
+    import subprocess
+
+    deploy_dir = tmpdir.join("deploy")
+    deploy_dir.ensure(dir=True)
+    sources = []
+
+    def check_call(cmd):
+        if "rsync" in " ".join(cmd):
+            sources.append(cmd[-2])
+            if cmd[-2].startswith("proxy1"):
+                raise subprocess.CalledProcessError(10, cmd)
+
+    mocker.patch("subprocess.check_call", side_effect=check_call)
+    nearest = mocker.patch.object(
+        tasks.utils, "find_nearest_host", side_effect=["proxy1", "proxy2"]
+    )
+    forget = mocker.patch.object(tasks.utils, "forget_nearest_host")
+
+    cfg = {
+        "deploy_dir": str(deploy_dir),
+        "master_rsync": "deploy1001",
+        "nearest_host_cache_ttl": 300,
+        "statsd_host": "127.0.0.1",
+        "statsd_port": 8125,
+    }
+    tasks.sync_common(cfg, sync_from=["proxy1", "proxy2", "proxy3"])
+
+    assert sources == ["proxy1::common", "proxy2::common"]
+    forget.assert_called_once_with(tasks.utils.NEAREST_HOST_CACHE, "proxy1")
+    assert nearest.call_args[0][0] == ["proxy2", "proxy3"]
+
+
+def test_bundle_round_trip(tmpdir, mocker):
+    master = tmpdir.join("master")
+    master.join("wmf-config", "InitialiseSettings.php").write("<?php", ensure=True)
+    master.join("php-1.0", "cache", "l10n", "en.json").write("{}", ensure=True)
+    master.join("php-1.0", "cache", "l10n", "de.json").write('{"a": 1}')
+    target = tmpdir.join("target")
+    target.join("php-1.0", "cache", "l10n", "fr.json").write("{}", ensure=True)
+    target.join("php-1.0", "cache", "l10n", "fr.cdb").write("cdb")
+    target.join("wmf-config", "InitialiseSettings.php").write("<?php", ensure=True)
+
+    # Masters serve their staging directory as ::common
+    cfg = {"stage_dir": str(master), "deploy_dir": str(tmpdir.join("deploy"))}
+    digest = tasks.build_bundle(cfg, ["php-1.0/cache/l10n"])
+    bundle = master.join(manifest.BUNDLE_DIR, "%s.tar.gz" % digest)
+    assert bundle.check()
+    assert not tmpdir.join("deploy").check()
+    # Unchanged content is not bundled again
+    assert tasks.build_bundle(cfg, ["php-1.0/cache/l10n/"]) == digest
+
+    def check_call(cmd):
+        assert cmd[-2] == "deploy1001::common/.scap-bundles/%s.tar.gz" % digest
+        bundle.copy(py.path.local(cmd[-1]))
+
+    check_call = mocker.patch("subprocess.check_call", side_effect=check_call)
+
+    cfg = {"deploy_dir": str(target), "master_rsync": "deploy1001"}
+    tasks.apply_bundle(cfg, digest)
+
+    l10n = target.join("php-1.0", "cache", "l10n")
+    assert sorted(f.basename for f in l10n.listdir()) == [
+        "de.json",
+        "en.json",
+        "fr.cdb",
+    ]
+    assert l10n.join("de.json").read() == '{"a": 1}'
+    assert not target.listdir(".scap-bundle-*")
+
+    # Targets which already have the bundle do not fetch it again
+    tasks.apply_bundle(cfg, digest)
+    assert check_call.call_count == 1
+
+
+def test_apply_bundle_checks_digest(tmpdir, mocker):
+    master = tmpdir.join("master")
+    master.join("index.php").write("<?php", ensure=True)
+    digest = tasks.build_bundle({"stage_dir": str(master)}, ["index.php"])
+
+    target = tmpdir.join("target").ensure(dir=True)
+    target.join(manifest.BUNDLE_DIR, "0" * 40 + ".tar.gz").write(
+        master.join(manifest.BUNDLE_DIR, "%s.tar.gz" % digest).read_binary(),
+        mode="wb",
+        ensure=True,
+    )
+
+    with pytest.raises(IOError):
+        tasks.apply_bundle({"deploy_dir": str(target)}, "0" * 40)
+    assert not target.join("index.php").check()
+
+
+@pytest.mark.parametrize("streaming", [False, True])
+def test_update_l10n_cdb(tmpdir, streaming):
+    upstream = tmpdir.join("upstream").ensure(dir=True)
+    upstream.join("l10n_cache-de.cdb.json").write_text(
+        u'{"messages:a": "b", "messages:\\u00e9": "\\u00fc\\/"}', "utf-8"
+    )
+    upstream.join("l10n_cache-de.cdb.MD5").write("0" * 32)
+
+    assert tasks.update_l10n_cdb(str(tmpdir), "l10n_cache-de.cdb", streaming=streaming)
+
+    with cdblib.Reader.open(str(tmpdir.join("l10n_cache-de.cdb"))) as reader:
+        assert sorted(reader.iteritems()) == [
+            (b"messages:a", b"b"),
+            (u"messages:\u00e9".encode("utf-8"), u"\u00fc/".encode("utf-8")),
+        ]
+
+
+def write_cdb(path, data):
+    with open(str(path), "wb") as fp:
+        writer = cdblib.Writer(fp)
+        for key, value in sorted(data.items()):
+            writer.put(key, value)
+        writer.finalize()
+
+
+def read_cdb(path):
+    with cdblib.Reader.open(str(path)) as reader:
+        return dict(reader.iteritems())
+
+
+def test_refresh_cdb_json_file_deltas(tmpdir):
+    cdb = tmpdir.join("x.cdb")
+    upstream = tmpdir.join("upstream").ensure(dir=True)
+
+    write_cdb(cdb, {b"a": b"1", b"b": b"2", b"c": b"3"})
+    tasks.refresh_cdb_json_file(str(cdb), deltas=True)
+    assert not upstream.join("x.cdb.delta").check()
+    upstream.join("x.cdb.json").setmtime(1000)
+
+    write_cdb(cdb, {b"a": b"1", b"b": b"20", b"d": b"4"})
+    tasks.refresh_cdb_json_file(str(cdb), deltas=True)
+    assert json.loads(upstream.join("x.cdb.delta").read()) == {
+        "steps": [
+            {
+                "from": 1000,
+                "to": int(upstream.join("x.cdb.json").mtime()),
+                "keys": 3,
+                "set": {"b": "20", "d": "4"},
+                "remove": ["c"],
+            }
+        ]
+    }
+
+    # Without deltas, the delta file would no longer lead to the json file
+    write_cdb(cdb, {b"a": b"1"})
+    tasks.refresh_cdb_json_file(str(cdb))
+    assert not upstream.join("x.cdb.delta").check()
+
+
+@pytest.mark.parametrize(
+    "cdb_mtime,data,expected",
+    [
+        (
+            1000,
+            {b"a": b"1", b"b": b"2", b"c": b"3"},
+            {b"a": b"1", b"b": b"20", b"e": b"5"},
+        ),
+        (
+            2000,
+            {b"a": b"1", b"b": b"20", b"d": b"4"},
+            {b"a": b"1", b"b": b"20", b"e": b"5"},
+        ),
+        # Older than the oldest delta: rebuilt from the json file
+        (500, {b"a": b"1"}, {b"json": b"1"}),
+        # Not the content the delta applies to
+        (2000, {b"a": b"1"}, {b"json": b"1"}),
+    ],
+)
+def test_update_l10n_cdb_applies_deltas(tmpdir, cdb_mtime, data, expected):
+    upstream = tmpdir.join("upstream").ensure(dir=True)
+    upstream.join("x.cdb.MD5").write("0" * 32)
+    upstream.join("x.cdb.json").write('{"json": "1"}')
+    upstream.join("x.cdb.json").setmtime(3000)
+    steps = [
+        {"from": 1000, "to": 2000, "keys": 3, "set": {"b": "20", "d": "4"}},
+        {"from": 2000, "to": 3000, "keys": 3, "set": {"e": "5"}},
+    ]
+    steps[0]["remove"] = ["c"]
+    steps[1]["remove"] = ["d"]
+    upstream.join("x.cdb.delta").write(json.dumps({"steps": steps}))
+
+    write_cdb(tmpdir.join("x.cdb"), data)
+    tmpdir.join("x.cdb").setmtime(cdb_mtime)
+
+    assert tasks.update_l10n_cdb(str(tmpdir), "x.cdb", trust_mtime=True)
+    assert read_cdb(tmpdir.join("x.cdb")) == expected
+    assert tmpdir.join("x.cdb").mtime() == 3000
+
+
+@pytest.mark.parametrize("size", [0, 2052])
+def test_update_l10n_cdb_rebuilds_unreadable_cdb(tmpdir, size):
+    upstream = tmpdir.join("upstream").ensure(dir=True)
+    upstream.join("x.cdb.MD5").write("0" * 32)
+    upstream.join("x.cdb.json").write('{"json": "1"}')
+    upstream.join("x.cdb.json").setmtime(2000)
+    steps = [{"from": 1000, "to": 2000, "keys": 2, "set": {"b": "2"}, "remove": []}]
+    upstream.join("x.cdb.delta").write(json.dumps({"steps": steps}))
+
+    write_cdb(tmpdir.join("x.cdb"), {b"a": b"1"})
+    tmpdir.join("x.cdb").write_binary(tmpdir.join("x.cdb").read_binary()[:size])
+    tmpdir.join("x.cdb").setmtime(1000)
+
+    assert tasks.update_l10n_cdb(str(tmpdir), "x.cdb", trust_mtime=True)
+    assert read_cdb(tmpdir.join("x.cdb")) == {b"json": b"1"}
+    assert sorted(f.basename for f in tmpdir.listdir()) == ["upstream", "x.cdb"]
+
+
+def test_merge_cdb_updates(tmpdir, mocker):
+    for version, name, size in [
+        ("1.0", "de", 10),
+        ("1.0", "en", 30),
+        ("2.0", "fr", 20),
+    ]:
+        upstream = tmpdir.join(version, "upstream").ensure(dir=True)
+        upstream.join("%s.cdb.json" % name).write('{"a": "%s"}' % ("b" * size))
+        upstream.join("%s.cdb.MD5" % name).write("0" * 32)
+
+    pool = mocker.patch("multiprocessing.Pool").return_value
+    pool.imap_unordered.side_effect = lambda func, tasks: (func(t) for t in tasks)
+
+    dirs = [str(tmpdir.join("1.0")), str(tmpdir.join("2.0"))]
+    assert tasks.merge_cdb_updates(dirs, 4, True, mute=True) == 0
+
+    # A single pool, fed largest file first, and closed
+    submitted = pool.imap_unordered.call_args[0][1]
+    assert [args[1] for args in submitted] == ["en.cdb", "fr.cdb", "de.cdb"]
+    pool.close.assert_called_once_with()
+    pool.join.assert_called_once_with()
+    assert read_cdb(tmpdir.join("2.0", "fr.cdb")) == {b"a": b"b" * 20}
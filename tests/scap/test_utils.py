@@ -97,3 +97,73 @@ def _env(path, env="test"):
     if env is None:
         return utils.get_env_specific_filename(path)
     return utils.get_env_specific_filename(path, env)
+
+
+def test_resolver_caches_lookups(mocker):
+    getfqdn = mocker.patch("socket.getfqdn", side_effect=lambda h: h + ".example")
+    resolver = utils.Resolver(ttl=60)
+
+    resolver.prefetch(["a", "b", "c"])
+    assert getfqdn.call_count == 3
+
+    assert resolver.getfqdn("a") == "a.example"
+    assert resolver.getfqdn("b") == "b.example"
+    assert getfqdn.call_count == 3
+    assert (resolver.hits, resolver.misses) == (2, 3)
+
+    # Entries expire after the TTL
+    resolver.ttl = 0
+    resolver.getfqdn("d")
+    resolver.getfqdn("d")
+    assert getfqdn.call_count == 5
+
+
+def test_resolver_caches_failures(mocker):
+    import socket
+
+    getaddrinfo = mocker.patch(
+        "socket.getaddrinfo", side_effect=socket.gaierror("no such host")
+    )
+    resolver = utils.Resolver()
+
+    for _ in range(2):
+        try:
+            resolver.getaddrinfo("nowhere", 22)
+        except socket.gaierror:
+            pass
+        else:
+            assert False, "expected a resolution failure"
+
+    assert getaddrinfo.call_count == 1
+
+
+def test_find_nearest_host_caches_result(mocker, tmpdir):
+    import socket
+
+    server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    server.bind(("127.0.0.1", 0))
+    server.listen(8)
+    port = server.getsockname()[1]
+    cache = str(tmpdir.join("cache", "nearest.json"))
+    hosts = ["127.0.0.2", "127.0.0.1"]
+
+    try:
+        assert utils.find_nearest_host(hosts, port=port, cache=cache) == "127.0.0.1"
+
+        probe = mocker.patch.object(
+            utils, "_probe_hosts", return_value=("127.0.0.1", set())
+        )
+        assert utils.find_nearest_host(hosts, port=port, cache=cache) == "127.0.0.1"
+        assert not probe.called
+
+        # Results are kept per mode and expire
+        utils.find_nearest_host(hosts, port=port, mode="rtt", cache=cache)
+        utils.find_nearest_host(hosts, port=port, cache=cache, cache_ttl=0)
+        assert probe.call_count == 2
+
+        # Forgotten hosts are probed again
+        utils.forget_nearest_host(cache, "127.0.0.1")
+        utils.find_nearest_host(hosts, port=port, cache=cache)
+        assert probe.call_count == 3
+    finally:
+        server.close()